@@ -0,0 +1,80 @@
+"""
+Замер пула соединений SQLite против соединения на каждый вызов.
+
+    python -m bot.bench_db --users 500 --calls 2000
+
+Работает на временной базе: рабочая DB_PATH не затрагивается. Чтение —
+выборка строки users по user_id, запись — обновление last_active_at
+с коммитом. Вызовы последовательные, результат — микросекунды на вызов.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import aiosqlite
+
+from bot.database import db
+
+
+async def read_connect(path: str, user_id: int):
+    async with aiosqlite.connect(path) as conn:
+        conn.row_factory = aiosqlite.Row
+        cursor = await conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        await cursor.fetchone()
+
+
+async def read_pool(path: str, user_id: int):
+    async with db._db() as conn:
+        cursor = await conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        await cursor.fetchone()
+
+
+async def write_connect(path: str, user_id: int):
+    async with aiosqlite.connect(path) as conn:
+        await conn.execute("UPDATE users SET last_active_at = ? WHERE user_id = ?", (db._now(), user_id))
+        await conn.commit()
+
+
+async def write_pool(path: str, user_id: int):
+    async def op(conn):
+        await conn.execute("UPDATE users SET last_active_at = ? WHERE user_id = ?", (db._now(), user_id))
+
+    await db._write(op)
+
+
+async def measure(fn, path: str, users: int, calls: int) -> float:
+    """Микросекунды на вызов."""
+    started = time.perf_counter()
+    for i in range(calls):
+        await fn(path, i % users)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Замер пула соединений SQLite")
+    parser.add_argument("--users", type=int, default=500, help="пользователей в тестовой базе")
+    parser.add_argument("--calls", type=int, default=2000, help="вызовов на каждый замер")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        db.DB_PATH = path
+        await db.init_db()
+        try:
+            for user_id in range(args.users):
+                await db.get_or_create_user(user_id, f"user{user_id}", "Bench")
+            for name, connect, pool in (
+                ("read", read_connect, read_pool),
+                ("write", write_connect, write_pool),
+            ):
+                before = await measure(connect, path, args.users, args.calls)
+                after = await measure(pool, path, args.users, args.calls)
+                print(f"{name:6s} {before:8.0f} us/call -> {after:6.0f} us/call (connect per call -> pool)")
+        finally:
+            await db.close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
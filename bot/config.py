@@ -1,9 +1,26 @@
+import json
 import os
 from dataclasses import dataclass, field
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Параметры запросов к модели по задачам; model=None — OPENAI_MODEL.
+# LLM_ROUTES в .env переопределяет отдельные поля, в том числе по тарифам:
+# {"card": {"model": "gpt-4o", "tiers": {"free": {"model": "gpt-4o-mini"}}}}
+DEFAULT_ROUTES = {
+    "questions": {"model": None, "max_tokens": 500, "temperature": 0.6, "timeout": 30},
+    # n — вариантов за один запрос: лишние ждут кнопку «Другой вариант»
+    "card": {"model": None, "max_tokens": 2000, "temperature": 0.7, "timeout": 90,
+             "n": int(os.getenv("CARD_CANDIDATES", "1"))},
+    "competitor": {"model": None, "max_tokens": 2500, "temperature": 0.7, "timeout": 120},
+    "rewrite": {"model": None, "max_tokens": 2000, "temperature": 0.8, "timeout": 90},
+    # Массовая генерация из файла: запасные варианты не нужны
+    "bulk": {"model": None, "max_tokens": 2000, "temperature": 0.7, "timeout": 90},
+    # Перегенерация одного раздела карточки (заголовок, ключевые слова)
+    "field": {"model": None, "max_tokens": 500, "temperature": 0.9, "timeout": 30},
+}
+
 
 @dataclass
 class Config:
@@ -15,6 +32,32 @@ class Config:
     openai_api_key: str = os.getenv("OPENAI_API_KEY", "")
     openai_base_url: str = os.getenv("OPENAI_BASE_URL", "https://api.proxyapi.ru/openai/v1")
     openai_model: str = os.getenv("OPENAI_MODEL", "gpt-5-mini-2025-08-07")
+    # Несколько эндпоинтов: OPENAI_ENDPOINTS='[{"base_url": "...", "api_key": "...", "model": "..."}]'
+    # api_key и model необязательны. По умолчанию — один OPENAI_BASE_URL
+    openai_endpoints: list[dict] = field(default_factory=list)
+    llm_routes: dict[str, dict] = field(default_factory=dict)
+    llm_max_attempts: int = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+    llm_backoff_base: float = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+    llm_breaker_threshold: int = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+    llm_breaker_cooldown: float = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+    # HTTP-клиент к API: общий пул соединений, keepalive и таймауты по фазам
+    llm_pool_size: int = int(os.getenv("LLM_POOL_SIZE", "20"))
+    llm_keepalive_connections: int = int(os.getenv("LLM_KEEPALIVE_CONNECTIONS", "10"))
+    llm_keepalive_expiry: float = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "90"))
+    llm_connect_timeout: float = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+    llm_read_timeout: float = float(os.getenv("LLM_READ_TIMEOUT", "120"))
+    llm_http2: bool = os.getenv("LLM_HTTP2", "1") == "1"
+    # Пинг эндпоинтов, чтобы соединения не закрывались в простое; 0 — отключить
+    llm_keepalive_interval: int = int(os.getenv("LLM_KEEPALIVE_INTERVAL", "60"))
+    # Второй запрос, если первый дольше p95 обычной задержки
+    llm_hedge: bool = os.getenv("LLM_HEDGE", "1") == "1"
+    # Потоковая выдача: текст появляется в сообщении по мере генерации.
+    # Правки не чаще раза в stream_edit_interval секунд — лимиты Telegram на edit
+    stream_responses: bool = os.getenv("STREAM_RESPONSES", "1") == "1"
+    stream_edit_interval: float = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+    # Карточки как JSON по схеме (response_format=json_schema); 0 — свободный текст,
+    # для провайдеров без structured outputs
+    structured_cards: bool = os.getenv("STRUCTURED_CARDS", "1") == "1"
 
     # Лимиты
     free_daily_limit: int = int(os.getenv("FREE_DAILY_LIMIT", "3"))
@@ -28,9 +71,87 @@ class Config:
     # Пути
     db_path: str = os.getenv("DB_PATH", "data/bot.db")
 
+    # SQLite: пул соединений и PRAGMA
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", "4"))
+    db_mmap_size: int = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+    db_cache_size_kb: int = int(os.getenv("DB_CACHE_SIZE_KB", "8192"))
+    db_busy_timeout_ms: int = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+    db_statement_cache: int = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+    # Групповой коммит: максимум операций в транзакции и ожидание добора пачки
+    db_write_batch_size: int = int(os.getenv("DB_WRITE_BATCH_SIZE", "64"))
+    db_write_max_wait_ms: float = float(os.getenv("DB_WRITE_MAX_WAIT_MS", "0"))
+    # Как часто сбрасывать накопленные last_active_at в БД, секунд
+    activity_flush_interval: float = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "30"))
+    # Сжатие текстов карточек: уровень zlib и общий словарь, обученный на карточках
+    body_compression_level: int = int(os.getenv("BODY_COMPRESSION_LEVEL", "6"))
+    body_dict_enabled: bool = os.getenv("BODY_DICT", "1") == "1"
+    body_dict_min_samples: int = int(os.getenv("BODY_DICT_MIN_SAMPLES", "100"))
+    # Кэш профилей пользователей: размер (LRU) и время жизни записи, секунд
+    user_cache_size: int = int(os.getenv("USER_CACHE_SIZE", "10000"))
+    user_cache_ttl: float = float(os.getenv("USER_CACHE_TTL", "60"))
+
+    # Очередь запросов к модели: параллельность, старение (секунд ожидания
+    # на ступень тарифа) и глубина, после которой бесплатные запросы отклоняются
+    llm_concurrency: int = int(os.getenv("LLM_CONCURRENCY", "8"))
+    llm_aging_seconds: float = float(os.getenv("LLM_AGING_SECONDS", "10"))
+    llm_shed_queue_depth: int = int(os.getenv("LLM_SHED_QUEUE_DEPTH", "30"))
+    # Предзагрузка стилей при открытии меню: параллельно на пользователя, размер и срок кэша
+    restyle_user_concurrency: int = int(os.getenv("RESTYLE_USER_CONCURRENCY", "2"))
+    restyle_cache_size: int = int(os.getenv("RESTYLE_CACHE_SIZE", "2000"))
+    restyle_cache_ttl: float = float(os.getenv("RESTYLE_CACHE_TTL", "1800"))
+    # Кэш ответов на одинаковые запросы карточек: память (LRU) + SQLite
+    response_cache_enabled: bool = os.getenv("RESPONSE_CACHE", "1") == "1"
+    response_cache_memory_size: int = int(os.getenv("RESPONSE_CACHE_MEMORY_SIZE", "1000"))
+    response_cache_ttl: int = int(os.getenv("RESPONSE_CACHE_TTL", str(7 * 86400)))
+    response_cache_max_rows: int = int(os.getenv("RESPONSE_CACHE_MAX_ROWS", "50000"))
+    # Очередь заданий генерации (SQLite): воркеров, таймаут видимости взятого
+    # задания и число попыток, опрос очереди (секунд), сколько хранить завершённые
+    # Воркеров по умолчанию столько же, сколько слотов к модели: очередь
+    # с приоритетом тарифа — таблица jobs, а не ожидание в llm_scheduler
+    job_workers: int = int(os.getenv("JOB_WORKERS", os.getenv("LLM_CONCURRENCY", "8")))
+    job_visibility_timeout: int = int(os.getenv("JOB_VISIBILITY_TIMEOUT", "120"))
+    job_max_attempts: int = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+    job_poll_interval: float = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+    job_retention: int = int(os.getenv("JOB_RETENTION", str(7 * 86400)))
+    # Резерв генерации, не записанный и не возвращённый за столько секунд,
+    # считается брошенным (процесс упал посреди генерации) и сбрасывается
+    quota_reservation_ttl: int = int(os.getenv("QUOTA_RESERVATION_TTL", "3600"))
+    # Хранилище состояний диалогов: memory, sqlite (переживает рестарт) или redis
+    # (общее для нескольких процессов); срок жизни сессии без обращений, секунд;
+    # сессий в памяти (LRU); как часто sqlite дописывает изменения, секунд
+    fsm_storage: str = os.getenv("FSM_STORAGE", "sqlite")
+    fsm_session_ttl: float = float(os.getenv("FSM_SESSION_TTL", str(86400)))
+    fsm_max_sessions: int = int(os.getenv("FSM_MAX_SESSIONS", "100000"))
+    fsm_flush_interval: float = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))
+    redis_url: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    # Массовая генерация из CSV/XLSX: строк параллельно на задание, максимум строк
+    # в файле, как часто обновлять сообщение о прогрессе (секунд), где хранить файлы
+    bulk_concurrency: int = int(os.getenv("BULK_CONCURRENCY", "4"))
+    bulk_max_rows: int = int(os.getenv("BULK_MAX_ROWS", "5000"))
+    bulk_progress_interval: float = float(os.getenv("BULK_PROGRESS_INTERVAL", "5"))
+    bulk_dir: str = os.getenv("BULK_DIR", "data/bulk")
+
     def __post_init__(self):
         raw = os.getenv("ADMIN_IDS", "")
         self.admin_ids = [int(x.strip()) for x in raw.split(",") if x.strip()]
 
+        overrides = json.loads(os.getenv("LLM_ROUTES", "") or "{}")
+        self.llm_routes = {
+            task: {**defaults, **overrides.get(task, {})}
+            for task, defaults in DEFAULT_ROUTES.items()
+        }
+
+        raw = os.getenv("OPENAI_ENDPOINTS", "")
+        self.openai_endpoints = json.loads(raw) if raw else [
+            {"base_url": self.openai_base_url, "api_key": self.openai_api_key}
+        ]
+
+    def route(self, task: str, plan: str = "free") -> dict:
+        """model, max_tokens, temperature, timeout для задачи с учётом тарифа."""
+        route = dict(self.llm_routes[task])
+        route.update(route.pop("tiers", {}).get(plan, {}))
+        route["model"] = route["model"] or self.openai_model
+        return route
+
 
 config = Config()
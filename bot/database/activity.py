@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityBuffer:
+    """
+    Отложенная запись last_active_at.
+    touch() только запоминает время в памяти; раз в interval секунд всё
+    накопленное пишется в БД одной пачкой. Последнее значение на пользователя
+    побеждает, так что частые нажатия схлопываются в одну запись.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[list[tuple[int, int]]], Awaitable[None]],
+        interval: float = 30.0,
+    ):
+        self._flush = flush
+        self.interval = interval
+        self._pending: dict[int, int] = {}
+        self._task: asyncio.Task | None = None
+
+    def touch(self, user_id: int):
+        self._pending[user_id] = int(time.time())
+
+    def get(self, user_id: int) -> int | None:
+        """Ещё не записанное время активности пользователя."""
+        return self._pending.get(user_id)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            await self._flush([(ts, uid) for uid, ts in batch.items()])
+        except Exception as e:
+            logger.error(f"Activity flush of {len(batch)} users failed: {e}")
+            # Возвращаем в буфер, не затирая более свежие отметки
+            for uid, ts in batch.items():
+                self._pending.setdefault(uid, ts)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name="activity-flush")
+
+    async def stop(self):
+        """Останавливает таймер и сбрасывает остаток."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
@@ -0,0 +1,63 @@
+import time
+from collections import OrderedDict
+from typing import Any
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Ограниченный кэш в памяти: запись живёт ttl секунд,
+    при переполнении вытесняется давно не использованная (LRU).
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+        # Растёт при каждой инвалидации: set() с устаревшим токеном игнорируется,
+        # чтобы чтение, начатое до записи в БД, не вернуло в кэш старое значение
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def token(self) -> int:
+        """Берётся перед чтением из БД и передаётся в set()."""
+        return self._epoch
+
+    def get(self, key: Any) -> Any:
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: Any, value: Any, token: int | None = None):
+        if token is not None and token != self._epoch:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, *keys: Any):
+        self._epoch += 1
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self):
+        self._epoch += 1
+        self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
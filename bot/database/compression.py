@@ -0,0 +1,42 @@
+import zlib
+from collections import Counter
+
+# Предустановленный словарь zlib — до 32 КБ
+MAX_DICT_SIZE = 32 * 1024
+
+
+def compress(text: str, zdict: bytes | None = None, level: int = 6) -> bytes:
+    if zdict:
+        c = zlib.compressobj(level, zdict=zdict)
+    else:
+        c = zlib.compressobj(level)
+    return c.compress(text.encode("utf-8")) + c.flush()
+
+
+def decompress(blob: bytes, zdict: bytes | None = None) -> str:
+    d = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+    return (d.decompress(blob) + d.flush()).decode("utf-8")
+
+
+def train_dictionary(samples: list[str], size: int = MAX_DICT_SIZE) -> bytes:
+    """
+    Словарь из строк, повторяющихся в разных карточках (заголовки разделов,
+    типовые формулировки). zlib дешевле ссылается на конец словаря,
+    поэтому самые полезные строки идут последними.
+    """
+    counts: Counter[str] = Counter()
+    for text in samples:
+        counts.update({line.strip() for line in text.splitlines() if len(line.strip()) >= 4})
+
+    useful = [(n * len(line.encode("utf-8")), line) for line, n in counts.items() if n > 1]
+    useful.sort()
+
+    parts: list[bytes] = []
+    total = 0
+    for _, line in reversed(useful):
+        chunk = line.encode("utf-8") + b"\n"
+        if total + len(chunk) > size:
+            break
+        parts.append(chunk)
+        total += len(chunk)
+    return b"".join(reversed(parts))
@@ -1,73 +1,239 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
 import aiosqlite
-from datetime import datetime, timedelta
+from datetime import datetime
 from bot.config import config
+from bot.database.activity import ActivityBuffer
+from bot.database.cache import MISSING, TTLCache
+from bot.database.compression import compress, decompress, train_dictionary
+from bot.database.migrations import run_migrations
+from bot.database.pool import ConnectionPool
+from bot.database.writer import DBWriter
 
-DB_PATH = config.db_path
+logger = logging.getLogger(__name__)
 
+DB_PATH = config.db_path
 
-async def init_db():
-    """Создание таблиц при первом запуске."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA journal_mode=WAL")
-        await db.execute("PRAGMA synchronous=NORMAL")
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                full_name TEXT,
-                subscription TEXT DEFAULT 'free',
-                sub_expires_at TEXT,
-                referral_code TEXT UNIQUE,
-                referred_by INTEGER,
-                referral_bonus_days INTEGER DEFAULT 0,
-                last_active_at TEXT DEFAULT (datetime('now')),
-                inactive_notified INTEGER DEFAULT 0,
-                created_at TEXT DEFAULT (datetime('now')),
-                is_blocked INTEGER DEFAULT 0
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS generations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                marketplace TEXT,
-                category TEXT,
-                product_name TEXT,
-                result_text TEXT,
-                tokens_in INTEGER DEFAULT 0,
-                tokens_out INTEGER DEFAULT 0,
-                created_at TEXT DEFAULT (datetime('now')),
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        """)
-
-        await db.execute("""
-            CREATE INDEX IF NOT EXISTS idx_gen_user_date
-            ON generations(user_id, created_at)
-        """)
-
-        # Миграции для существующих БД
-        await _migrate(db)
-        await db.commit()
-
-
-async def _migrate(db: aiosqlite.Connection):
-    """Добавляет новые колонки если их нет (безопасно для существующих БД)."""
-    columns = [
-        ("users", "referral_code", "TEXT"),
-        ("users", "referred_by", "INTEGER"),
-        ("users", "referral_bonus_days", "INTEGER DEFAULT 0"),
-        ("users", "last_active_at", "TEXT"),
-        ("users", "inactive_notified", "INTEGER DEFAULT 0"),
-        ("generations", "result_text", "TEXT"),
-    ]
-    for table, col, col_type in columns:
+_pool: ConnectionPool | None = None
+_writer: DBWriter | None = None
+_activity: ActivityBuffer | None = None
+_body_migration: asyncio.Task | None = None
+
+# Словари сжатия текстов карточек: id → данные; 0 — без словаря
+_dicts: dict[int, bytes] = {}
+_current_dict_id = 0
+
+# Строки users по user_id — их читают почти все хэндлеры
+user_cache = TTLCache(maxsize=config.user_cache_size, ttl=config.user_cache_ttl)
+
+# Размер истории карточек по пользователям: user_id → count, вытесняется
+# давно не запрошенный (LRU)
+_history_counts: OrderedDict[int, int] = OrderedDict()
+HISTORY_COUNTS_SIZE = 10000
+
+DAY = 86400
+
+
+def _now() -> int:
+    """Все даты в БД — целые секунды Unix epoch (UTC)."""
+    return int(time.time())
+
+
+def _db():
+    """Соединение из пула: `async with _db() as db: ...`"""
+    if _pool is None:
+        raise RuntimeError("Database is not initialized, call init_db() first")
+    return _pool.acquire()
+
+
+async def _write(op):
+    """Запись через единственного писателя (групповой коммит). op(db) не делает commit."""
+    if _writer is None:
+        raise RuntimeError("Database is not initialized, call init_db() first")
+    return await _writer.submit(op)
+
+
+async def init_db(migrate_bodies: bool = False):
+    """
+    Открытие пула соединений, миграции схемы и запуск писателя.
+    migrate_bodies — фоновый перенос текстов карточек в generation_bodies
+    и обучение словаря сжатия; только для процесса бота, не для утилит
+    (bot.prewarm и т. п.).
+    """
+    global _pool, _writer, _activity
+    _pool = ConnectionPool(
+        DB_PATH,
+        size=config.db_pool_size,
+        mmap_size=config.db_mmap_size,
+        cache_size_kb=config.db_cache_size_kb,
+        busy_timeout_ms=config.db_busy_timeout_ms,
+        statement_cache=config.db_statement_cache,
+    )
+    await _pool.open()
+
+    # Миграции — на отдельном соединении с ручным управлением транзакциями
+    migration_db = await _pool.connect(isolation_level=None)
+    try:
+        version = await run_migrations(migration_db)
+    finally:
+        await migration_db.close()
+    logger.info(f"Database schema v{version}")
+
+    async with _db() as db:
+        await _load_dicts(db)
+
+    _writer = DBWriter(
+        lambda: _pool.connect(isolation_level=None),
+        max_batch=config.db_write_batch_size,
+        max_wait_ms=config.db_write_max_wait_ms,
+    )
+    await _writer.start()
+
+    _activity = ActivityBuffer(_flush_activity, interval=config.activity_flush_interval)
+    _activity.start()
+
+    if migrate_bodies:
+        global _body_migration
+        _body_migration = asyncio.create_task(migrate_generation_bodies(), name="body-migration")
+
+
+async def close_db():
+    """Сброс буфера активности, остановка писателя (с дозаписью очереди) и закрытие пула."""
+    global _pool, _writer, _activity, _body_migration
+    if _body_migration is not None:
+        _body_migration.cancel()
         try:
-            await db.execute(f"ALTER TABLE {table} ADD COLUMN {col} {col_type}")
-        except Exception:
+            await _body_migration
+        except (asyncio.CancelledError, Exception):
             pass
+        _body_migration = None
+    if _activity is not None:
+        await _activity.stop()
+        _activity = None
+    if _writer is not None:
+        await _writer.stop()
+        _writer = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+# ── Сжатие текстов карточек ──
+
+async def _load_dicts(db: aiosqlite.Connection):
+    global _current_dict_id
+    cursor = await db.execute("SELECT id, data FROM compression_dicts ORDER BY id")
+    for row in await cursor.fetchall():
+        _dicts[row["id"]] = row["data"]
+        _current_dict_id = row["id"]
+
+
+def _pack_body(text: str) -> tuple[int, bytes]:
+    return _current_dict_id, compress(text, _dicts.get(_current_dict_id), config.body_compression_level)
+
+
+async def _unpack_body(dict_id: int, body: bytes) -> str:
+    if dict_id and dict_id not in _dicts:
+        # Словарь обучил другой процесс после нашего init_db()
+        async with _db() as db:
+            await _load_dicts(db)
+        if dict_id not in _dicts:
+            raise LookupError(f"Compression dictionary #{dict_id} not found")
+    return decompress(body, _dicts.get(dict_id))
+
+
+async def _train_body_dict(sample_size: int = 500) -> bool:
+    """Обучает общий словарь на последних карточках, если их достаточно."""
+    global _current_dict_id
+    async with _db() as db:
+        cursor = await db.execute(
+            """SELECT result_text FROM generations
+               WHERE result_text IS NOT NULL AND result_text != ''
+               ORDER BY id DESC LIMIT ?""",
+            (sample_size,),
+        )
+        samples = [r[0] for r in await cursor.fetchall()]
+        packed = []
+        if len(samples) < sample_size:
+            cursor = await db.execute(
+                "SELECT dict_id, body FROM generation_bodies ORDER BY generation_id DESC LIMIT ?",
+                (sample_size - len(samples),),
+            )
+            packed = await cursor.fetchall()
+    # Распаковка — после возврата соединения: она может перечитать словари
+    samples += [await _unpack_body(r[0], r[1]) for r in packed]
+
+    if len(samples) < config.body_dict_min_samples:
+        return False
+    zdict = train_dictionary(samples)
+    if not zdict:
+        return False
+
+    async def op(db):
+        cursor = await db.execute("INSERT INTO compression_dicts (data) VALUES (?)", (zdict,))
+        return cursor.lastrowid
+
+    dict_id = await _write(op)
+    _dicts[dict_id] = zdict
+    _current_dict_id = dict_id
+    logger.info(f"Compression dictionary #{dict_id} trained on {len(samples)} cards ({len(zdict)} bytes)")
+    return True
+
+
+async def migrate_generation_bodies(batch_size: int = 200) -> dict:
+    """
+    Онлайн-перенос result_text старых строк в generation_bodies.
+    Идёт пачками через писателя, бот в это время работает как обычно.
+    Возвращает отчёт: сколько строк и байт до/после сжатия.
+    """
+    if config.body_dict_enabled and _current_dict_id == 0:
+        await _train_body_dict()
+
+    report = {"rows": 0, "raw_bytes": 0, "packed_bytes": 0}
+    last_id = 0
+    while True:
+        async def op(db):
+            cursor = await db.execute(
+                """SELECT id, result_text FROM generations
+                   WHERE id > ? AND result_text IS NOT NULL
+                   ORDER BY id LIMIT ?""",
+                (last_id, batch_size),
+            )
+            rows = await cursor.fetchall()
+            bodies = []
+            for row in rows:
+                if not row["result_text"]:
+                    continue
+                dict_id, body = _pack_body(row["result_text"])
+                bodies.append((row["id"], dict_id, body))
+                report["raw_bytes"] += len(row["result_text"].encode("utf-8"))
+                report["packed_bytes"] += len(body)
+            await db.executemany(
+                "INSERT OR IGNORE INTO generation_bodies (generation_id, dict_id, body) VALUES (?, ?, ?)",
+                bodies,
+            )
+            await db.executemany(
+                "UPDATE generations SET result_text = NULL WHERE id = ?",
+                [(row["id"],) for row in rows],
+            )
+            report["rows"] += len(bodies)
+            return rows[-1]["id"] if rows else None
+
+        last_id = await _write(op)
+        if last_id is None:
+            break
+        await asyncio.sleep(0)
+
+    if report["rows"]:
+        saved = 100 - report["packed_bytes"] * 100 // max(report["raw_bytes"], 1)
+        logger.info(
+            f"Card bodies migrated: {report['rows']} rows, "
+            f"{report['raw_bytes'] // 1024} KB → {report['packed_bytes'] // 1024} KB (-{saved}%). "
+            f"Run VACUUM to return the freed pages to the filesystem."
+        )
+    return report
 
 
 # ── Пользователи ──
@@ -82,105 +248,137 @@ async def get_or_create_user(
     user_id: int, username: str = "", full_name: str = "",
     referred_by: int | None = None,
 ) -> dict:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
+    user = await get_user(user_id)
+    if user:
+        await touch_active(user_id)
+        return user
 
-        if row:
-            await db.execute(
-                "UPDATE users SET last_active_at = datetime('now'), inactive_notified = 0 WHERE user_id = ?",
-                (user_id,),
-            )
-            await db.commit()
-            return dict(row)
+    ref_code = _make_ref_code(user_id)
 
-        ref_code = _make_ref_code(user_id)
+    now = _now()
+
+    async def op(db):
         await db.execute(
-            """INSERT INTO users
-               (user_id, username, full_name, referral_code, referred_by, last_active_at)
-               VALUES (?, ?, ?, ?, ?, datetime('now'))""",
-            (user_id, username, full_name, ref_code, referred_by),
+            """INSERT OR IGNORE INTO users
+               (user_id, username, full_name, referral_code, referred_by, last_active_at, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (user_id, username, full_name, ref_code, referred_by, now, now),
         )
-        await db.commit()
-
         cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
-        return dict(row)
+        return dict(await cursor.fetchone())
+
+    user = await _write(op)
+    user_cache.invalidate(user_id)
+    return user
 
 
 async def get_user(user_id: int) -> dict | None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+    cached = user_cache.get(user_id)
+    if cached is MISSING:
+        token = user_cache.token()
+        async with _db() as db:
+            cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+            row = await cursor.fetchone()
+        if not row:
+            return None
+        cached = dict(row)
+        user_cache.set(user_id, cached, token)
+    return _with_activity(dict(cached))
+
+
+def _with_activity(user: dict) -> dict:
+    """Подставляет ещё не записанное в БД время активности."""
+    last_active = _activity.get(user["user_id"]) if _activity else None
+    if last_active:
+        user["last_active_at"] = last_active
+        user["inactive_notified"] = 0
+    return user
 
 
 async def get_user_by_ref_code(ref_code: str) -> dict | None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    async with _db() as db:
         cursor = await db.execute("SELECT * FROM users WHERE referral_code = ?", (ref_code,))
         row = await cursor.fetchone()
-        return dict(row) if row else None
+    return _with_activity(dict(row)) if row else None
 
 
 async def touch_active(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE users SET last_active_at = datetime('now'), inactive_notified = 0 WHERE user_id = ?",
-            (user_id,),
+    """Отмечает активность в памяти; в БД попадёт со следующим сбросом буфера."""
+    if _activity is not None:
+        _activity.touch(user_id)
+
+
+async def _flush_activity(rows: list[tuple[int, int]]):
+    async def op(db):
+        await db.executemany(
+            "UPDATE users SET last_active_at = ?, inactive_notified = 0 WHERE user_id = ?",
+            rows,
         )
-        await db.commit()
+
+    await _write(op)
+    user_cache.invalidate(*(uid for _, uid in rows))
 
 
 async def set_subscription(user_id: int, plan: str, days: int = 30):
-    expires = (datetime.utcnow() + timedelta(days=days)).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
+    expires = _now() + days * DAY
+
+    async def op(db):
         await db.execute(
             "UPDATE users SET subscription = ?, sub_expires_at = ? WHERE user_id = ?",
             (plan, expires, user_id),
         )
-        await db.commit()
+
+    await _write(op)
+    user_cache.invalidate(user_id)
 
 
 async def extend_subscription(user_id: int, extra_days: int):
-    user = await get_user(user_id)
-    if not user:
-        return
-    current_plan = user["subscription"]
-    current_expires = user["sub_expires_at"]
-
-    if current_plan == "free" or not current_expires:
-        await set_subscription(user_id, "pro", extra_days)
-    else:
-        expires_dt = datetime.fromisoformat(current_expires)
-        if expires_dt < datetime.utcnow():
-            expires_dt = datetime.utcnow()
-        new_expires = (expires_dt + timedelta(days=extra_days)).isoformat()
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "UPDATE users SET sub_expires_at = ? WHERE user_id = ?",
-                (new_expires, user_id),
-            )
-            await db.commit()
+    # Чтение и запись в одной операции писателя — параллельные продления не теряются
+    async def op(db):
+        cursor = await db.execute(
+            "SELECT subscription, sub_expires_at FROM users WHERE user_id = ?", (user_id,)
+        )
+        user = await cursor.fetchone()
+        if not user:
+            return
+        current_plan = user["subscription"]
+        current_expires = user["sub_expires_at"]
+
+        now = _now()
+        if current_plan == "free" or not current_expires:
+            plan, base = "pro", now
+        else:
+            plan, base = current_plan, max(current_expires, now)
+        new_expires = base + extra_days * DAY
+        await db.execute(
+            "UPDATE users SET subscription = ?, sub_expires_at = ? WHERE user_id = ?",
+            (plan, new_expires, user_id),
+        )
+
+    await _write(op)
+    user_cache.invalidate(user_id)
 
 
 async def get_active_subscription(user_id: int) -> str:
     user = await get_user(user_id)
     if not user:
         return "free"
-    plan = user["subscription"]
-    expires = user["sub_expires_at"]
+    return await _resolve_plan(user_id, user["subscription"], user["sub_expires_at"])
+
+
+async def _resolve_plan(user_id: int, plan: str, expires: int | None) -> str:
+    """Текущий тариф с учётом срока; истёкшую подписку сбрасывает на free."""
     if plan == "free" or not expires:
         return "free"
-    if datetime.fromisoformat(expires) < datetime.utcnow():
-        async with aiosqlite.connect(DB_PATH) as db:
+    if expires < _now():
+        async def op(db):
             await db.execute(
                 "UPDATE users SET subscription = 'free', sub_expires_at = NULL WHERE user_id = ?",
                 (user_id,),
             )
-            await db.commit()
+
+        await _write(op)
+        user_cache.invalidate(user_id)
         return "free"
     return plan
 
@@ -188,41 +386,49 @@ async def get_active_subscription(user_id: int) -> str:
 # ── Рефералы ──
 
 async def count_referrals(user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _db() as db:
         cursor = await db.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,))
         return (await cursor.fetchone())[0]
 
 
 async def add_referral_bonus(inviter_id: int, bonus_days: int = 3):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async def op(db):
         await db.execute(
             "UPDATE users SET referral_bonus_days = referral_bonus_days + ? WHERE user_id = ?",
             (bonus_days, inviter_id),
         )
-        await db.commit()
+
+    await _write(op)
+    user_cache.invalidate(inviter_id)
     await extend_subscription(inviter_id, bonus_days)
 
 
 # ── Генерации ──
 
-async def count_today_generations(user_id: int) -> int:
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    async with aiosqlite.connect(DB_PATH) as db:
+def _day_period(now: datetime | None = None) -> str:
+    return "d:" + (now or datetime.utcnow()).strftime("%Y-%m-%d")
+
+
+def _month_period(now: datetime | None = None) -> str:
+    return "m:" + (now or datetime.utcnow()).strftime("%Y-%m")
+
+
+async def _get_usage(user_id: int, period: str) -> int:
+    async with _db() as db:
         cursor = await db.execute(
-            "SELECT COUNT(*) FROM generations WHERE user_id = ? AND created_at >= ?",
-            (user_id, today),
+            "SELECT count FROM usage_counters WHERE user_id = ? AND period = ?",
+            (user_id, period),
         )
-        return (await cursor.fetchone())[0]
+        row = await cursor.fetchone()
+        return row[0] if row else 0
+
+
+async def count_today_generations(user_id: int) -> int:
+    return await _get_usage(user_id, _day_period())
 
 
 async def count_month_generations(user_id: int) -> int:
-    month_start = datetime.utcnow().replace(day=1).strftime("%Y-%m-%d")
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            "SELECT COUNT(*) FROM generations WHERE user_id = ? AND created_at >= ?",
-            (user_id, month_start),
-        )
-        return (await cursor.fetchone())[0]
+    return await _get_usage(user_id, _month_period())
 
 
 async def log_generation(
@@ -233,80 +439,762 @@ async def log_generation(
     result_text: str = "",
     tokens_in: int = 0,
     tokens_out: int = 0,
-):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+    model: str | None = None,
+    latency_ms: int = 0,
+    candidates: list[tuple[str, int]] | None = None,
+    result_format: int = 0,
+    bulk_row: tuple[int, int] | None = None,
+    job_id: int | None = None,
+    details: str | None = None,
+    reserved_period: str | None = None,
+) -> int:
+    """
+    Сохраняет генерацию и увеличивает счётчики дня и месяца в одной транзакции.
+    candidates — запасные варианты (текст, токены_выход) для «Другой вариант»,
+    в том же формате result_format, что и основной текст; details — ответы
+    на вопросы, по ним «Другой вариант» генерирует карточку заново.
+    bulk_row — (job_id, row_no) строки массовой генерации: отмечается в той же
+    транзакции; если строка уже записана, возвращается её генерация без списания.
+    job_id — задание очереди: так же, повторное выполнение задания не создаёт
+    вторую генерацию. reserved_period — период резерва reserve_generation():
+    резерв снимается в той же транзакции.
+    """
+    created_at = _now()
+    now = datetime.utcfromtimestamp(created_at)
+
+    body = _pack_body(result_text) if result_text else None
+    packed = [(i, *_pack_body(text), tokens) for i, (text, tokens) in enumerate(candidates or [], 1)]
+
+    async def op(db):
+        if reserved_period is not None:
+            await _unreserve(db, user_id, reserved_period)
+        if bulk_row is not None:
+            cursor = await db.execute(
+                "SELECT generation_id FROM bulk_rows WHERE job_id = ? AND row_no = ?", bulk_row
+            )
+            row = await cursor.fetchone()
+            if row is not None:
+                return row["generation_id"], False
+        if job_id is not None:
+            cursor = await db.execute("SELECT generation_id FROM jobs WHERE id = ?", (job_id,))
+            row = await cursor.fetchone()
+            if row is not None and row["generation_id"] is not None:
+                return row["generation_id"], False
+        cursor = await db.execute(
             """INSERT INTO generations
-               (user_id, marketplace, category, product_name, result_text, tokens_in, tokens_out)
-               VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (user_id, marketplace, category, product_name, result_text, tokens_in, tokens_out),
+               (user_id, marketplace, category, product_name, details, has_result,
+                tokens_in, tokens_out, model, latency_ms, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (user_id, marketplace, category, product_name, details, int(body is not None),
+             tokens_in, tokens_out, model, latency_ms, created_at),
         )
-        await db.commit()
+        if body is not None:
+            await db.execute(
+                "INSERT INTO generation_bodies (generation_id, dict_id, body, format) VALUES (?, ?, ?, ?)",
+                (cursor.lastrowid, *body, result_format),
+            )
+        if packed:
+            await db.executemany(
+                """INSERT INTO generation_candidates (generation_id, idx, dict_id, body, tokens_out)
+                   VALUES (?, ?, ?, ?, ?)""",
+                [(cursor.lastrowid, *row) for row in packed],
+            )
+        if bulk_row is not None:
+            await db.execute(
+                "INSERT INTO bulk_rows (job_id, row_no, generation_id) VALUES (?, ?, ?)",
+                (*bulk_row, cursor.lastrowid),
+            )
+        if job_id is not None:
+            await db.execute(
+                "UPDATE jobs SET generation_id = ?, updated_at = ? WHERE id = ?",
+                (cursor.lastrowid, created_at, job_id),
+            )
+        await db.executemany(
+            """INSERT INTO usage_counters (user_id, period, count) VALUES (?, ?, 1)
+               ON CONFLICT(user_id, period) DO UPDATE SET count = count + 1""",
+            [(user_id, _day_period(now)), (user_id, _month_period(now))],
+        )
+        return cursor.lastrowid, True
+
+    gen_id, created = await _write(op)
+    if created and body is not None and user_id in _history_counts:
+        _history_counts[user_id] += 1
     await touch_active(user_id)
+    return gen_id
 
 
-async def get_user_generations(user_id: int, limit: int = 5, offset: int = 0) -> list[dict]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+async def pop_candidate(generation_id: int, user_id: int) -> tuple[str, int, int] | None:
+    """
+    Следующий неиспользованный вариант генерации (текст, токены_выход, формат);
+    помечается показанным. Формат — как у основного текста генерации.
+    """
+    async def op(db):
         cursor = await db.execute(
-            """SELECT id, marketplace, product_name, result_text, created_at
+            """SELECT c.idx, c.dict_id, c.body, c.tokens_out, COALESCE(b.format, 0) AS format
+               FROM generation_candidates c JOIN generations g ON g.id = c.generation_id
+               LEFT JOIN generation_bodies b ON b.generation_id = c.generation_id
+               WHERE c.generation_id = ? AND g.user_id = ? AND c.used_at IS NULL
+               ORDER BY c.idx LIMIT 1""",
+            (generation_id, user_id),
+        )
+        row = await cursor.fetchone()
+        if not row:
+            return None
+        await db.execute(
+            "UPDATE generation_candidates SET used_at = ? WHERE generation_id = ? AND idx = ?",
+            (_now(), generation_id, row["idx"]),
+        )
+        return row["dict_id"], row["body"], row["tokens_out"], row["format"]
+
+    row = await _write(op)
+    if row is None:
+        return None
+    return await _unpack_body(row[0], row[1]), row[2], row[3]
+
+
+async def get_user_generations(
+    user_id: int, limit: int = 5, anchor_id: int | None = None, newer: bool = False,
+) -> list[dict]:
+    """
+    Страница истории (новые сверху) по курсору (created_at, id) вместо OFFSET:
+    без anchor_id — первая страница, иначе записи старше якоря
+    (или новее, если newer=True). Стоимость не зависит от номера страницы.
+    """
+    async with _db() as db:
+        if anchor_id is None:
+            cursor = await db.execute(
+                """SELECT id, marketplace, product_name, created_at
+                   FROM generations
+                   WHERE user_id = ? AND has_result = 1
+                   ORDER BY created_at DESC, id DESC LIMIT ?""",
+                (user_id, limit),
+            )
+            return [dict(r) for r in await cursor.fetchall()]
+
+        cursor = await db.execute(
+            "SELECT created_at FROM generations WHERE id = ? AND user_id = ?", (anchor_id, user_id)
+        )
+        anchor = await cursor.fetchone()
+        if not anchor:
+            return []
+        if newer:
+            cursor = await db.execute(
+                """SELECT id, marketplace, product_name, created_at
+                   FROM generations
+                   WHERE user_id = ? AND has_result = 1 AND (created_at, id) > (?, ?)
+                   ORDER BY created_at ASC, id ASC LIMIT ?""",
+                (user_id, anchor["created_at"], anchor_id, limit),
+            )
+            return [dict(r) for r in reversed(await cursor.fetchall())]
+        cursor = await db.execute(
+            """SELECT id, marketplace, product_name, created_at
                FROM generations
-               WHERE user_id = ? AND result_text IS NOT NULL AND result_text != ''
-               ORDER BY created_at DESC LIMIT ? OFFSET ?""",
-            (user_id, limit, offset),
+               WHERE user_id = ? AND has_result = 1 AND (created_at, id) < (?, ?)
+               ORDER BY created_at DESC, id DESC LIMIT ?""",
+            (user_id, anchor["created_at"], anchor_id, limit),
         )
         return [dict(r) for r in await cursor.fetchall()]
 
 
 async def get_generation_by_id(gen_id: int, user_id: int) -> dict | None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    """
+    Генерация с текстом; сжатое тело распаковывается только здесь.
+    result_format — формат result_text (см. bot.services.card_format).
+    """
+    async with _db() as db:
         cursor = await db.execute(
-            "SELECT * FROM generations WHERE id = ? AND user_id = ?", (gen_id, user_id)
+            """SELECT g.*, b.dict_id AS body_dict_id, b.body, COALESCE(b.format, 0) AS result_format
+               FROM generations g
+               LEFT JOIN generation_bodies b ON b.generation_id = g.id
+               WHERE g.id = ? AND g.user_id = ?""",
+            (gen_id, user_id),
         )
         row = await cursor.fetchone()
-        return dict(row) if row else None
+    if not row:
+        return None
+    card = dict(row)
+    body = card.pop("body")
+    dict_id = card.pop("body_dict_id")
+    if body is not None:
+        card["result_text"] = await _unpack_body(dict_id, body)
+    return card
+
+
+async def get_generation_source(gen_id: int, user_id: int) -> dict | None:
+    """Товар и ответы на вопросы карточки (без текста); None — нет генерации или ответов."""
+    async with _db() as db:
+        cursor = await db.execute(
+            """SELECT marketplace, product_name, details FROM generations
+               WHERE id = ? AND user_id = ? AND details IS NOT NULL""",
+            (gen_id, user_id),
+        )
+        row = await cursor.fetchone()
+    return dict(row) if row else None
 
 
 async def count_user_generations(user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
+    """Число карточек в истории; считается один раз, дальше поддерживается log_generation."""
+    cached = _history_counts.get(user_id)
+    if cached is not None:
+        _history_counts.move_to_end(user_id)
+        return cached
+    async with _db() as db:
         cursor = await db.execute(
-            "SELECT COUNT(*) FROM generations WHERE user_id = ? AND result_text IS NOT NULL AND result_text != ''",
+            "SELECT COUNT(*) FROM generations WHERE user_id = ? AND has_result = 1",
             (user_id,),
         )
-        return (await cursor.fetchone())[0]
+        total = (await cursor.fetchone())[0]
+    _history_counts[user_id] = total
+    _history_counts.move_to_end(user_id)
+    while len(_history_counts) > HISTORY_COUNTS_SIZE:
+        _history_counts.popitem(last=False)
+    return total
 
 
 # ── Лимиты ──
 
-async def check_limit(user_id: int) -> tuple[bool, int, int]:
-    plan = await get_active_subscription(user_id)
+def _plan_limit(plan: str, day_count: int, month_count: int) -> tuple[bool, int, int]:
     if plan == "free":
-        used = await count_today_generations(user_id)
+        used = day_count
         limit = config.free_daily_limit
         return used < limit, used, limit
     elif plan == "standard":
-        used = await count_month_generations(user_id)
+        used = month_count
         limit = config.standard_monthly_limit
         return used < limit, used, limit
     elif plan == "pro":
-        used = await count_month_generations(user_id)
+        used = month_count
         limit = config.pro_monthly_limit
         return used < limit, used, limit
     return False, 0, 0
 
 
+async def check_limit(user_id: int) -> tuple[bool, int, int]:
+    """Тариф и счётчик текущего периода — одним запросом по первичным ключам."""
+    async with _db() as db:
+        cursor = await db.execute(
+            """SELECT u.subscription, u.sub_expires_at,
+                      COALESCE(d.count, 0) AS day_count,
+                      COALESCE(m.count, 0) AS month_count
+               FROM users u
+               LEFT JOIN usage_counters d ON d.user_id = u.user_id AND d.period = ?
+               LEFT JOIN usage_counters m ON m.user_id = u.user_id AND m.period = ?
+               WHERE u.user_id = ?""",
+            (_day_period(), _month_period(), user_id),
+        )
+        row = await cursor.fetchone()
+    if not row:
+        return _plan_limit("free", 0, 0)
+
+    plan = await _resolve_plan(user_id, row["subscription"], row["sub_expires_at"])
+    return _plan_limit(plan, row["day_count"], row["month_count"])
+
+
+async def reserve_generation(user_id: int) -> tuple[bool, int, int, str]:
+    """
+    Резервирует одну генерацию в счётчике периода, по которому считается
+    лимит тарифа. Проверка count + reserved и увеличение reserved — одна
+    операция писателя (BEGIN IMMEDIATE), поэтому лимит не превысят и
+    параллельные запросы из разных процессов.
+    Возвращает (разрешено, израсходовано с резервами, лимит, период).
+    """
+    plan = await get_active_subscription(user_id)
+    period = _day_period() if plan == "free" else _month_period()
+
+    async def op(db):
+        cursor = await db.execute(
+            "SELECT count + reserved FROM usage_counters WHERE user_id = ? AND period = ?",
+            (user_id, period),
+        )
+        row = await cursor.fetchone()
+        used = row[0] if row else 0
+        allowed, used, limit = _plan_limit(plan, used, used)
+        if allowed:
+            await db.execute(
+                """INSERT INTO usage_counters (user_id, period, count, reserved, reserved_at)
+                   VALUES (?, ?, 0, 1, ?)
+                   ON CONFLICT(user_id, period) DO UPDATE SET
+                       reserved = reserved + 1, reserved_at = excluded.reserved_at""",
+                (user_id, period, _now()),
+            )
+        return allowed, used, limit
+
+    allowed, used, limit = await _write(op)
+    return allowed, used, limit, period
+
+
+async def _unreserve(db, user_id: int, period: str):
+    await db.execute(
+        "UPDATE usage_counters SET reserved = MAX(reserved - 1, 0) WHERE user_id = ? AND period = ?",
+        (user_id, period),
+    )
+
+
+async def release_generation(user_id: int, period: str):
+    """Возвращает резерв reserve_generation(), не ставший генерацией."""
+    async def op(db):
+        await _unreserve(db, user_id, period)
+
+    await _write(op)
+
+
+async def purge_quota_reservations(max_age: int) -> int:
+    """Сбрасывает резервы строк, где не резервировали дольше max_age секунд."""
+    async def op(db):
+        cursor = await db.execute(
+            "UPDATE usage_counters SET reserved = 0 WHERE reserved > 0 AND reserved_at < ?",
+            (_now() - max_age,),
+        )
+        return cursor.rowcount
+
+    return await _write(op)
+
+
+async def get_user_context(user_id: int) -> dict:
+    """
+    Всё, что хэндлерам нужно о пользователе, одним запросом:
+    профиль, тариф, расход за день и месяц, число приглашённых и лимит.
+    Для неизвестного пользователя user = None и тариф free.
+    """
+    token = user_cache.token()
+    async with _db() as db:
+        cursor = await db.execute(
+            """SELECT u.*,
+                      COALESCE(d.count, 0) AS ctx_today,
+                      COALESCE(m.count, 0) AS ctx_month,
+                      (SELECT COUNT(*) FROM users r WHERE r.referred_by = u.user_id) AS ctx_referrals
+               FROM users u
+               LEFT JOIN usage_counters d ON d.user_id = u.user_id AND d.period = ?
+               LEFT JOIN usage_counters m ON m.user_id = u.user_id AND m.period = ?
+               WHERE u.user_id = ?""",
+            (_day_period(), _month_period(), user_id),
+        )
+        row = await cursor.fetchone()
+
+    if not row:
+        allowed, used, limit = _plan_limit("free", 0, 0)
+        return {
+            "user": None, "plan": "free", "today_gens": 0, "month_gens": 0,
+            "referrals": 0, "allowed": allowed, "used": used, "limit": limit,
+        }
+
+    user = dict(row)
+    today, month, referrals = user.pop("ctx_today"), user.pop("ctx_month"), user.pop("ctx_referrals")
+    user_cache.set(user_id, dict(user), token)
+
+    plan = await _resolve_plan(user_id, user["subscription"], user["sub_expires_at"])
+    if plan != user["subscription"]:
+        user["subscription"], user["sub_expires_at"] = plan, None
+    allowed, used, limit = _plan_limit(plan, today, month)
+    return {
+        "user": _with_activity(user), "plan": plan,
+        "today_gens": today, "month_gens": month, "referrals": referrals,
+        "allowed": allowed, "used": used, "limit": limit,
+    }
+
+
+# ── Кэш ответов модели ──
+
+async def get_cached_response(key: str, max_age: int) -> tuple[str, int, int] | None:
+    """(текст, токены_вход, токены_выход) сохранённого ответа, если он не старше max_age секунд."""
+    async with _db() as db:
+        cursor = await db.execute(
+            """SELECT dict_id, body, tokens_in, tokens_out FROM response_cache
+               WHERE key = ? AND created_at >= ?""",
+            (key, _now() - max_age),
+        )
+        row = await cursor.fetchone()
+    if not row:
+        return None
+
+    async def op(db):
+        await db.execute(
+            "UPDATE response_cache SET hits = hits + 1, last_hit_at = ? WHERE key = ?",
+            (_now(), key),
+        )
+
+    await _write(op)
+    return await _unpack_body(row["dict_id"], row["body"]), row["tokens_in"], row["tokens_out"]
+
+
+async def put_cached_response(key: str, text: str, tokens_in: int, tokens_out: int):
+    dict_id, body = _pack_body(text)
+    now = _now()
+
+    async def op(db):
+        await db.execute(
+            """INSERT INTO response_cache
+                   (key, dict_id, body, tokens_in, tokens_out, created_at, last_hit_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(key) DO UPDATE SET
+                   dict_id = excluded.dict_id, body = excluded.body,
+                   tokens_in = excluded.tokens_in, tokens_out = excluded.tokens_out,
+                   created_at = excluded.created_at, last_hit_at = excluded.last_hit_at""",
+            (key, dict_id, body, tokens_in, tokens_out, now, now),
+        )
+
+    await _write(op)
+
+
+async def evict_response_cache(max_age: int, max_rows: int) -> int:
+    """Удаляет просроченные ответы, затем самые давно востребованные сверх max_rows."""
+    async def op(db):
+        cursor = await db.execute(
+            "DELETE FROM response_cache WHERE created_at < ?", (_now() - max_age,)
+        )
+        removed = cursor.rowcount
+        cursor = await db.execute(
+            """DELETE FROM response_cache WHERE key IN (
+                   SELECT key FROM response_cache ORDER BY last_hit_at DESC LIMIT -1 OFFSET ?
+               )""",
+            (max_rows,),
+        )
+        return removed + cursor.rowcount
+
+    return await _write(op)
+
+
+async def get_top_product_names(limit: int = 5000) -> list[tuple[str, str, int]]:
+    """Самые частые (маркетплейс, название товара, число генераций) — для прогрева кэша вопросов."""
+    async with _db() as db:
+        cursor = await db.execute(
+            """SELECT marketplace, product_name, COUNT(*) AS n FROM generations
+               WHERE COALESCE(category, '') != 'анализ' AND product_name != ''
+               GROUP BY marketplace, product_name
+               ORDER BY n DESC LIMIT ?""",
+            (limit,),
+        )
+        return [(r["marketplace"], r["product_name"], r["n"]) for r in await cursor.fetchall()]
+
+
+# ── Массовая генерация ──
+
+async def create_bulk_job(
+    user_id: int, chat_id: int, marketplace: str, file_name: str, source: str, total: int,
+) -> int:
+    """marketplace — для строк, где он не указан."""
+    now = _now()
+
+    async def op(db):
+        cursor = await db.execute(
+            """INSERT INTO bulk_jobs
+               (user_id, chat_id, marketplace, file_name, source, total, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (user_id, chat_id, marketplace, file_name, source, total, now, now),
+        )
+        return cursor.lastrowid
+
+    return await _write(op)
+
+
+async def get_bulk_job(job_id: int) -> dict | None:
+    async with _db() as db:
+        cursor = await db.execute("SELECT * FROM bulk_jobs WHERE id = ?", (job_id,))
+        row = await cursor.fetchone()
+    return dict(row) if row else None
+
+
+async def get_running_bulk_jobs(user_id: int | None = None) -> list[dict]:
+    """Незавершённые задания — все или одного пользователя."""
+    async with _db() as db:
+        if user_id is None:
+            cursor = await db.execute("SELECT * FROM bulk_jobs WHERE status = 'running' ORDER BY id")
+        else:
+            cursor = await db.execute(
+                "SELECT * FROM bulk_jobs WHERE status = 'running' AND user_id = ? ORDER BY id", (user_id,)
+            )
+        return [dict(r) for r in await cursor.fetchall()]
+
+
+async def update_bulk_job(job_id: int, **fields):
+    """Меняет message_id, status, next_row."""
+    if not set(fields) <= {"message_id", "status", "next_row"}:
+        raise ValueError(f"Unknown bulk job fields: {sorted(fields)}")
+    columns = ", ".join(f"{name} = ?" for name in fields)
+
+    async def op(db):
+        await db.execute(
+            f"UPDATE bulk_jobs SET {columns}, updated_at = ? WHERE id = ?",
+            (*fields.values(), _now(), job_id),
+        )
+
+    await _write(op)
+
+
+async def save_bulk_error(job_id: int, row_no: int, error: str):
+    async def op(db):
+        await db.execute(
+            "INSERT OR IGNORE INTO bulk_rows (job_id, row_no, error) VALUES (?, ?, ?)",
+            (job_id, row_no, error),
+        )
+
+    await _write(op)
+
+
+async def get_bulk_progress(job_id: int, from_row: int = 0) -> tuple[int, int, set[int]]:
+    """
+    (готово, ошибок, обработанные строки начиная с from_row). Строк после
+    next_row задания не больше, чем шло параллельно, — множество маленькое.
+    """
+    async with _db() as db:
+        cursor = await db.execute(
+            "SELECT COUNT(generation_id), COUNT(error) FROM bulk_rows WHERE job_id = ?", (job_id,)
+        )
+        done, failed = await cursor.fetchone()
+        cursor = await db.execute(
+            "SELECT row_no FROM bulk_rows WHERE job_id = ? AND row_no >= ?", (job_id, from_row)
+        )
+        rows = {r[0] for r in await cursor.fetchall()}
+    return done, failed, rows
+
+
+async def iter_bulk_results(job_id: int, page: int = 200):
+    """(row_no, текст, формат, ошибка) по возрастанию row_no, постранично — без загрузки всего задания."""
+    last = -1
+    while True:
+        async with _db() as db:
+            cursor = await db.execute(
+                """SELECT r.row_no, r.error, b.dict_id, b.body, COALESCE(b.format, 0) AS format
+                   FROM bulk_rows r
+                   LEFT JOIN generation_bodies b ON b.generation_id = r.generation_id
+                   WHERE r.job_id = ? AND r.row_no > ?
+                   ORDER BY r.row_no LIMIT ?""",
+                (job_id, last, page),
+            )
+            rows = await cursor.fetchall()
+        if not rows:
+            return
+        for row in rows:
+            text = await _unpack_body(row["dict_id"], row["body"]) if row["body"] is not None else ""
+            yield row["row_no"], text, row["format"], row["error"]
+        last = rows[-1]["row_no"]
+
+
+# ── Очередь заданий ──
+
+async def create_job(
+    kind: str, user_id: int, chat_id: int, payload: str, score: float, exclusive: bool = False,
+) -> int | None:
+    """
+    score — порядок выдачи воркерам (меньше — раньше), см. JobQueue.enqueue.
+    exclusive — не ставить, если такое же задание пользователя ещё ждёт
+    или выполняется (повторное нажатие кнопки); тогда возвращается None.
+    Проверка и вставка идут одной операцией писателя — гонки между ними нет.
+    """
+    now = _now()
+
+    async def op(db):
+        if exclusive:
+            cursor = await db.execute(
+                """SELECT 1 FROM jobs
+                   WHERE user_id = ? AND kind = ? AND status IN ('queued', 'running')""",
+                (user_id, kind),
+            )
+            if await cursor.fetchone():
+                return None
+        cursor = await db.execute(
+            """INSERT INTO jobs (kind, user_id, chat_id, payload, score, visible_at, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (kind, user_id, chat_id, payload, score, now, now, now),
+        )
+        return cursor.lastrowid
+
+    return await _write(op)
+
+
+async def claim_job(visibility_timeout: int) -> dict | None:
+    """
+    Забирает доступное задание с наименьшим score: новое или брошенное
+    упавшим воркером (running с истёкшим visible_at). Скрывает его на visibility_timeout.
+    """
+    async def op(db):
+        now = _now()
+        cursor = await db.execute(
+            """SELECT * FROM jobs
+               WHERE status IN ('queued', 'running') AND visible_at <= ?
+               ORDER BY score, id LIMIT 1""",
+            (now,),
+        )
+        row = await cursor.fetchone()
+        if row is None:
+            return None
+        await db.execute(
+            """UPDATE jobs SET status = 'running', attempts = attempts + 1,
+                   visible_at = ?, updated_at = ?
+               WHERE id = ?""",
+            (now + visibility_timeout, now, row["id"]),
+        )
+        job = dict(row)
+        job["attempts"] += 1
+        return job
+
+    return await _write(op)
+
+
+async def has_ready_job() -> bool:
+    """Дешёвая проверка чтением — чтобы простаивающая очередь не открывала транзакцию записи."""
+    async with _db() as db:
+        cursor = await db.execute(
+            "SELECT 1 FROM jobs WHERE status IN ('queued', 'running') AND visible_at <= ? LIMIT 1",
+            (_now(),),
+        )
+        return await cursor.fetchone() is not None
+
+
+async def count_ready_jobs() -> int:
+    """Задания, ждущие воркера, — глубина очереди для отказа бесплатным."""
+    async with _db() as db:
+        cursor = await db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND visible_at <= ?", (_now(),),
+        )
+        return (await cursor.fetchone())[0]
+
+
+async def extend_job(job_id: int, visibility_timeout: int):
+    """Продлевает скрытие задания, пока воркер над ним работает."""
+    async def op(db):
+        now = _now()
+        await db.execute(
+            "UPDATE jobs SET visible_at = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+            (now + visibility_timeout, now, job_id),
+        )
+
+    await _write(op)
+
+
+async def set_job_message(job_id: int, message_id: int):
+    """Сообщение ожидания задания — при повторе правится оно же, а не создаётся новое."""
+    async def op(db):
+        await db.execute("UPDATE jobs SET message_id = ? WHERE id = ?", (message_id, job_id))
+
+    await _write(op)
+
+
+async def retry_job(job_id: int, delay: int, error: str):
+    async def op(db):
+        now = _now()
+        await db.execute(
+            """UPDATE jobs SET status = 'queued', visible_at = ?, error = ?, updated_at = ?
+               WHERE id = ?""",
+            (now + delay, error, now, job_id),
+        )
+
+    await _write(op)
+
+
+async def finish_job(job_id: int, status: str, error: str | None = None):
+    """status: done | failed."""
+    async def op(db):
+        await db.execute(
+            "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+            (status, error, _now(), job_id),
+        )
+
+    await _write(op)
+
+
+async def recover_jobs() -> int:
+    """
+    При старте: задания, взятые до остановки, сразу снова доступны —
+    ждать истечения таймаута видимости некому.
+    """
+    async def op(db):
+        cursor = await db.execute(
+            "UPDATE jobs SET visible_at = ? WHERE status = 'running'", (_now(),)
+        )
+        return cursor.rowcount
+
+    return await _write(op)
+
+
+async def purge_jobs(max_age: int) -> int:
+    """Удаляет завершённые задания старше max_age секунд."""
+    async def op(db):
+        cursor = await db.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+            (_now() - max_age,),
+        )
+        return cursor.rowcount
+
+    return await _write(op)
+
+
+async def get_job_counts() -> dict[str, int]:
+    async with _db() as db:
+        cursor = await db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        counts = {status: n for status, n in await cursor.fetchall()}
+    return {status: counts.get(status, 0) for status in ("queued", "running", "done", "failed")}
+
+
+# ── Состояния диалогов (FSM) ──
+
+async def load_fsm_session(key: str, max_age: float) -> tuple[str | None, str] | None:
+    """(state, data JSON) сессии, записанной не раньше max_age секунд назад."""
+    async with _db() as db:
+        cursor = await db.execute(
+            "SELECT state, data FROM fsm_sessions WHERE key = ? AND updated_at >= ?",
+            (key, _now() - max_age),
+        )
+        row = await cursor.fetchone()
+    return (row["state"], row["data"]) if row else None
+
+
+async def save_fsm_sessions(
+    rows: list[tuple[str, str | None, str]],
+    deleted: list[str],
+    touched: list[str] = (),
+):
+    """
+    Пачка сессий одной операцией писателя: rows — (key, state, data JSON),
+    deleted — пустые, touched — только прочитанные (продлевается срок).
+    """
+    now = _now()
+
+    async def op(db):
+        if rows:
+            await db.executemany(
+                """INSERT INTO fsm_sessions (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(key) DO UPDATE SET
+                       state = excluded.state, data = excluded.data, updated_at = excluded.updated_at""",
+                [(key, state, data, now) for key, state, data in rows],
+            )
+        if deleted:
+            await db.executemany("DELETE FROM fsm_sessions WHERE key = ?", [(key,) for key in deleted])
+        if touched:
+            await db.executemany(
+                "UPDATE fsm_sessions SET updated_at = ? WHERE key = ?", [(now, key) for key in touched]
+            )
+
+    await _write(op)
+
+
+async def purge_fsm_sessions(max_age: float) -> int:
+    async def op(db):
+        cursor = await db.execute("DELETE FROM fsm_sessions WHERE updated_at < ?", (_now() - max_age,))
+        return cursor.rowcount
+
+    return await _write(op)
+
+
+async def count_fsm_sessions() -> int:
+    async with _db() as db:
+        cursor = await db.execute("SELECT COUNT(*) FROM fsm_sessions")
+        return (await cursor.fetchone())[0]
+
+
 # ── Напоминания ──
 
 async def get_inactive_users(days: int = 3) -> list[dict]:
-    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
+    # Сначала дописываем буфер, иначе активные пользователи попадут в рассылку
+    if _activity is not None:
+        await _activity.flush()
+    cutoff = _now() - days * DAY
+    async with _db() as db:
         cursor = await db.execute(
             """SELECT user_id, full_name, last_active_at
                FROM users
-               WHERE last_active_at < ?
-                 AND inactive_notified = 0
+               WHERE inactive_notified = 0
+                 AND last_active_at < ?
                  AND is_blocked = 0""",
             (cutoff,),
         )
@@ -316,46 +1204,135 @@ async def get_inactive_users(days: int = 3) -> list[dict]:
 async def mark_inactive_notified(user_ids: list[int]):
     if not user_ids:
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        placeholders = ",".join("?" for _ in user_ids)
+    placeholders = ",".join("?" for _ in user_ids)
+
+    async def op(db):
         await db.execute(
             f"UPDATE users SET inactive_notified = 1 WHERE user_id IN ({placeholders})",
             user_ids,
         )
-        await db.commit()
+
+    await _write(op)
+    user_cache.invalidate(*user_ids)
 
 
 # ── Статистика ──
 
+STATS_KEYS = (
+    "total_users", "paid_users", "total_referrals",
+    "total_gens", "total_tokens_in", "total_tokens_out",
+)
+MODEL_STATS_FIELDS = ("gens", "tokens_in", "tokens_out", "latency_ms")
+CANDIDATE_STATS_KEYS = (
+    "candidates_total", "candidates_used", "candidates_tokens_out", "candidates_tokens_out_used",
+)
+
 async def get_stats() -> dict:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT COUNT(*) FROM users")
-        total_users = (await cursor.fetchone())[0]
+    today_key = "gens:" + datetime.utcnow().strftime("%Y-%m-%d")
+    async with _db() as db:
+        cursor = await db.execute(
+            f"SELECT key, value FROM stats_totals WHERE key IN ({','.join('?' * (len(STATS_KEYS) + 1))})",
+            (*STATS_KEYS, today_key),
+        )
+        totals = {r["key"]: r["value"] for r in await cursor.fetchall()}
+
+    stats = {key: totals.get(key, 0) for key in STATS_KEYS}
+    stats["today_gens"] = totals.get(today_key, 0)
+    return stats
+
+
+async def _compute_stats(db: aiosqlite.Connection) -> dict[str, int]:
+    """Итоги с нуля — полным проходом по таблицам."""
+    cursor = await db.execute(
+        """SELECT COUNT(*),
+                  COALESCE(SUM(subscription != 'free'), 0),
+                  COALESCE(SUM(referred_by IS NOT NULL), 0)
+           FROM users"""
+    )
+    row = await cursor.fetchone()
+    totals = {"total_users": row[0], "paid_users": row[1], "total_referrals": row[2]}
+
+    cursor = await db.execute(
+        "SELECT COUNT(*), COALESCE(SUM(tokens_in), 0), COALESCE(SUM(tokens_out), 0) FROM generations"
+    )
+    row = await cursor.fetchone()
+    totals.update(total_gens=row[0], total_tokens_in=row[1], total_tokens_out=row[2])
+
+    cursor = await db.execute(
+        "SELECT date(created_at, 'unixepoch'), COUNT(*) FROM generations GROUP BY 1"
+    )
+    for day, count in await cursor.fetchall():
+        if day:
+            totals["gens:" + day] = count
+
+    cursor = await db.execute(
+        """SELECT model, COUNT(*), SUM(tokens_in), SUM(tokens_out), SUM(latency_ms)
+           FROM generations WHERE model IS NOT NULL GROUP BY model"""
+    )
+    for model, *values in await cursor.fetchall():
+        for field, value in zip(MODEL_STATS_FIELDS, values):
+            totals[f"model:{model}:{field}"] = value
+
+    cursor = await db.execute(
+        """SELECT COUNT(*), COALESCE(SUM(used_at IS NOT NULL), 0),
+                  COALESCE(SUM(tokens_out), 0),
+                  COALESCE(SUM(CASE WHEN used_at IS NOT NULL THEN tokens_out END), 0)
+           FROM generation_candidates"""
+    )
+    totals.update(zip(CANDIDATE_STATS_KEYS, await cursor.fetchone()))
+    return totals
+
+
+async def get_candidate_stats() -> dict[str, int]:
+    """Сколько запасных вариантов сгенерировано и показано — для подбора n."""
+    async with _db() as db:
+        cursor = await db.execute(
+            f"SELECT key, value FROM stats_totals WHERE key IN ({','.join('?' * len(CANDIDATE_STATS_KEYS))})",
+            CANDIDATE_STATS_KEYS,
+        )
+        totals = {r["key"]: r["value"] for r in await cursor.fetchall()}
+    return {key: totals.get(key, 0) for key in CANDIDATE_STATS_KEYS}
 
-        cursor = await db.execute("SELECT COUNT(*) FROM users WHERE subscription != 'free'")
-        paid_users = (await cursor.fetchone())[0]
 
-        today = datetime.utcnow().strftime("%Y-%m-%d")
-        cursor = await db.execute("SELECT COUNT(*) FROM generations WHERE created_at >= ?", (today,))
-        today_gens = (await cursor.fetchone())[0]
+async def get_model_stats() -> dict[str, dict[str, int]]:
+    """Итоги по моделям: модель → {gens, tokens_in, tokens_out, latency_ms}."""
+    async with _db() as db:
+        cursor = await db.execute(
+            "SELECT key, value FROM stats_totals WHERE key >= 'model:' AND key < 'model;'"
+        )
+        rows = await cursor.fetchall()
+    models: dict[str, dict[str, int]] = {}
+    for row in rows:
+        model, field = row["key"][len("model:"):].rsplit(":", 1)
+        models.setdefault(model, dict.fromkeys(MODEL_STATS_FIELDS, 0))[field] = row["value"]
+    return models
+
+
+async def reconcile_stats() -> dict[str, tuple[int, int]]:
+    """
+    Пересчитывает stats_totals с нуля и заменяет накопленные значения.
+    Возвращает расхождения: key → (было, стало).
+    """
+    async def op(db):
+        cursor = await db.execute("SELECT key, value FROM stats_totals")
+        old = {r["key"]: r["value"] for r in await cursor.fetchall()}
+        new = await _compute_stats(db)
+        await db.execute("DELETE FROM stats_totals")
+        await db.executemany(
+            "INSERT INTO stats_totals (key, value) VALUES (?, ?)", list(new.items())
+        )
+        return {
+            key: (old.get(key, 0), new.get(key, 0))
+            for key in old.keys() | new.keys()
+            if old.get(key, 0) != new.get(key, 0)
+        }
 
-        cursor = await db.execute("SELECT COUNT(*) FROM generations")
-        total_gens = (await cursor.fetchone())[0]
+    return await _write(op)
 
-        cursor = await db.execute("SELECT SUM(tokens_in), SUM(tokens_out) FROM generations")
-        row = await cursor.fetchone()
-        total_tokens_in = row[0] or 0
-        total_tokens_out = row[1] or 0
 
-        cursor = await db.execute("SELECT COUNT(*) FROM users WHERE referred_by IS NOT NULL")
-        total_referrals = (await cursor.fetchone())[0]
+# ── Рассылка ──
 
-    return {
-        "total_users": total_users,
-        "paid_users": paid_users,
-        "today_gens": today_gens,
-        "total_gens": total_gens,
-        "total_tokens_in": total_tokens_in,
-        "total_tokens_out": total_tokens_out,
-        "total_referrals": total_referrals,
-    }
+async def get_broadcast_user_ids() -> list[int]:
+    async with _db() as db:
+        cursor = await db.execute("SELECT user_id FROM users WHERE is_blocked = 0")
+        return [r[0] for r in await cursor.fetchall()]
@@ -0,0 +1,335 @@
+import asyncio
+import json
+import logging
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from bot.config import config
+from bot.database.db import count_fsm_sessions, load_fsm_session, purge_fsm_sessions, save_fsm_sessions
+
+try:
+    from redis.asyncio import Redis
+except ImportError:  # нужен только для FSM_STORAGE=redis
+    Redis = None
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class _Session:
+    state: str | None = None
+    data: dict[str, Any] = field(default_factory=dict)
+    touched: float = 0.0
+
+
+def _key_str(key: StorageKey) -> str:
+    """Строковый ключ сессии для SQLite и Redis: bot:chat:user[:thread][:business][:destiny]."""
+    parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+    if key.thread_id is not None:
+        parts.append(f"t{key.thread_id}")
+    if key.business_connection_id is not None:
+        parts.append(f"b{key.business_connection_id}")
+    if key.destiny != "default":
+        parts.append(key.destiny)
+    return ":".join(parts)
+
+
+class SessionStorage(BaseStorage):
+    """
+    FSM-хранилище в памяти с вытеснением. Сессия, к которой не обращались
+    ttl секунд, удаляется — пользователь начнёт с меню. Сверх maxsize
+    вытесняется давно не использованная (LRU). Пустые сессии (без состояния
+    и данных) не хранятся: MemoryStorage заводит запись на каждое чтение.
+    """
+
+    backend = "memory"
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # От давно не использованных к свежим: истёкшие всегда в начале
+        self._sessions: OrderedDict[StorageKey, _Session] = OrderedDict()
+        self.evicted = 0
+
+    def _get(self, key: StorageKey) -> _Session | None:
+        session = self._sessions.get(key)
+        if session is None:
+            return None
+        now = time.monotonic()
+        if session.touched + self.ttl < now:
+            del self._sessions[key]
+            self.evicted += 1
+            return None
+        session.touched = now
+        self._sessions.move_to_end(key)
+        return session
+
+    def _remember(self, key: StorageKey, session: _Session):
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.maxsize:
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+
+    async def _fetch(self, key: StorageKey) -> _Session | None:
+        return self._get(key)
+
+    async def _store(self, key: StorageKey, state: str | None, data: dict[str, Any]):
+        if state is None and not data:
+            self._sessions.pop(key, None)
+            return
+        self._remember(key, _Session(state, data, time.monotonic()))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        session = await self._fetch(key)
+        state = state.state if isinstance(state, State) else state
+        await self._store(key, state, session.data if session else {})
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        session = await self._fetch(key)
+        return session.state if session else None
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        session = await self._fetch(key)
+        await self._store(key, session.state if session else None, data.copy())
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        session = await self._fetch(key)
+        return session.data.copy() if session else {}
+
+    async def close(self) -> None:
+        pass
+
+    async def evict(self) -> int:
+        """Удаляет истёкшие сессии (для планировщика); возвращает их число."""
+        deadline = time.monotonic() - self.ttl
+        removed = 0
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if session.touched >= deadline:
+                break
+            del self._sessions[key]
+            removed += 1
+        self.evicted += removed
+        return removed
+
+    async def stats(self) -> dict:
+        """sessions/bytes — сессии в памяти процесса, stored — всего в хранилище."""
+        return {
+            "backend": self.backend,
+            "sessions": len(self._sessions),
+            "evicted": self.evicted,
+            "bytes": sum(_footprint(key) + _footprint(s) for key, s in self._sessions.items()),
+            "stored": len(self._sessions),
+        }
+
+
+class SQLiteStorage(SessionStorage):
+    """
+    Сессии в таблице fsm_sessions — переживают рестарт. Память служит
+    кэшем чтения: промах читается из БД, вытесненная сессия не теряется.
+    Запись отложенная: изменения копятся и раз в flush_interval секунд
+    уходят одной операцией писателя, последнее значение сессии побеждает.
+    Срок жизни в БД считается от последнего обращения: прочитанные сессии
+    отмечаются и продлеваются в БД той же операцией.
+    Подходит для одного процесса бота; для нескольких — RedisSessionStorage.
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, ttl: float, maxsize: int, flush_interval: float):
+        super().__init__(ttl, maxsize)
+        self.flush_interval = flush_interval
+        self._pending: dict[StorageKey, tuple[str | None, dict[str, Any]]] = {}
+        self._touched: set[StorageKey] = set()
+        self._flusher: asyncio.Task | None = None
+        self.loads = 0
+
+    async def _fetch(self, key: StorageKey) -> _Session | None:
+        session = self._get(key)
+        if session is None:
+            session = await self._load(key)
+        if session.state is not None or session.data:
+            self._touch(key)
+        return session
+
+    def _touch(self, key: StorageKey):
+        # Изменённую сессию flush запишет целиком — продлевать отдельно не нужно
+        if key not in self._pending:
+            self._touched.add(key)
+            self._schedule()
+
+    def _schedule(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run(), name="fsm-flush")
+
+    async def _load(self, key: StorageKey) -> _Session:
+        if key not in self._pending:
+            self.loads += 1
+            row = await load_fsm_session(_key_str(key), self.ttl)
+            # Пока шло чтение, сессию могли записать — она свежее строки из БД
+            session = self._get(key)
+            if session is not None:
+                return session
+        if key in self._pending:
+            state, data = self._pending[key]
+        else:
+            state, data = (row[0], json.loads(row[1])) if row else (None, {})
+        session = _Session(state, data, time.monotonic())
+        # Пустая тоже запоминается, иначе каждое обновление без состояния шло бы в БД
+        self._remember(key, session)
+        return session
+
+    async def _store(self, key: StorageKey, state: str | None, data: dict[str, Any]):
+        self._remember(key, _Session(state, data, time.monotonic()))
+        self._pending[key] = (state, data)
+        self._touched.discard(key)
+        self._schedule()
+
+    async def flush(self):
+        if not self._pending and not self._touched:
+            return
+        batch, self._pending = self._pending, {}
+        touched, self._touched = self._touched, set()
+        rows, deleted = [], []
+        for key, (state, data) in batch.items():
+            if state is None and not data:
+                deleted.append(_key_str(key))
+            else:
+                rows.append((_key_str(key), state, json.dumps(data, ensure_ascii=False)))
+        try:
+            await save_fsm_sessions(rows, deleted, [_key_str(key) for key in touched])
+        except Exception as e:
+            logger.error(f"FSM flush of {len(batch)} sessions failed: {e}")
+            # Возвращаем в буфер, не затирая более свежие изменения
+            for key, value in batch.items():
+                self._pending.setdefault(key, value)
+            self._touched |= {key for key in touched if key not in self._pending}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self) -> None:
+        """Останавливает таймер и дописывает остаток; вызывать до close_db()."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+    async def evict(self) -> int:
+        removed = await super().evict()
+        # Сначала продлеваем прочитанные, иначе их строки сочтутся истёкшими
+        await self.flush()
+        return removed + await purge_fsm_sessions(self.ttl)
+
+    async def stats(self) -> dict:
+        return {**await super().stats(), "stored": await count_fsm_sessions(), "pending": len(self._pending)}
+
+
+class RedisSessionStorage(BaseStorage):
+    """
+    Сессии в Redis — общие для нескольких процессов бота, поэтому без кэша
+    в памяти. Сессия — хэш {s: состояние, d: JSON данных}; состояние и данные
+    пишутся отдельными полями, без чтения перед записью. Каждое обращение
+    продлевает срок на ttl секунд, простаивающие сессии удаляет сам Redis.
+    """
+
+    backend = "redis"
+
+    def __init__(self, redis: "Redis", ttl: float, prefix: str = "fsm"):
+        self.redis = redis
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, ttl: float) -> "RedisSessionStorage":
+        if Redis is None:
+            raise RuntimeError("FSM_STORAGE=redis requires the redis package")
+        return cls(Redis.from_url(url), ttl)
+
+    def _name(self, key: StorageKey) -> str:
+        return f"{self.prefix}:{_key_str(key)}"
+
+    async def _read(self, key: StorageKey, field_name: str) -> bytes | None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hget(self._name(key), field_name)
+            pipe.expire(self._name(key), self.ttl)
+            value, _ = await pipe.execute()
+        return value
+
+    async def _write_field(self, key: StorageKey, field_name: str, value: str | None):
+        name = self._name(key)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if value is None:
+                # Хэш без полей Redis удаляет сам
+                pipe.hdel(name, field_name)
+            else:
+                pipe.hset(name, field_name, value)
+            pipe.expire(name, self.ttl)
+            await pipe.execute()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await self._write_field(key, "s", state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        value = await self._read(key, "s")
+        return value.decode() if value is not None else None
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        await self._write_field(key, "d", json.dumps(data, ensure_ascii=False) if data else None)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        value = await self._read(key, "d")
+        return json.loads(value) if value is not None else {}
+
+    async def close(self) -> None:
+        await self.redis.aclose()
+
+    async def evict(self) -> int:
+        return 0  # истёкшие ключи удаляет Redis
+
+    async def stats(self) -> dict:
+        stored = 0
+        async for _ in self.redis.scan_iter(match=f"{self.prefix}:*", count=1000):
+            stored += 1
+        return {"backend": self.backend, "sessions": 0, "evicted": 0, "bytes": 0, "stored": stored}
+
+
+def create_storage() -> BaseStorage:
+    """Хранилище FSM по FSM_STORAGE: memory, sqlite или redis."""
+    if config.fsm_storage == "memory":
+        return SessionStorage(ttl=config.fsm_session_ttl, maxsize=config.fsm_max_sessions)
+    if config.fsm_storage == "sqlite":
+        return SQLiteStorage(
+            ttl=config.fsm_session_ttl,
+            maxsize=config.fsm_max_sessions,
+            flush_interval=config.fsm_flush_interval,
+        )
+    if config.fsm_storage == "redis":
+        return RedisSessionStorage.from_url(config.redis_url, ttl=config.fsm_session_ttl)
+    raise ValueError(f"Unknown FSM_STORAGE: {config.fsm_storage!r}")
+
+
+def _footprint(obj: Any) -> int:
+    """Примерный объём объекта в памяти вместе с вложенными (sys.getsizeof)."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_footprint(k) + _footprint(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(_footprint(item) for item in obj)
+    elif isinstance(obj, _Session):
+        size += _footprint(obj.state) + _footprint(obj.data)
+    return size
@@ -0,0 +1,521 @@
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# Версия схемы хранится в PRAGMA user_version.
+# Шаги не меняются после выпуска — новые изменения схемы только новым шагом в конце.
+
+NOW_EPOCH = "(CAST(strftime('%s', 'now') AS INTEGER))"
+
+
+async def _table_exists(db: aiosqlite.Connection, table: str) -> bool:
+    cursor = await db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    )
+    return await cursor.fetchone() is not None
+
+
+async def _has_column(db: aiosqlite.Connection, table: str, column: str) -> bool:
+    cursor = await db.execute(
+        "SELECT 1 FROM pragma_table_info(?) WHERE name = ?", (table, column)
+    )
+    return await cursor.fetchone() is not None
+
+
+# ── 1. Исходная схема ──
+# Приводит к одному виду и новые БД, и старые, созданные до версионирования
+# (у них user_version = 0, но часть таблиц и колонок уже есть).
+
+async def _m1_baseline(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            subscription TEXT DEFAULT 'free',
+            sub_expires_at TEXT,
+            referral_code TEXT UNIQUE,
+            referred_by INTEGER,
+            referral_bonus_days INTEGER DEFAULT 0,
+            last_active_at TEXT DEFAULT (datetime('now')),
+            inactive_notified INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT (datetime('now')),
+            is_blocked INTEGER DEFAULT 0
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS generations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            marketplace TEXT,
+            category TEXT,
+            product_name TEXT,
+            result_text TEXT,
+            tokens_in INTEGER DEFAULT 0,
+            tokens_out INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT (datetime('now')),
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+
+    # Колонки, добавленные в ранних версиях бота
+    for table, column, column_type in (
+        ("users", "referral_code", "TEXT"),
+        ("users", "referred_by", "INTEGER"),
+        ("users", "referral_bonus_days", "INTEGER DEFAULT 0"),
+        ("users", "last_active_at", "TEXT"),
+        ("users", "inactive_notified", "INTEGER DEFAULT 0"),
+        ("generations", "result_text", "TEXT"),
+    ):
+        if not await _has_column(db, table, column):
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    if not await _has_column(db, "generations", "has_result"):
+        await db.execute("ALTER TABLE generations ADD COLUMN has_result INTEGER NOT NULL DEFAULT 0")
+        await db.execute(
+            "UPDATE generations SET has_result = 1 WHERE result_text IS NOT NULL AND result_text != ''"
+        )
+
+    if not await _table_exists(db, "usage_counters"):
+        await db.execute("""
+            CREATE TABLE usage_counters (
+                user_id INTEGER NOT NULL,
+                period TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, period)
+            ) WITHOUT ROWID
+        """)
+        now = datetime.utcnow()
+        for period, since in (
+            ("d:" + now.strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d")),
+            ("m:" + now.strftime("%Y-%m"), now.replace(day=1).strftime("%Y-%m-%d")),
+        ):
+            await db.execute(
+                """INSERT INTO usage_counters (user_id, period, count)
+                   SELECT user_id, ?, COUNT(*) FROM generations
+                   WHERE created_at >= ? GROUP BY user_id""",
+                (period, since),
+            )
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS generation_bodies (
+            generation_id INTEGER PRIMARY KEY,
+            dict_id INTEGER NOT NULL DEFAULT 0,
+            body BLOB NOT NULL
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS compression_dicts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            data BLOB NOT NULL,
+            created_at TEXT DEFAULT (datetime('now'))
+        )
+    """)
+
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_gen_user_date ON generations(user_id, created_at)"
+    )
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_gen_history
+        ON generations(user_id, created_at DESC, id DESC, marketplace, product_name, has_result)
+        WHERE has_result = 1
+    """)
+
+    # stats_totals заполняется с нуля в шаге 2, после перевода дат в epoch
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+
+
+# ── 2. Время — целые секунды Unix epoch ──
+# Вместо TEXT вперемешку 'YYYY-MM-DD HH:MM:SS' и isoformat() с 'T'.
+# SQLite не меняет тип колонки через ALTER, поэтому таблицы пересоздаются.
+
+async def _m2_epoch_timestamps(db: aiosqlite.Connection):
+    def epoch(column: str) -> str:
+        return f"CAST(strftime('%s', {column}) AS INTEGER)"
+
+    await db.execute(f"""
+        CREATE TABLE users_new (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            subscription TEXT NOT NULL DEFAULT 'free',
+            sub_expires_at INTEGER,
+            referral_code TEXT UNIQUE,
+            referred_by INTEGER,
+            referral_bonus_days INTEGER NOT NULL DEFAULT 0,
+            last_active_at INTEGER NOT NULL DEFAULT {NOW_EPOCH},
+            inactive_notified INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL DEFAULT {NOW_EPOCH},
+            is_blocked INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    await db.execute(f"""
+        INSERT INTO users_new
+            (user_id, username, full_name, subscription, sub_expires_at, referral_code,
+             referred_by, referral_bonus_days, last_active_at, inactive_notified,
+             created_at, is_blocked)
+        SELECT user_id, username, full_name, COALESCE(subscription, 'free'),
+               {epoch('sub_expires_at')}, referral_code, referred_by,
+               COALESCE(referral_bonus_days, 0),
+               COALESCE({epoch('last_active_at')}, {epoch('created_at')}, {NOW_EPOCH}),
+               COALESCE(inactive_notified, 0),
+               COALESCE({epoch('created_at')}, {NOW_EPOCH}),
+               COALESCE(is_blocked, 0)
+        FROM users
+    """)
+    await db.execute("DROP TABLE users")
+    await db.execute("ALTER TABLE users_new RENAME TO users")
+
+    await db.execute(f"""
+        CREATE TABLE generations_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            marketplace TEXT,
+            category TEXT,
+            product_name TEXT,
+            result_text TEXT,
+            has_result INTEGER NOT NULL DEFAULT 0,
+            tokens_in INTEGER NOT NULL DEFAULT 0,
+            tokens_out INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL DEFAULT {NOW_EPOCH},
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+    await db.execute(f"""
+        INSERT INTO generations_new
+            (id, user_id, marketplace, category, product_name, result_text,
+             has_result, tokens_in, tokens_out, created_at)
+        SELECT id, user_id, marketplace, category, product_name, result_text,
+               has_result, COALESCE(tokens_in, 0), COALESCE(tokens_out, 0),
+               COALESCE({epoch('created_at')}, 0)
+        FROM generations
+    """)
+    await db.execute("DROP TABLE generations")
+    await db.execute("ALTER TABLE generations_new RENAME TO generations")
+
+    await db.execute("CREATE INDEX idx_gen_user_date ON generations(user_id, created_at)")
+    await db.execute("""
+        CREATE INDEX idx_gen_history
+        ON generations(user_id, created_at DESC, id DESC, marketplace, product_name, has_result)
+        WHERE has_result = 1
+    """)
+    await db.execute("CREATE INDEX idx_users_referred_by ON users(referred_by) WHERE referred_by IS NOT NULL")
+    await db.execute("CREATE INDEX idx_users_inactive ON users(inactive_notified, last_active_at)")
+    await db.execute(
+        "CREATE INDEX idx_users_sub_expires ON users(sub_expires_at) WHERE sub_expires_at IS NOT NULL"
+    )
+
+    # Итоги для /admin поддерживаются триггерами при каждой записи
+    await db.execute("""
+        CREATE TRIGGER trg_stats_gen_insert AFTER INSERT ON generations
+        BEGIN
+            INSERT INTO stats_totals (key, value) VALUES
+                ('total_gens', 1),
+                ('total_tokens_in', NEW.tokens_in),
+                ('total_tokens_out', NEW.tokens_out),
+                ('gens:' || date(NEW.created_at, 'unixepoch'), 1)
+            ON CONFLICT(key) DO UPDATE SET value = value + excluded.value;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER trg_stats_user_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO stats_totals (key, value) VALUES
+                ('total_users', 1),
+                ('paid_users', NEW.subscription != 'free'),
+                ('total_referrals', NEW.referred_by IS NOT NULL)
+            ON CONFLICT(key) DO UPDATE SET value = value + excluded.value;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER trg_stats_user_plan AFTER UPDATE OF subscription ON users
+        BEGIN
+            INSERT INTO stats_totals (key, value) VALUES
+                ('paid_users', (NEW.subscription != 'free') - (OLD.subscription != 'free'))
+            ON CONFLICT(key) DO UPDATE SET value = value + excluded.value;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER trg_stats_user_ref AFTER UPDATE OF referred_by ON users
+        BEGIN
+            INSERT INTO stats_totals (key, value) VALUES
+                ('total_referrals', (NEW.referred_by IS NOT NULL) - (OLD.referred_by IS NOT NULL))
+            ON CONFLICT(key) DO UPDATE SET value = value + excluded.value;
+        END
+    """)
+
+    await db.execute("DELETE FROM stats_totals")
+    await db.execute("""
+        INSERT INTO stats_totals (key, value)
+        SELECT 'total_users', COUNT(*) FROM users
+        UNION ALL SELECT 'paid_users', COUNT(*) FROM users WHERE subscription != 'free'
+        UNION ALL SELECT 'total_referrals', COUNT(*) FROM users WHERE referred_by IS NOT NULL
+        UNION ALL SELECT 'total_gens', COUNT(*) FROM generations
+        UNION ALL SELECT 'total_tokens_in', COALESCE(SUM(tokens_in), 0) FROM generations
+        UNION ALL SELECT 'total_tokens_out', COALESCE(SUM(tokens_out), 0) FROM generations
+        UNION ALL SELECT 'gens:' || date(created_at, 'unixepoch'), COUNT(*)
+                  FROM generations GROUP BY date(created_at, 'unixepoch')
+    """)
+
+
+# ── 3. Кэш ответов модели ──
+# Ключ — хэш нормализованного запроса. Тексты сжаты тем же словарём, что и карточки.
+
+async def _m3_response_cache(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE response_cache (
+            key TEXT PRIMARY KEY,
+            dict_id INTEGER NOT NULL DEFAULT 0,
+            body BLOB NOT NULL,
+            tokens_in INTEGER NOT NULL DEFAULT 0,
+            tokens_out INTEGER NOT NULL DEFAULT 0,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            last_hit_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    await db.execute("CREATE INDEX idx_response_cache_created ON response_cache(created_at)")
+    await db.execute("CREATE INDEX idx_response_cache_last_hit ON response_cache(last_hit_at)")
+
+
+# ── 4. Модель и задержка у каждой генерации ──
+# Итоги по моделям — в stats_totals под ключами model:<модель>:<поле>.
+
+async def _m4_generation_model(db: aiosqlite.Connection):
+    await db.execute("ALTER TABLE generations ADD COLUMN model TEXT")
+    await db.execute("ALTER TABLE generations ADD COLUMN latency_ms INTEGER NOT NULL DEFAULT 0")
+
+    await db.execute("DROP TRIGGER trg_stats_gen_insert")
+    await db.execute("""
+        CREATE TRIGGER trg_stats_gen_insert AFTER INSERT ON generations
+        BEGIN
+            INSERT INTO stats_totals (key, value) VALUES
+                ('total_gens', 1),
+                ('total_tokens_in', NEW.tokens_in),
+                ('total_tokens_out', NEW.tokens_out),
+                ('gens:' || date(NEW.created_at, 'unixepoch'), 1)
+            ON CONFLICT(key) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO stats_totals (key, value)
+                SELECT 'model:' || NEW.model || ':' || column1, column2 FROM (VALUES
+                    ('gens', 1),
+                    ('tokens_in', NEW.tokens_in),
+                    ('tokens_out', NEW.tokens_out),
+                    ('latency_ms', NEW.latency_ms))
+                WHERE NEW.model IS NOT NULL
+            ON CONFLICT(key) DO UPDATE SET value = value + excluded.value;
+        END
+    """)
+
+
+# ── 5. Запасные варианты карточки ──
+# Модель возвращает n вариантов за один запрос; первый показывается сразу,
+# остальные ждут «Другой вариант». used_at — когда вариант показан.
+
+async def _m5_generation_candidates(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE generation_candidates (
+            generation_id INTEGER NOT NULL REFERENCES generations(id),
+            idx INTEGER NOT NULL,
+            dict_id INTEGER NOT NULL DEFAULT 0,
+            body BLOB NOT NULL,
+            tokens_out INTEGER NOT NULL DEFAULT 0,
+            used_at INTEGER,
+            PRIMARY KEY (generation_id, idx)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        CREATE TRIGGER trg_stats_candidate_insert AFTER INSERT ON generation_candidates
+        BEGIN
+            INSERT INTO stats_totals (key, value) VALUES
+                ('candidates_total', 1),
+                ('candidates_tokens_out', NEW.tokens_out)
+            ON CONFLICT(key) DO UPDATE SET value = value + excluded.value;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER trg_stats_candidate_used AFTER UPDATE OF used_at ON generation_candidates
+        WHEN OLD.used_at IS NULL AND NEW.used_at IS NOT NULL
+        BEGIN
+            INSERT INTO stats_totals (key, value) VALUES
+                ('candidates_used', 1),
+                ('candidates_tokens_out_used', NEW.tokens_out)
+            ON CONFLICT(key) DO UPDATE SET value = value + excluded.value;
+        END
+    """)
+
+
+# ── 6. Формат тела генерации ──
+
+async def _m6_body_format(db: aiosqlite.Connection):
+    # 0 — свободный текст, 1 — структурированная карточка (JSON)
+    await db.execute("ALTER TABLE generation_bodies ADD COLUMN format INTEGER NOT NULL DEFAULT 0")
+
+
+# ── 7. Массовая генерация из файла ──
+
+async def _m7_bulk_jobs(db: aiosqlite.Connection):
+    # next_row — все строки до него обработаны; после него готовые лежат в bulk_rows
+    await db.execute("""
+        CREATE TABLE bulk_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER,
+            marketplace TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            source TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            next_row INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX idx_bulk_jobs_status ON bulk_jobs(status, user_id)")
+    await db.execute("""
+        CREATE TABLE bulk_rows (
+            job_id INTEGER NOT NULL REFERENCES bulk_jobs(id),
+            row_no INTEGER NOT NULL,
+            generation_id INTEGER REFERENCES generations(id),
+            error TEXT,
+            PRIMARY KEY (job_id, row_no)
+        ) WITHOUT ROWID
+    """)
+
+
+# ── 8. Очередь заданий генерации ──
+# Задание видно воркерам, когда visible_at <= now. Взятое задание скрывается
+# на время таймаута видимости; не продлённое (воркер упал) — снова доступно.
+
+async def _m8_jobs(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            visible_at INTEGER NOT NULL,
+            message_id INTEGER,
+            generation_id INTEGER REFERENCES generations(id),
+            error TEXT,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+    await db.execute("CREATE INDEX idx_jobs_ready ON jobs(status, visible_at)")
+
+
+async def _m9_active_jobs(db: aiosqlite.Connection):
+    # Поиск незавершённого задания пользователя при повторном нажатии;
+    # частичный индекс — готовые задания в него не попадают
+    await db.execute("""
+        CREATE INDEX idx_jobs_active ON jobs(user_id, kind)
+        WHERE status IN ('queued', 'running')
+    """)
+
+
+async def _m10_job_generation(db: aiosqlite.Connection):
+    # Параметры исходного задания для «Другой вариант»: в состоянии FSM
+    # хранится только id генерации
+    await db.execute("""
+        CREATE INDEX idx_jobs_generation ON jobs(generation_id)
+        WHERE generation_id IS NOT NULL
+    """)
+
+
+async def _m11_fsm_sessions(db: aiosqlite.Connection):
+    # Состояния диалогов (aiogram FSM): key — bot:chat:user, data — JSON
+    await db.execute("""
+        CREATE TABLE fsm_sessions (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    await db.execute("CREATE INDEX idx_fsm_sessions_updated ON fsm_sessions(updated_at)")
+
+
+async def _m12_job_score(db: aiosqlite.Connection):
+    # Порядок выдачи заданий: время постановки + ступень тарифа * старение
+    await db.execute("ALTER TABLE jobs ADD COLUMN score REAL NOT NULL DEFAULT 0")
+    await db.execute("UPDATE jobs SET score = created_at")
+
+
+async def _m13_generation_details(db: aiosqlite.Connection):
+    # Ответы на вопросы при генерации карточки — для «Другой вариант»;
+    # payload заданий удаляется через JOB_RETENTION, генерация остаётся
+    await db.execute("ALTER TABLE generations ADD COLUMN details TEXT")
+    await db.execute("""
+        UPDATE generations SET details = (
+            SELECT json_extract(j.payload, '$.details') FROM jobs j
+            WHERE j.generation_id = generations.id AND j.kind IN ('card', 'regenerate')
+        )
+        WHERE id IN (SELECT generation_id FROM jobs WHERE kind IN ('card', 'regenerate'))
+    """)
+
+
+async def _m14_usage_reserved(db: aiosqlite.Connection):
+    # Резервы генераций в счётчике — общие для всех процессов бота;
+    # reserved_at — последний резерв строки, по нему сбрасываются
+    # резервы, брошенные упавшим процессом
+    await db.execute("ALTER TABLE usage_counters ADD COLUMN reserved INTEGER NOT NULL DEFAULT 0")
+    await db.execute("ALTER TABLE usage_counters ADD COLUMN reserved_at INTEGER")
+    await db.execute("""
+        CREATE INDEX idx_usage_counters_reserved ON usage_counters(reserved_at)
+        WHERE reserved > 0
+    """)
+
+
+MIGRATIONS: list[Callable[[aiosqlite.Connection], Awaitable[None]]] = [
+    _m1_baseline,
+    _m2_epoch_timestamps,
+    _m3_response_cache,
+    _m4_generation_model,
+    _m5_generation_candidates,
+    _m6_body_format,
+    _m7_bulk_jobs,
+    _m8_jobs,
+    _m9_active_jobs,
+    _m10_job_generation,
+    _m11_fsm_sessions,
+    _m12_job_score,
+    _m13_generation_details,
+    _m14_usage_reserved,
+]
+
+
+async def run_migrations(db: aiosqlite.Connection) -> int:
+    """
+    Применяет только недостающие шаги, каждый в своей транзакции вместе
+    с записью новой user_version. db — соединение с isolation_level=None.
+    Возвращает итоговую версию схемы.
+    """
+    cursor = await db.execute("PRAGMA user_version")
+    version = (await cursor.fetchone())[0]
+    if version > len(MIGRATIONS):
+        raise RuntimeError(f"Database schema v{version} is newer than this bot (v{len(MIGRATIONS)})")
+
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            await step(db)
+            await db.execute(f"PRAGMA user_version = {number}")
+            await db.execute("COMMIT")
+        except Exception:
+            await db.execute("ROLLBACK")
+            raise
+        logger.info(f"Migration {number} applied: {step.__name__}")
+    return len(MIGRATIONS)
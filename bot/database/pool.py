@@ -0,0 +1,75 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """
+    Пул постоянных соединений с SQLite.
+    Открывается один раз в init_db() и закрывается при остановке бота —
+    вместо aiosqlite.connect() на каждый запрос.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size: int = 4,
+        mmap_size: int = 64 * 1024 * 1024,
+        cache_size_kb: int = 8192,
+        busy_timeout_ms: int = 5000,
+        statement_cache: int = 256,
+    ):
+        self.path = path
+        self.size = size
+        self.mmap_size = mmap_size
+        self.cache_size_kb = cache_size_kb
+        self.busy_timeout_ms = busy_timeout_ms
+        self.statement_cache = statement_cache
+        self._idle: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._conns: list[aiosqlite.Connection] = []
+
+    async def connect(self, **kwargs) -> aiosqlite.Connection:
+        """Новое соединение с настроенными PRAGMA (используется и вне пула)."""
+        # cached_statements — кэш подготовленных выражений sqlite3,
+        # работает только пока соединение живёт
+        conn = await aiosqlite.connect(
+            self.path, cached_statements=self.statement_cache, **kwargs
+        )
+        conn.row_factory = aiosqlite.Row
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        await conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+        await conn.execute("PRAGMA temp_store=MEMORY")
+        await conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        return conn
+
+    async def open(self):
+        for _ in range(self.size):
+            conn = await self.connect()
+            self._conns.append(conn)
+            self._idle.put_nowait(conn)
+        logger.info(f"DB pool opened: {self.size} connections to {self.path}")
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            # Незакоммиченное после ошибки не должно утечь к следующему вызову
+            if conn.in_transaction:
+                await conn.rollback()
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._conns:
+            await conn.close()
+        self._conns.clear()
+        self._idle = asyncio.Queue()
+        logger.info("DB pool closed")
@@ -0,0 +1,37 @@
+from bot.database.db import log_generation, release_generation, reserve_generation
+
+
+class QuotaReservation:
+    """
+    Зарезервированная генерация. Резерв хранится в usage_counters.reserved
+    и учитывается при проверке лимита во всех процессах бота.
+    commit() записывает генерацию, release() возвращает резерв;
+    после commit() release() ничего не делает — его можно звать в finally.
+    """
+
+    def __init__(self, user_id: int, allowed: bool, used: int, limit: int, period: str):
+        self.user_id = user_id
+        self.allowed = allowed
+        self.used = used
+        self.limit = limit
+        self.period = period
+        self._active = allowed
+
+    async def commit(self, **generation) -> int:
+        """Записывает генерацию (аргументы log_generation) и в той же транзакции снимает резерв."""
+        if not self._active:
+            raise RuntimeError("Reservation is not active")
+        gen_id = await log_generation(user_id=self.user_id, reserved_period=self.period, **generation)
+        self._active = False
+        return gen_id
+
+    async def release(self):
+        if self._active:
+            self._active = False
+            await release_generation(self.user_id, self.period)
+
+
+async def reserve_quota(user_id: int) -> QuotaReservation:
+    """Проверяет лимит с учётом уже выданных резервов и занимает одну генерацию."""
+    allowed, used, limit, period = await reserve_generation(user_id)
+    return QuotaReservation(user_id, allowed, used, limit, period)
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, TypeVar
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+WriteOp = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+
+class DBWriter:
+    """
+    Единственный писатель в SQLite.
+    Операции из очереди группируются в одну транзакцию (group commit):
+    один fsync и одна блокировка WAL на пачку вместо одной на каждый вызов.
+    Каждая операция выполняется в своём SAVEPOINT, так что ошибка одной
+    не откатывает остальные в пачке.
+
+    connect() должен вернуть соединение с isolation_level=None:
+    транзакциями писатель управляет сам.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Awaitable[aiosqlite.Connection]],
+        max_batch: int = 64,
+        max_wait_ms: float = 0.0,
+    ):
+        self._connect = connect
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._conn: aiosqlite.Connection | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        self._conn = await self._connect()
+        self._task = asyncio.create_task(self._run(), name="db-writer")
+
+    async def stop(self):
+        """Дописывает всё, что уже в очереди, и закрывает соединение."""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+        await self._conn.close()
+        self._conn = None
+
+    async def submit(self, op: Callable[[aiosqlite.Connection], Awaitable[T]]) -> T:
+        """Ставит операцию в очередь и ждёт коммита её пачки. Операция не должна делать commit."""
+        if self._task is None:
+            raise RuntimeError("DB writer is not running")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit_batch(batch)
+
+    async def _commit_batch(self, batch: list):
+        conn = self._conn
+        results = []
+        try:
+            await conn.execute("BEGIN IMMEDIATE")
+            for op, future in batch:
+                if future.cancelled():
+                    continue
+                await conn.execute("SAVEPOINT op")
+                try:
+                    result = await op(conn)
+                except Exception as e:
+                    await conn.execute("ROLLBACK TO op")
+                    await conn.execute("RELEASE op")
+                    results.append((future, None, e))
+                else:
+                    await conn.execute("RELEASE op")
+                    results.append((future, result, None))
+            await conn.execute("COMMIT")
+        except Exception as e:
+            logger.error(f"DB write batch of {len(batch)} failed: {e}")
+            if conn.in_transaction:
+                await conn.rollback()
+            results = [(future, None, e) for _, future in batch]
+
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
@@ -1,8 +1,19 @@
 import logging
+from datetime import datetime
 from aiogram import Router
 from aiogram.filters import Command
 from aiogram.types import Message
-from bot.database.db import set_subscription, get_stats, get_user
+from aiogram.fsm.context import FSMContext
+from bot.database.db import (
+    set_subscription, get_stats, get_user, get_broadcast_user_ids, reconcile_stats,
+    get_model_stats, get_candidate_stats, user_cache,
+)
+from bot.services.ai_service import client as llm_client
+from bot.services.llm_scheduler import llm_scheduler
+from bot.services.response_cache import response_cache
+from bot.services.bulk import bulk_runner
+from bot.services.jobs import job_queue
+from bot.services.restyle import restyle_prefetcher
 from bot.config import config
 
 logger = logging.getLogger(__name__)
@@ -14,7 +25,7 @@ def is_admin(uid: int) -> bool:
 
 
 @router.message(Command("admin"))
-async def cmd_admin(message: Message):
+async def cmd_admin(message: Message, state: FSMContext):
     if not is_admin(message.from_user.id):
         return
     s = await get_stats()
@@ -22,6 +33,17 @@ async def cmd_admin(message: Message):
     cost_in = s["total_tokens_in"] / 1_000_000 * 65
     cost_out = s["total_tokens_out"] / 1_000_000 * 516
     total_cost = cost_in + cost_out
+    uc = user_cache.stats()
+    rc = response_cache.stats()
+    q = llm_scheduler.stats()
+    wait_p95 = " · ".join(f"{plan} {w['p95']:.1f}с" for plan, w in q["wait"].items())
+    lc = llm_client.stats()
+    rs = restyle_prefetcher.stats()
+    bs = bulk_runner.stats()
+    js = await job_queue.stats()
+    fs = await state.storage.stats()
+    cs = await get_candidate_stats()
+    endpoints = " · ".join(f"{name}: {e['state']}" for name, e in lc["endpoints"].items())
 
     text = (
         "📊 <b>Панель администратора</b>\n\n"
@@ -31,14 +53,69 @@ async def cmd_admin(message: Message):
         f"📝 Генераций сегодня: <b>{s['today_gens']}</b>\n"
         f"📝 Генераций всего: <b>{s['total_gens']}</b>\n\n"
         f"🔤 Токены: {s['total_tokens_in']:,} → {s['total_tokens_out']:,}\n"
-        f"💰 Расход API: ≈ <b>{total_cost:.0f} ₽</b>\n\n"
+        f"💰 Расход API: ≈ <b>{total_cost:.0f} ₽</b>\n"
+        f"🗂 Кэш профилей: {uc['hit_ratio']:.0%} попаданий "
+        f"({uc['hits']}/{uc['hits'] + uc['misses']}, записей {uc['size']})\n"
+        f"♻️ Кэш карточек: {rc['hit_ratio']:.0%} попаданий "
+        f"(память {rc['memory_hits']}, БД {rc['db_hits']}, промахов {rc['misses']}), "
+        f"сэкономлено {rc['tokens_saved']:,} токенов\n"
+        f"🚦 Очередь к модели: {q['active']}/{q['concurrency']} в работе, "
+        f"{q['waiting']} ждут, отклонено {q['shed']}\n"
+        f"⏱ Ожидание p95: {wait_p95}\n"
+        f"🔌 API: {endpoints}; повторов {lc['retries']}, "
+        f"хедж-запросов {lc['hedges']} (выиграли {lc['hedge_wins']})\n"
+        f"✨ Стили: предзагружено {rs['started']}, показано {rs['served']}\n"
+        f"🔄 Запасные варианты: показано {cs['candidates_used']} из {cs['candidates_total']} "
+        f"(токенов {cs['candidates_tokens_out_used']:,} из {cs['candidates_tokens_out']:,})\n"
+        f"📦 Каталоги: в работе {bs['running']}, строк готово {bs['rows_done']}\n"
+        f"🧵 Задания: ждут {js['queued']}, в работе {js['running']}/{js['workers']}, "
+        f"готово {js['done']}, ошибок {js['failed']}, повторов {js['retried']}, "
+        f"повторных нажатий {js['coalesced']}, отклонено {js['shed']}\n"
+        f"🧠 Сессии FSM ({fs['backend']}): всего {fs['stored']}, в памяти {fs['sessions']} "
+        f"(≈ {fs['bytes'] / 1024:.0f} КБ), вытеснено {fs['evicted']}\n\n"
         f"/activate <code>user_id plan</code>\n"
         f"/userinfo <code>user_id</code>\n"
-        f"/broadcast <code>текст</code>"
+        f"/broadcast <code>текст</code>\n"
+        f"/models — расход и задержка по моделям\n"
+        f"/reconcile — пересчитать статистику"
     )
     await message.answer(text, parse_mode="HTML")
 
 
+@router.message(Command("reconcile"))
+async def cmd_reconcile(message: Message):
+    """Пересчёт итогов статистики с нуля и сверка с накопленными."""
+    if not is_admin(message.from_user.id):
+        return
+    diff = await reconcile_stats()
+    if not diff:
+        await message.answer("✅ Статистика сходится")
+        return
+    lines = [f"{key}: {old} → {new}" for key, (old, new) in sorted(diff.items())]
+    await message.answer("⚠️ <b>Исправлены расхождения:</b>\n" + "\n".join(lines), parse_mode="HTML")
+
+
+@router.message(Command("models"))
+async def cmd_models(message: Message):
+    """Генерации, токены и средняя задержка по моделям."""
+    if not is_admin(message.from_user.id):
+        return
+    models = await get_model_stats()
+    if not models:
+        await message.answer("Пока нет генераций с записанной моделью")
+        return
+    lines = []
+    for model, m in sorted(models.items(), key=lambda item: -item[1]["gens"]):
+        gens = m["gens"] or 1
+        lines.append(
+            f"<b>{model}</b>: {m['gens']} ген., "
+            f"токены {m['tokens_in']:,} → {m['tokens_out']:,} "
+            f"(≈{m['tokens_out'] // gens} на ответ), "
+            f"задержка ≈{m['latency_ms'] / gens / 1000:.1f} с"
+        )
+    await message.answer("🤖 <b>Модели</b>\n\n" + "\n".join(lines), parse_mode="HTML")
+
+
 @router.message(Command("activate"))
 async def cmd_activate(message: Message):
     if not is_admin(message.from_user.id):
@@ -98,17 +175,20 @@ async def cmd_userinfo(message: Message):
     if not user:
         await message.answer("⚠️ Не найден")
         return
+    def fmt(ts: int | None) -> str:
+        return datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M") if ts else "—"
+
     text = (
         f"👤 ID: <code>{user['user_id']}</code>\n"
         f"Username: @{user['username'] or '—'}\n"
         f"Имя: {user['full_name'] or '—'}\n"
         f"Тариф: {user['subscription']}\n"
-        f"До: {user['sub_expires_at'] or '—'}\n"
+        f"До: {fmt(user['sub_expires_at'])}\n"
         f"Реф.код: <code>{user.get('referral_code', '—')}</code>\n"
         f"Приглашён: {user.get('referred_by') or '—'}\n"
         f"Бонусов: {user.get('referral_bonus_days', 0)} дней\n"
-        f"Рег.: {user['created_at']}\n"
-        f"Активен: {user.get('last_active_at', '—')}"
+        f"Рег.: {fmt(user['created_at'])}\n"
+        f"Активен: {fmt(user.get('last_active_at'))}"
     )
     await message.answer(text, parse_mode="HTML")
 
@@ -123,14 +203,10 @@ async def cmd_broadcast(message: Message):
         return
 
     from bot.main import bot
-    import aiosqlite
     sent = failed = 0
-    async with aiosqlite.connect(config.db_path) as db:
-        cursor = await db.execute("SELECT user_id FROM users WHERE is_blocked = 0")
-        rows = await cursor.fetchall()
-    for row in rows:
+    for uid in await get_broadcast_user_ids():
         try:
-            await bot.send_message(row[0], text, parse_mode="HTML")
+            await bot.send_message(uid, text, parse_mode="HTML")
             sent += 1
         except Exception:
             failed += 1
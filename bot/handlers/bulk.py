@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+from aiogram import Router, F
+from aiogram.types import Message, CallbackQuery
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from bot.config import config
+from bot.database.db import create_bulk_job, get_bulk_job, get_running_bulk_jobs, update_bulk_job
+from bot.services.bulk import XLSX_AVAILABLE, BulkFileError, bulk_runner, inspect_file
+from bot.keyboards.inline import marketplace_kb, back_kb, bulk_cancel_kb
+
+logger = logging.getLogger(__name__)
+router = Router()
+
+# Telegram Bot API отдаёт ботам файлы до 20 МБ
+MAX_FILE_SIZE = 20 * 1024 * 1024
+
+
+class BulkStates(StatesGroup):
+    choosing_marketplace = State()
+    waiting_file = State()
+
+
+@router.callback_query(F.data == "bulk")
+async def cb_bulk(callback: CallbackQuery, state: FSMContext, user_ctx: dict):
+    if not user_ctx["allowed"]:
+        await callback.answer("⚠️ Лимит исчерпан", show_alert=True)
+        return
+    if await get_running_bulk_jobs(callback.from_user.id):
+        await callback.answer("⏳ Предыдущий каталог ещё обрабатывается", show_alert=True)
+        return
+    await state.clear()
+    await state.set_state(BulkStates.choosing_marketplace)
+    await callback.message.edit_text(
+        "📦 <b>Каталог из файла</b>\n\n"
+        "Для какого маркетплейса карточки, если в файле он не указан?",
+        reply_markup=marketplace_kb(), parse_mode="HTML",
+    )
+    await callback.answer()
+
+
+@router.callback_query(BulkStates.choosing_marketplace, F.data.startswith("mp_"))
+async def cb_bulk_mp(callback: CallbackQuery, state: FSMContext, user_ctx: dict):
+    mp = "Wildberries" if callback.data == "mp_wb" else "Ozon"
+    await state.update_data(marketplace=mp)
+    await state.set_state(BulkStates.waiting_file)
+    formats = "CSV или XLSX" if XLSX_AVAILABLE else "CSV"
+    await callback.message.edit_text(
+        f"📦 <b>Каталог из файла</b> · {mp}\n\n"
+        f"Пришлите файл {formats} документом. Первая строка — заголовки столбцов:\n"
+        f"• <b>Товар</b> — название (обязательно)\n"
+        f"• <b>Детали</b> — материал, размеры, особенности\n"
+        f"• <b>Маркетплейс</b> — WB или Ozon, если нужен не {mp}\n\n"
+        f"До {config.bulk_max_rows} строк. Каждая строка — одна генерация, "
+        f"доступно ещё: {max(user_ctx['limit'] - user_ctx['used'], 0)}.\n"
+        f"Результат придёт файлом того же формата.",
+        reply_markup=back_kb(), parse_mode="HTML",
+    )
+    await callback.answer()
+
+
+@router.message(BulkStates.waiting_file, F.document)
+async def msg_bulk_file(message: Message, state: FSMContext):
+    document = message.document
+    ext = os.path.splitext(document.file_name or "")[1].lower()
+    if ext not in (".csv", ".xlsx") or (ext == ".xlsx" and not XLSX_AVAILABLE):
+        await message.answer("⚠️ Нужен файл " + ("CSV или XLSX." if XLSX_AVAILABLE else "CSV."))
+        return
+    if document.file_size and document.file_size > MAX_FILE_SIZE:
+        await message.answer("⚠️ Файл больше 20 МБ — разбейте его на части.")
+        return
+
+    os.makedirs(config.bulk_dir, exist_ok=True)
+    path = os.path.join(config.bulk_dir, f"{message.from_user.id}-{document.file_unique_id}{ext}")
+    try:
+        await message.bot.download(document, destination=path)
+        total = await asyncio.to_thread(inspect_file, path, config.bulk_max_rows)
+    except BulkFileError as e:
+        os.remove(path)
+        await message.answer(f"⚠️ {e}")
+        return
+    except Exception as e:
+        logger.error(f"Bulk file from {message.from_user.id} rejected: {e}")
+        if os.path.exists(path):
+            os.remove(path)
+        await message.answer("⚠️ Не удалось прочитать файл. Проверьте формат и попробуйте ещё раз.")
+        return
+
+    data = await state.get_data()
+    await state.clear()
+    job_id = await create_bulk_job(
+        message.from_user.id, message.chat.id, data.get("marketplace", "Wildberries"),
+        document.file_name, path, total,
+    )
+    progress = await message.answer(
+        f"📦 <b>Каталог: {document.file_name}</b>\n\n"
+        f"Строк: {total}. Начинаю генерацию...",
+        reply_markup=bulk_cancel_kb(job_id), parse_mode="HTML",
+    )
+    await update_bulk_job(job_id, message_id=progress.message_id)
+    await bulk_runner.start_job(message.bot, job_id)
+
+
+@router.message(BulkStates.waiting_file)
+async def msg_bulk_not_file(message: Message):
+    await message.answer("📎 Пришлите таблицу файлом (скрепка → Файл).", reply_markup=back_kb())
+
+
+@router.callback_query(F.data.startswith("bulk_cancel:"))
+async def cb_bulk_cancel(callback: CallbackQuery):
+    job_id = int(callback.data.split(":", 1)[1])
+    job = await get_bulk_job(job_id)
+    if not job or job["user_id"] != callback.from_user.id:
+        await callback.answer("⚠️ Задание не найдено", show_alert=True)
+        return
+    if bulk_runner.cancel(job_id):
+        await callback.answer("⏹ Останавливаю — готовые карточки пришлю файлом")
+    else:
+        await callback.answer("Задание уже завершено")
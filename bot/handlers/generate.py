@@ -1,10 +1,20 @@
+import asyncio
 import logging
+from typing import Awaitable, Callable
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from bot.database.db import check_limit, log_generation, get_active_subscription, touch_active
-from bot.services.ai_service import generate_card, analyze_competitor, rewrite_card, generate_questions
+from bot.database.db import get_generation_by_id, get_generation_source, pop_candidate, touch_active
+from bot.database.quota import reserve_quota
+from bot.services.ai_service import (
+    CANDIDATE_MODEL, Completion, generate_card, analyze_competitor, rewrite_card, generate_questions,
+    get_cached_questions, regenerate_field,
+)
+from bot.services.card_format import FORMAT_CARD, plain_text, render_text
+from bot.services.jobs import Job, job_queue
+from bot.services.llm_scheduler import LLMOverloaded
+from bot.services.restyle import restyle_prefetcher
 from bot.keyboards.inline import (
     marketplace_kb, after_generation_kb, restyle_kb,
     main_menu, back_kb, skip_kb, STYLE_MAP,
@@ -13,6 +23,16 @@ from bot.keyboards.inline import (
 logger = logging.getLogger(__name__)
 router = Router()
 
+OVERLOADED_TEXT = (
+    "⏳ <b>Сейчас очень много запросов.</b>\n"
+    "Попробуйте через минуту — лимит не списан."
+)
+
+# Повторное нажатие, пока прежнее задание того же вида ещё в работе
+BUSY_TEXT = "⏳ Уже генерирую — результат придёт в этот чат"
+# Очередь заданий переполнена — для всплывающего уведомления, без разметки
+OVERLOADED_NOTICE = "⏳ Сейчас очень много запросов. Попробуйте через минуту — лимит не списан."
+
 
 class GenStates(StatesGroup):
     choosing_marketplace = State()
@@ -26,12 +46,11 @@ class GenStates(StatesGroup):
 # ── Создание карточки ──
 
 @router.callback_query(F.data == "new_card")
-async def cb_new_card(callback: CallbackQuery, state: FSMContext):
+async def cb_new_card(callback: CallbackQuery, state: FSMContext, user_ctx: dict):
     await touch_active(callback.from_user.id)
-    allowed, used, limit = await check_limit(callback.from_user.id)
-    if not allowed:
-        plan = await get_active_subscription(callback.from_user.id)
-        if plan == "free":
+    limit = user_ctx["limit"]
+    if not user_ctx["allowed"]:
+        if user_ctx["plan"] == "free":
             text = f"⚠️ Лимит исчерпан ({limit} карточки в день).\n\nОформите подписку для увеличения лимита 👇"
         else:
             text = f"⚠️ Лимит на этот месяц исчерпан ({limit} карточек)."
@@ -67,7 +86,7 @@ async def cb_choose_mp(callback: CallbackQuery, state: FSMContext):
 
 
 @router.message(GenStates.entering_product)
-async def msg_enter_product(message: Message, state: FSMContext):
+async def msg_enter_product(message: Message, state: FSMContext, user_ctx: dict):
     product = message.text.strip()
     if len(product) < 3:
         await message.answer("⚠️ Слишком короткое название. Опишите товар подробнее.")
@@ -79,13 +98,20 @@ async def msg_enter_product(message: Message, state: FSMContext):
     await state.update_data(product_name=product)
     data = await state.get_data()
 
-    wait_msg = await message.answer("🤔 <b>Анализирую товар, подбираю вопросы...</b>", parse_mode="HTML")
-
+    # Для известных категорий вопросы уже в кэше — без ожидания модели
+    wait_msg = None
     try:
-        questions = await generate_questions(data["marketplace"], product)
-        await state.update_data(ai_questions=questions)
+        questions = await get_cached_questions(data["marketplace"], product, user_ctx["plan"])
+        if questions is None:
+            wait_msg = await message.answer(
+                "🤔 <b>Анализирую товар, подбираю вопросы...</b>", parse_mode="HTML"
+            )
+            questions = await generate_questions(
+                data["marketplace"], product, use_cache=False, plan=user_ctx["plan"],
+            )
         await state.set_state(GenStates.answering_questions)
-        await wait_msg.delete()
+        if wait_msg:
+            await wait_msg.delete()
         await message.answer(
             f"📦 <b>{product}</b>\n\n"
             f"Ответьте на вопросы, чтобы карточка получилась точнее:\n\n"
@@ -95,7 +121,8 @@ async def msg_enter_product(message: Message, state: FSMContext):
         )
     except Exception as e:
         logger.error(f"Questions error: {e}")
-        await wait_msg.delete()
+        if wait_msg:
+            await wait_msg.delete()
         await state.set_state(GenStates.answering_questions)
         await message.answer(
             f"📦 <b>{product}</b>\n\n"
@@ -106,170 +133,378 @@ async def msg_enter_product(message: Message, state: FSMContext):
 
 
 @router.callback_query(GenStates.answering_questions, F.data == "skip_questions")
-async def cb_skip(callback: CallbackQuery, state: FSMContext):
-    await callback.answer()
-    await _do_generation(callback.message, callback.from_user.id, state, "")
+async def cb_skip(callback: CallbackQuery, state: FSMContext, user_ctx: dict):
+    notice = await _enqueue_generation(callback.message, callback.from_user.id, user_ctx["plan"], state, "")
+    await callback.answer(notice)
 
 
 @router.message(GenStates.answering_questions)
-async def msg_answers(message: Message, state: FSMContext):
+async def msg_answers(message: Message, state: FSMContext, user_ctx: dict):
     answers = message.text.strip()
     if len(answers) > 3000:
         await message.answer("⚠️ Слишком длинно. Сократите до 3000 символов.")
         return
-    await _do_generation(message, message.from_user.id, state, answers)
+    notice = await _enqueue_generation(message, message.from_user.id, user_ctx["plan"], state, answers)
+    if notice:
+        await message.answer(notice)
 
 
-async def _do_generation(message: Message, user_id: int, state: FSMContext, answers: str):
-    allowed, _, _ = await check_limit(user_id)
-    if not allowed:
-        await message.answer("⚠️ Лимит исчерпан.", reply_markup=back_kb())
-        await state.clear()
-        return
-
+async def _enqueue_generation(
+    message: Message, user_id: int, plan: str, state: FSMContext, answers: str,
+) -> str | None:
     data = await state.get_data()
-    wait_msg = await message.answer(
-        "⏳ <b>Генерирую карточку...</b>\n<i>10-20 секунд</i>", parse_mode="HTML"
-    )
-
+    return await _submit("card", user_id, message.chat.id, {
+        "marketplace": data["marketplace"],
+        "product_name": data["product_name"],
+        "details": answers,
+        "plan": plan,
+    })
+
+
+async def _submit(kind: str, user_id: int, chat_id: int, payload: dict) -> str | None:
+    """
+    Ставит задание, если такое же у пользователя ещё не в работе: двойное
+    нажатие не запускает второй запрос к модели. None — поставлено, иначе
+    текст для пользователя: уже генерируется или очередь переполнена.
+    """
+    try:
+        job_id = await job_queue.enqueue(
+            kind, user_id, chat_id, payload, plan=payload["plan"], exclusive=True,
+        )
+    except LLMOverloaded:
+        return OVERLOADED_NOTICE
+    return BUSY_TEXT if job_id is None else None
+
+
+# ── Выполнение заданий (воркеры очереди) ──
+
+async def _generate(
+    job: Job,
+    produce: Callable[[], Awaitable[tuple[Completion, dict]]],
+    overloaded_markup=None,
+    clear_on_limit: bool = False,
+) -> tuple[int, Completion] | None:
+    """
+    Общая часть заданий: лимит, вызов модели (produce → Completion и поля
+    для log_generation), запись генерации. None — лимит исчерпан или очередь
+    к модели переполнена; пользователю уже ответили. Если генерацию записала
+    прошлая попытка задания, модель не вызывается — берётся сохранённый текст.
+    """
+    if job.generation_id:
+        stored = await get_generation_by_id(job.generation_id, job.user_id)
+        if stored and stored.get("result_text"):
+            return job.generation_id, Completion(
+                stored["result_text"], stored["tokens_in"], stored["tokens_out"],
+                stored["model"] or "", stored["latency_ms"], result_format=stored["result_format"],
+            )
+
+    quota = await reserve_quota(job.user_id)
+    if not quota.allowed:
+        await job.delete_wait()
+        await job.answer("⚠️ Лимит исчерпан.", reply_markup=back_kb())
+        if clear_on_limit:
+            await job.state.clear()
+        return None
     try:
-        text, tokens_in, tokens_out = await generate_card(
-            marketplace=data["marketplace"],
-            product_name=data["product_name"],
-            details=answers,
+        card, fields = await produce()
+        await job.finish_progress()
+        gen_id = await quota.commit(job_id=job.id, **fields, **card.usage())
+        return gen_id, card
+    except LLMOverloaded:
+        await job.delete_wait()
+        await job.answer(OVERLOADED_TEXT, reply_markup=overloaded_markup, parse_mode="HTML")
+        return None
+    finally:
+        await quota.release()
+
+
+async def _deliver(
+    job: Job, gen_id: int, card: Completion, marketplace: str | None, source_gen_id: int | None = None,
+):
+    """
+    Показывает результат. В состоянии пользователя — только id генераций
+    и формат: тексты хранятся в БД и читаются, когда понадобятся
+    (смена стиля, перегенерация раздела). source_gen_id — генерация, чьи
+    товар и ответы на вопросы берёт «Другой вариант»; None — оставить прежнюю.
+    """
+    data = await job.state.get_data()
+    await job.state.set_data({
+        "marketplace": marketplace,
+        "gen_id": gen_id,
+        "source_gen_id": source_gen_id or data.get("source_gen_id"),
+        "fmt": card.result_format,
+    })
+    await job.state.set_state(GenStates.result)
+    await job.delete_wait()
+
+    text = render_text(card.text, card.result_format, marketplace)
+    kb = after_generation_kb(structured=card.result_format == FORMAT_CARD)
+    for i in range(0, len(text), 4000):
+        last = i + 4000 >= len(text)
+        await job.answer(text[i:i + 4000], reply_markup=kb if last else None)
+
+
+async def _card_job(job: Job):
+    p = job.payload
+
+    async def produce():
+        progress = await job.progress(
+            "⏳ <b>Генерирую карточку...</b>\n<i>текст появится через пару секунд</i>"
+        )
+        card = await generate_card(
+            marketplace=p["marketplace"],
+            product_name=p["product_name"],
+            details=p["details"],
+            on_progress=progress,
+            plan=p["plan"],
+            on_queued=progress.queued,
+        )
+        return card, {
+            "marketplace": p["marketplace"], "category": "",
+            "product_name": p["product_name"], "details": p["details"],
+        }
+
+    # При перегрузке ответы на вопросы остаются в состоянии — их можно отправить снова
+    result = await _generate(job, produce, clear_on_limit=True)
+    if result is not None:
+        gen_id, card = result
+        await _deliver(job, gen_id, card, p["marketplace"], source_gen_id=gen_id)
+
+
+async def _card_failed(job: Job, error: Exception):
+    await job.answer(
+        "❌ <b>Ошибка генерации.</b> Попробуйте через несколько секунд.",
+        reply_markup=main_menu(), parse_mode="HTML",
+    )
+    await job.state.clear()
+
+
+async def _regenerate_job(job: Job):
+    p = job.payload
+    fields = {
+        "marketplace": p["marketplace"], "category": "",
+        "product_name": p["product_name"], "details": p["details"],
+    }
+
+    async def produce():
+        # Сначала — запасной вариант из того же запроса к модели
+        if p["source_gen_id"]:
+            try:
+                candidate = await pop_candidate(p["source_gen_id"], job.user_id)
+            except Exception as e:
+                logger.error(f"Candidate lookup failed: {e}")
+                candidate = None
+            if candidate is not None:
+                body, _, fmt = candidate
+                return Completion(body, 0, 0, CANDIDATE_MODEL, 0, result_format=fmt), fields
+
+        progress = await job.progress("⏳ <b>Генерирую другой вариант...</b>")
+        card = await generate_card(
+            marketplace=p["marketplace"],
+            product_name=p["product_name"],
+            details=p["details"],
+            on_progress=progress,
+            use_cache=False,
+            plan=p["plan"],
+            on_queued=progress.queued,
         )
+        return card, fields
 
-        # Сохраняем с текстом результата для истории
-        await log_generation(
-            user_id=user_id,
-            marketplace=data["marketplace"],
-            category="",
-            product_name=data["product_name"],
-            result_text=text,
-            tokens_in=tokens_in,
-            tokens_out=tokens_out,
+    result = await _generate(job, produce, overloaded_markup=after_generation_kb())
+    if result is not None:
+        gen_id, card = result
+        # Запасной вариант не заменяет источник: следующий берётся из того же запроса
+        source = p["source_gen_id"] if card.model == CANDIDATE_MODEL else gen_id
+        await _deliver(job, gen_id, card, p["marketplace"], source_gen_id=source)
+
+
+async def _load_result(job: Job, gen_id: int) -> dict | None:
+    """Показанная пользователю генерация; None — её нет (пользователю уже ответили)."""
+    stored = await get_generation_by_id(gen_id, job.user_id)
+    if stored is None or not stored.get("result_text"):
+        await job.answer("⚠️ Карточка не найдена.", reply_markup=main_menu())
+        return None
+    return stored
+
+
+async def _restyle_job(job: Job):
+    p = job.payload
+    stored = await _load_result(job, p["gen_id"])
+    if stored is None:
+        return
+    marketplace = stored["marketplace"] or "Wildberries"
+
+    async def produce():
+        card = None
+        prefetched = restyle_prefetcher.take(job.user_id, p["gen_id"], p["style_key"])
+        if prefetched is not None:
+            # Готовый вариант показываем сразу, без сообщения ожидания
+            if not prefetched.done():
+                await job.progress("⏳ <b>Переписываю...</b>")
+            try:
+                # shield: отмена воркера не должна отменять общую задачу
+                card = await asyncio.shield(prefetched)
+            except Exception as e:
+                logger.warning(f"Prefetched style failed, rewriting again: {e!r}")
+        if card is None:
+            progress = await job.progress("⏳ <b>Переписываю...</b>")
+            card = await rewrite_card(
+                plain_text(stored["result_text"], stored["result_format"]),
+                STYLE_MAP.get(p["style_key"], "Нейтральный"), marketplace,
+                on_progress=progress, plan=p["plan"], on_queued=progress.queued,
+            )
+        return card, {"marketplace": marketplace, "category": "", "product_name": stored["product_name"]}
+
+    result = await _generate(job, produce, overloaded_markup=after_generation_kb())
+    if result is not None:
+        gen_id, card = result
+        await _deliver(job, gen_id, card, marketplace)
+
+
+async def _field_job(job: Job):
+    p = job.payload
+    field, label = FIELD_LABELS[p["action"]]
+    stored = await _load_result(job, p["gen_id"])
+    if stored is None:
+        return
+    marketplace = stored["marketplace"] or "Wildberries"
+
+    async def produce():
+        progress = await job.progress(f"⏳ <b>Подбираю {label}...</b>")
+        card = await regenerate_field(
+            stored["result_text"], field, marketplace, plan=p["plan"], on_queued=progress.queued,
         )
+        return card, {"marketplace": marketplace, "category": "", "product_name": stored["product_name"]}
 
-        await state.update_data(last_result=text, details=answers)
-        await state.set_state(GenStates.result)
-        await wait_msg.delete()
-
-        if len(text) > 4000:
-            for i in range(0, len(text), 4000):
-                chunk = text[i:i + 4000]
-                if i + 4000 >= len(text):
-                    await message.answer(chunk, reply_markup=after_generation_kb())
-                else:
-                    await message.answer(chunk)
-        else:
-            await message.answer(text, reply_markup=after_generation_kb())
+    result = await _generate(job, produce, overloaded_markup=after_generation_kb(structured=True))
+    if result is not None:
+        gen_id, card = result
+        await _deliver(job, gen_id, card, marketplace)
 
-    except Exception as e:
-        logger.error(f"Generation error for {user_id}: {e}")
-        await wait_msg.delete()
-        await message.answer(
-            "❌ <b>Ошибка генерации.</b> Попробуйте через несколько секунд.",
-            reply_markup=main_menu(), parse_mode="HTML",
+
+async def _competitor_job(job: Job):
+    p = job.payload
+
+    async def produce():
+        progress = await job.progress("⏳ <b>Анализирую...</b>")
+        card = await analyze_competitor(
+            p["text"], p["marketplace"], on_progress=progress,
+            plan=p["plan"], on_queued=progress.queued,
         )
-        await state.clear()
+        return card, {"marketplace": p["marketplace"], "category": "анализ", "product_name": "конкурент"}
+
+    # При перегрузке текст конкурента можно отправить ещё раз — состояние сохраняется
+    result = await _generate(job, produce, clear_on_limit=True)
+    if result is not None:
+        gen_id, card = result
+        await _deliver(job, gen_id, card, p["marketplace"])
+
+
+async def _edit_failed(job: Job, error: Exception):
+    await job.answer("❌ Ошибка. Попробуйте ещё раз.", reply_markup=main_menu())
+
+
+async def _competitor_failed(job: Job, error: Exception):
+    await job.answer("❌ Ошибка анализа.", reply_markup=main_menu())
+    await job.state.clear()
 
 
 # ── Перегенерация ──
 
 @router.callback_query(F.data == "regenerate")
-async def cb_regenerate(callback: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    if not data.get("product_name"):
+async def cb_regenerate(callback: CallbackQuery, state: FSMContext, user_ctx: dict):
+    source_gen_id = await state.get_value("source_gen_id")
+    # Товар и ответы на вопросы — из исходной генерации
+    source = await get_generation_source(source_gen_id, callback.from_user.id) if source_gen_id else None
+    if source is None:
         await callback.message.edit_text("⚠️ Нет данных для перегенерации.", reply_markup=main_menu())
         await callback.answer()
         return
-
-    allowed, _, _ = await check_limit(callback.from_user.id)
-    if not allowed:
+    if not user_ctx["allowed"]:
         await callback.answer("⚠️ Лимит исчерпан", show_alert=True)
         return
 
-    await callback.answer("⏳ Генерирую...")
-    wait_msg = await callback.message.answer("⏳ <b>Генерирую другой вариант...</b>", parse_mode="HTML")
+    notice = await _submit("regenerate", callback.from_user.id, callback.message.chat.id, {
+        "marketplace": source["marketplace"],
+        "product_name": source["product_name"],
+        "details": source["details"],
+        "source_gen_id": source_gen_id,
+        "plan": user_ctx["plan"],
+    })
+    await callback.answer(notice or "⏳ Генерирую...")
 
-    try:
-        text, tokens_in, tokens_out = await generate_card(
-            marketplace=data["marketplace"],
-            product_name=data["product_name"],
-            details=data.get("details", ""),
-        )
-        await log_generation(
-            user_id=callback.from_user.id,
-            marketplace=data["marketplace"], category="",
-            product_name=data["product_name"],
-            result_text=text,
-            tokens_in=tokens_in, tokens_out=tokens_out,
-        )
-        await state.update_data(last_result=text)
-        await wait_msg.delete()
-        await callback.message.answer(text, reply_markup=after_generation_kb())
-    except Exception as e:
-        logger.error(f"Regen error: {e}")
-        await wait_msg.delete()
-        await callback.message.answer("❌ Ошибка. Попробуйте ещё раз.", reply_markup=main_menu())
+
+# ── Перегенерация одного раздела ──
+
+FIELD_LABELS = {"regen_title": ("title", "заголовок"), "regen_keywords": ("keywords", "ключевые слова")}
+
+
+@router.callback_query(F.data.in_(FIELD_LABELS))
+async def cb_regen_field(callback: CallbackQuery, state: FSMContext, user_ctx: dict):
+    data = await state.get_data()
+    if not data.get("gen_id") or data.get("fmt") != FORMAT_CARD:
+        await callback.answer("⚠️ Нет карточки", show_alert=True)
+        return
+    if not user_ctx["allowed"]:
+        await callback.answer("⚠️ Лимит исчерпан", show_alert=True)
+        return
+
+    label = FIELD_LABELS[callback.data][1]
+    notice = await _submit("field", callback.from_user.id, callback.message.chat.id, {
+        "action": callback.data,
+        "gen_id": data["gen_id"],
+        "plan": user_ctx["plan"],
+    })
+    await callback.answer(notice or f"⏳ Подбираю {label}...")
 
 
 # ── Стили ──
 
 @router.callback_query(F.data == "restyle")
-async def cb_restyle(callback: CallbackQuery, state: FSMContext):
-    plan = await get_active_subscription(callback.from_user.id)
-    if plan == "free":
+async def cb_restyle(callback: CallbackQuery, state: FSMContext, user_ctx: dict):
+    if user_ctx["plan"] == "free":
         await callback.answer("💎 Смена стиля доступна на тарифе Стандарт+", show_alert=True)
         return
     await callback.message.edit_text("✨ <b>Выберите стиль:</b>", reply_markup=restyle_kb(), parse_mode="HTML")
     await callback.answer()
 
+    # Пока пользователь выбирает, все стили переписываются в фоне
+    gen_id = await state.get_value("gen_id")
+    if user_ctx["allowed"] and gen_id:
+        stored = await get_generation_by_id(gen_id, callback.from_user.id)
+        if stored and stored.get("result_text"):
+            restyle_prefetcher.prefetch(
+                callback.from_user.id, gen_id, plain_text(stored["result_text"], stored["result_format"]),
+                stored["marketplace"] or "Wildberries", user_ctx["plan"], STYLE_MAP,
+            )
+
 
 @router.callback_query(F.data.startswith("style_"))
-async def cb_style(callback: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    last = data.get("last_result")
-    if not last:
+async def cb_style(callback: CallbackQuery, state: FSMContext, user_ctx: dict):
+    gen_id = await state.get_value("gen_id")
+    if not gen_id:
         await callback.answer("⚠️ Нет карточки", show_alert=True)
         return
-    allowed, _, _ = await check_limit(callback.from_user.id)
-    if not allowed:
+    if not user_ctx["allowed"]:
         await callback.answer("⚠️ Лимит исчерпан", show_alert=True)
         return
 
-    style = STYLE_MAP.get(callback.data, "Нейтральный")
-    await callback.answer("⏳ Применяю стиль...")
-    wait_msg = await callback.message.answer("⏳ <b>Переписываю...</b>", parse_mode="HTML")
-
-    try:
-        text, tokens_in, tokens_out = await rewrite_card(last, style, data.get("marketplace", "Wildberries"))
-        await log_generation(
-            user_id=callback.from_user.id,
-            marketplace=data.get("marketplace", ""), category="",
-            product_name=data.get("product_name", ""),
-            result_text=text,
-            tokens_in=tokens_in, tokens_out=tokens_out,
-        )
-        await state.update_data(last_result=text)
-        await wait_msg.delete()
-        await callback.message.answer(text, reply_markup=after_generation_kb())
-    except Exception as e:
-        logger.error(f"Restyle error: {e}")
-        await wait_msg.delete()
-        await callback.message.answer("❌ Ошибка.", reply_markup=main_menu())
+    notice = await _submit("restyle", callback.from_user.id, callback.message.chat.id, {
+        "style_key": callback.data,
+        "gen_id": gen_id,
+        "plan": user_ctx["plan"],
+    })
+    await callback.answer(notice or "⏳ Применяю стиль...")
 
 
 # ── Анализ конкурента ──
 
 @router.callback_query(F.data == "analyze")
-async def cb_analyze(callback: CallbackQuery, state: FSMContext):
-    plan = await get_active_subscription(callback.from_user.id)
-    if plan == "free":
+async def cb_analyze(callback: CallbackQuery, state: FSMContext, user_ctx: dict):
+    if user_ctx["plan"] == "free":
         await callback.answer("💎 Анализ конкурентов — тариф Стандарт+", show_alert=True)
         return
-    allowed, _, _ = await check_limit(callback.from_user.id)
-    if not allowed:
+    if not user_ctx["allowed"]:
         await callback.answer("⚠️ Лимит исчерпан", show_alert=True)
         return
     await state.clear()
@@ -294,7 +529,7 @@ async def cb_comp_mp(callback: CallbackQuery, state: FSMContext):
 
 
 @router.message(GenStates.entering_competitor_text)
-async def msg_comp_text(message: Message, state: FSMContext):
+async def msg_comp_text(message: Message, state: FSMContext, user_ctx: dict):
     text = message.text.strip()
     if len(text) < 20:
         await message.answer("⚠️ Текст слишком короткий.")
@@ -304,23 +539,17 @@ async def msg_comp_text(message: Message, state: FSMContext):
         return
 
     data = await state.get_data()
-    wait_msg = await message.answer("⏳ <b>Анализирую...</b>", parse_mode="HTML")
-
-    try:
-        result, tokens_in, tokens_out = await analyze_competitor(text, data["marketplace"])
-        await log_generation(
-            user_id=message.from_user.id,
-            marketplace=data["marketplace"], category="анализ",
-            product_name="конкурент",
-            result_text=result,
-            tokens_in=tokens_in, tokens_out=tokens_out,
-        )
-        await state.update_data(last_result=result)
-        await state.set_state(GenStates.result)
-        await wait_msg.delete()
-        await message.answer(result, reply_markup=after_generation_kb())
-    except Exception as e:
-        logger.error(f"Competitor error: {e}")
-        await wait_msg.delete()
-        await message.answer("❌ Ошибка анализа.", reply_markup=main_menu())
-        await state.clear()
+    notice = await _submit("competitor", message.from_user.id, message.chat.id, {
+        "text": text,
+        "marketplace": data["marketplace"],
+        "plan": user_ctx["plan"],
+    })
+    if notice:
+        await message.answer(notice)
+
+
+job_queue.register("card", _card_job, _card_failed)
+job_queue.register("regenerate", _regenerate_job, _edit_failed)
+job_queue.register("field", _field_job, _edit_failed)
+job_queue.register("restyle", _restyle_job, _edit_failed)
+job_queue.register("competitor", _competitor_job, _competitor_failed)
@@ -1,7 +1,9 @@
 import logging
+from datetime import datetime
 from aiogram import Router, F
 from aiogram.types import CallbackQuery
 from bot.database.db import get_user_generations, get_generation_by_id, count_user_generations
+from bot.services.card_format import render_text
 from bot.keyboards.inline import history_kb, card_detail_kb, back_kb
 
 logger = logging.getLogger(__name__)
@@ -10,10 +12,22 @@ router = Router()
 PER_PAGE = 5
 
 
+def _parse_cursor(cursor: str) -> tuple[int, int | None, bool]:
+    """
+    Курсор страницы: "0" — первая, "<стр>:o:<id>" — старше карточки id,
+    "<стр>:n:<id>" — новее карточки id. Возвращает (страница, id якоря, новее ли).
+    """
+    parts = cursor.split(":")
+    if len(parts) != 3:
+        return 1, None, False
+    return int(parts[0]), int(parts[2]), parts[1] == "n"
+
+
 @router.callback_query(F.data.startswith("my_cards:"))
 async def cb_my_cards(callback: CallbackQuery):
     uid = callback.from_user.id
-    offset = int(callback.data.split(":")[1])
+    cursor = callback.data.split(":", 1)[1]
+    page, anchor_id, newer = _parse_cursor(cursor)
     total = await count_user_generations(uid)
 
     if total == 0:
@@ -25,14 +39,16 @@ async def cb_my_cards(callback: CallbackQuery):
         await callback.answer()
         return
 
-    cards = await get_user_generations(uid, limit=PER_PAGE, offset=offset)
-    page = (offset // PER_PAGE) + 1
+    cards = await get_user_generations(uid, limit=PER_PAGE, anchor_id=anchor_id, newer=newer)
+    if not cards:
+        page, cursor = 1, "0"
+        cards = await get_user_generations(uid, limit=PER_PAGE)
     total_pages = (total + PER_PAGE - 1) // PER_PAGE
 
     await callback.message.edit_text(
         f"📂 <b>Мои карточки</b> — {total} шт. (стр. {page}/{total_pages})\n\n"
         f"Нажмите, чтобы просмотреть:",
-        reply_markup=history_kb(cards, offset, total),
+        reply_markup=history_kb(cards, page, total, cursor),
         parse_mode="HTML",
     )
     await callback.answer()
@@ -40,9 +56,9 @@ async def cb_my_cards(callback: CallbackQuery):
 
 @router.callback_query(F.data.startswith("show_card:"))
 async def cb_show_card(callback: CallbackQuery):
-    parts = callback.data.split(":")
+    parts = callback.data.split(":", 2)
     gen_id = int(parts[1])
-    offset = int(parts[2]) if len(parts) > 2 else 0
+    cursor = parts[2] if len(parts) > 2 else "0"
     uid = callback.from_user.id
 
     card = await get_generation_by_id(gen_id, uid)
@@ -51,8 +67,10 @@ async def cb_show_card(callback: CallbackQuery):
         return
 
     mp_icon = "🟣" if card.get("marketplace") == "Wildberries" else "🔵"
-    created = card.get("created_at", "")[:16].replace("T", " ")
-    result = card.get("result_text") or "Текст не сохранён"
+    created = datetime.utcfromtimestamp(card["created_at"]).strftime("%Y-%m-%d %H:%M")
+    result = "Текст не сохранён"
+    if card.get("result_text"):
+        result = render_text(card["result_text"], card["result_format"], card.get("marketplace"))
 
     header = f"{mp_icon} <b>{card.get('product_name', '—')}</b>\n📅 {created}\n{'─' * 28}\n\n"
     full = header + result
@@ -61,6 +79,6 @@ async def cb_show_card(callback: CallbackQuery):
         full = full[:3990] + "\n\n<i>…обрезано</i>"
 
     await callback.message.edit_text(
-        full, reply_markup=card_detail_kb(offset), parse_mode="HTML",
+        full, reply_markup=card_detail_kb(cursor), parse_mode="HTML",
     )
     await callback.answer()
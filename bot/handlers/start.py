@@ -1,11 +1,10 @@
 import logging
+from datetime import datetime
 from aiogram import Router, F
 from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.types import Message, CallbackQuery
 from bot.database.db import (
-    get_or_create_user, get_active_subscription,
-    count_today_generations, count_month_generations,
-    get_user, get_user_by_ref_code, count_referrals,
+    get_or_create_user, get_user_by_ref_code, count_referrals,
     add_referral_bonus, touch_active,
 )
 from bot.keyboards.inline import main_menu, pricing_kb, back_kb
@@ -52,12 +51,12 @@ HELP_TEXT = """❓ <b>Как пользоваться ботом</b>
 
 
 @router.message(CommandStart(deep_link=True))
-async def cmd_start_with_ref(message: Message, command: CommandObject):
+async def cmd_start_with_ref(message: Message, command: CommandObject, user_ctx: dict):
     """Запуск с реферальной ссылкой: /start KP1A2B3C4D"""
     user = message.from_user
     ref_code = command.args
 
-    existing = await get_user(user.id)
+    existing = user_ctx["user"]
     inviter_id = None
 
     if not existing and ref_code:
@@ -133,13 +132,12 @@ async def cb_back_main(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "profile")
-async def cb_profile(callback: CallbackQuery):
-    uid = callback.from_user.id
-    plan = await get_active_subscription(uid)
-    today = await count_today_generations(uid)
-    month = await count_month_generations(uid)
-    refs = await count_referrals(uid)
-    user = await get_user(uid)
+async def cb_profile(callback: CallbackQuery, user_ctx: dict):
+    plan = user_ctx["plan"]
+    today = user_ctx["today_gens"]
+    month = user_ctx["month_gens"]
+    refs = user_ctx["referrals"]
+    user = user_ctx["user"]
 
     plan_names = {"free": "🆓 Бесплатный", "standard": "⭐ Стандарт", "pro": "💎 Про"}
     plan_name = plan_names.get(plan, plan)
@@ -153,7 +151,7 @@ async def cb_profile(callback: CallbackQuery):
 
     expires = ""
     if plan != "free" and user and user.get("sub_expires_at"):
-        expires = f"\nПодписка до: {user['sub_expires_at'][:10]}"
+        expires = f"\nПодписка до: {datetime.utcfromtimestamp(user['sub_expires_at']):%Y-%m-%d}"
 
     bonus = user.get("referral_bonus_days", 0) if user else 0
 
@@ -191,14 +189,14 @@ async def cb_pricing(callback: CallbackQuery):
 # ── Реферальная программа ──
 
 @router.callback_query(F.data == "referral")
-async def cb_referral(callback: CallbackQuery):
-    user = await get_user(callback.from_user.id)
+async def cb_referral(callback: CallbackQuery, user_ctx: dict):
+    user = user_ctx["user"]
     if not user:
         await callback.answer("Ошибка", show_alert=True)
         return
 
     ref_code = user.get("referral_code", "")
-    refs = await count_referrals(callback.from_user.id)
+    refs = user_ctx["referrals"]
     bonus = user.get("referral_bonus_days", 0)
 
     from bot.main import bot
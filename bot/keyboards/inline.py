@@ -1,3 +1,4 @@
+from datetime import datetime
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 
@@ -5,6 +6,7 @@ def main_menu() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🛍 Создать карточку", callback_data="new_card")],
         [InlineKeyboardButton(text="🔍 Анализ конкурента", callback_data="analyze")],
+        [InlineKeyboardButton(text="📦 Каталог из файла", callback_data="bulk")],
         [
             InlineKeyboardButton(text="📂 Мои карточки", callback_data="my_cards:0"),
             InlineKeyboardButton(text="👤 Профиль", callback_data="profile"),
@@ -34,14 +36,29 @@ def skip_kb() -> InlineKeyboardMarkup:
     ])
 
 
-def after_generation_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
+def after_generation_kb(structured: bool = False) -> InlineKeyboardMarkup:
+    """structured — карточка по разделам: можно перегенерировать заголовок или ключи отдельно."""
+    keyboard = [
         [
             InlineKeyboardButton(text="🔄 Другой вариант", callback_data="regenerate"),
             InlineKeyboardButton(text="✨ Сменить стиль", callback_data="restyle"),
         ],
+    ]
+    if structured:
+        keyboard.append([
+            InlineKeyboardButton(text="📌 Новый заголовок", callback_data="regen_title"),
+            InlineKeyboardButton(text="🔑 Новые ключи", callback_data="regen_keywords"),
+        ])
+    keyboard += [
         [InlineKeyboardButton(text="🛍 Новая карточка", callback_data="new_card")],
         [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_main")],
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def bulk_cancel_kb(job_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⏹ Остановить", callback_data=f"bulk_cancel:{job_id}")],
     ])
 
 
@@ -67,11 +84,13 @@ STYLE_MAP = {
 }
 
 
-def history_kb(cards: list[dict], offset: int, total: int) -> InlineKeyboardMarkup:
-    """Список карточек с пагинацией по 5 шт."""
+def history_kb(cards: list[dict], page: int, total: int, cursor: str) -> InlineKeyboardMarkup:
+    """Список карточек с пагинацией по 5 шт. Навигация несёт курсор, а не смещение."""
     keyboard = []
     for card in cards:
-        created = card["created_at"][:10] if card.get("created_at") else ""
+        created = ""
+        if card.get("created_at"):
+            created = datetime.utcfromtimestamp(card["created_at"]).strftime("%Y-%m-%d")
         mp_icon = "🟣" if card.get("marketplace") == "Wildberries" else "🔵"
         name = card.get("product_name", "")
         if len(name) > 30:
@@ -79,15 +98,19 @@ def history_kb(cards: list[dict], offset: int, total: int) -> InlineKeyboardMark
         keyboard.append([
             InlineKeyboardButton(
                 text=f"{mp_icon} {name}  •  {created}",
-                callback_data=f"show_card:{card['id']}:{offset}",
+                callback_data=f"show_card:{card['id']}:{cursor}",
             )
         ])
 
     nav_row = []
-    if offset > 0:
-        nav_row.append(InlineKeyboardButton(text="◀️", callback_data=f"my_cards:{offset - 5}"))
-    if offset + 5 < total:
-        nav_row.append(InlineKeyboardButton(text="▶️", callback_data=f"my_cards:{offset + 5}"))
+    if page > 1 and cards:
+        nav_row.append(InlineKeyboardButton(
+            text="◀️", callback_data=f"my_cards:{page - 1}:n:{cards[0]['id']}",
+        ))
+    if page * 5 < total and cards:
+        nav_row.append(InlineKeyboardButton(
+            text="▶️", callback_data=f"my_cards:{page + 1}:o:{cards[-1]['id']}",
+        ))
     if nav_row:
         keyboard.append(nav_row)
 
@@ -95,9 +118,9 @@ def history_kb(cards: list[dict], offset: int, total: int) -> InlineKeyboardMark
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def card_detail_kb(offset: int) -> InlineKeyboardMarkup:
+def card_detail_kb(cursor: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="◀️ К списку", callback_data=f"my_cards:{offset}")],
+        [InlineKeyboardButton(text="◀️ К списку", callback_data=f"my_cards:{cursor}")],
         [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_main")],
     ])
 
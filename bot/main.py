@@ -3,16 +3,22 @@ import logging
 import sys
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.memory import MemoryStorage
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from bot.config import config
-from bot.database.db import init_db
+from bot.database.db import init_db, close_db, purge_jobs, purge_quota_reservations
+from bot.database.fsm_storage import create_storage
 from bot.middlewares.throttle import ThrottleMiddleware
+from bot.middlewares.user_context import UserContextMiddleware
 from bot.services.scheduler import send_inactive_reminders
+from bot.services.bulk import bulk_runner
+from bot.services.jobs import job_queue
+from bot.services.response_cache import response_cache
+from bot.services.ai_service import client as llm_client
 
 from bot.handlers.start import router as start_router
 from bot.handlers.generate import router as generate_router
+from bot.handlers.bulk import router as bulk_router
 from bot.handlers.history import router as history_router
 from bot.handlers.subscription import router as subscription_router
 from bot.handlers.admin import router as admin_router
@@ -32,16 +38,29 @@ async def main():
     )
     logger = logging.getLogger(__name__)
 
-    await init_db()
+    await init_db(migrate_bodies=True)
     logger.info("Database initialized")
 
-    dp = Dispatcher(storage=MemoryStorage())
+    # Соединения с API открываются заранее — первый пользователь не ждёт TLS.
+    # Запуск бота не ждёт прогрева: недоступный эндпоинт не задерживает старт
+    async def warm_up_llm():
+        timings = await llm_client.warm_up()
+        logger.info(f"LLM endpoints warmed up: {timings} ms")
+    warm_up = asyncio.create_task(warm_up_llm(), name="llm-warm-up")
+
+    # В состоянии FSM только id и короткие значения; простаивающие сессии вытесняются
+    storage = create_storage()
+    logger.info(f"FSM storage: {storage.backend}")
+    dp = Dispatcher(storage=storage)
 
     dp.message.middleware(ThrottleMiddleware(rate_limit=1.0))
     dp.callback_query.middleware(ThrottleMiddleware(rate_limit=0.5))
+    dp.message.middleware(UserContextMiddleware())
+    dp.callback_query.middleware(UserContextMiddleware())
 
     dp.include_router(start_router)
     dp.include_router(generate_router)
+    dp.include_router(bulk_router)
     dp.include_router(history_router)
     dp.include_router(subscription_router)
     dp.include_router(admin_router)
@@ -57,16 +76,69 @@ async def main():
         id="inactive_reminders",
         replace_existing=True,
     )
+    scheduler.add_job(
+        response_cache.evict,
+        "interval",
+        hours=1,
+        id="response_cache_evict",
+        replace_existing=True,
+    )
+    if config.llm_keepalive_interval > 0:
+        scheduler.add_job(
+            llm_client.warm_up,
+            "interval",
+            seconds=config.llm_keepalive_interval,
+            id="llm_keepalive",
+            replace_existing=True,
+        )
+    scheduler.add_job(
+        storage.evict,
+        "interval",
+        minutes=10,
+        id="fsm_evict",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        purge_jobs,
+        "interval",
+        hours=24,
+        args=[config.job_retention],
+        id="jobs_purge",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        purge_quota_reservations,
+        "interval",
+        minutes=10,
+        args=[config.quota_reservation_ttl],
+        id="quota_reservations_purge",
+        replace_existing=True,
+    )
     scheduler.start()
     logger.info("Scheduler started (reminders every 6h)")
 
     logger.info("Bot starting...")
     await bot.delete_webhook(drop_pending_updates=True)
 
+    # Каталоги, прерванные прошлой остановкой, продолжаются с сохранённой строки
+    resumed = await bulk_runner.resume(bot)
+    if resumed:
+        logger.info(f"Resumed {resumed} bulk jobs")
+
+    # Задания генерации, взятые до остановки, выполняются снова
+    recovered = await job_queue.start(bot, dp.storage)
+    logger.info(f"Job queue started ({job_queue.workers} workers, {recovered} recovered)")
+
     try:
         await dp.start_polling(bot)
     finally:
         scheduler.shutdown()
+        warm_up.cancel()
+        await job_queue.stop()
+        await bulk_runner.stop()
+        await storage.close()
+        await llm_client.close()
+        await close_db()
 
 
 if __name__ == "__main__":
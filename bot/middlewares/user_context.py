@@ -0,0 +1,25 @@
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from bot.database.db import get_user_context
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """
+    Один запрос к БД на апдейт: профиль, тариф, расход и рефералы
+    кладутся в data["user_ctx"]. Загружается только для хэндлеров,
+    которые объявили параметр user_ctx.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        user = data.get("event_from_user")
+        if user and handler_object and "user_ctx" in handler_object.params:
+            data["user_ctx"] = await get_user_context(user.id)
+        return await handler(event, data)
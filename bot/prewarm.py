@@ -0,0 +1,76 @@
+"""
+Прогрев кэша уточняющих вопросов по самым популярным категориям.
+
+    python -m bot.prewarm --top 200
+
+Категории берутся из generations.product_name; для каждой вопросы
+генерируются по самому частому названию товара в ней.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from collections import Counter
+
+from bot.database.db import close_db, get_top_product_names, init_db
+from bot.services.ai_service import generate_questions, get_cached_questions
+from bot.services.categories import category_key
+
+logger = logging.getLogger(__name__)
+
+
+async def prewarm(top: int, concurrency: int, refresh: bool) -> tuple[int, int]:
+    """Возвращает (сгенерировано, уже было в кэше)."""
+    counts: Counter[str] = Counter()
+    sample: dict[str, tuple[str, str]] = {}
+    for marketplace, product_name, n in await get_top_product_names():
+        key = category_key(marketplace, product_name)
+        if key is None:
+            continue
+        counts[key] += n
+        # Строки идут по убыванию частоты — первое название самое типичное
+        sample.setdefault(key, (marketplace, product_name))
+
+    semaphore = asyncio.Semaphore(concurrency)
+    warmed = skipped = 0
+
+    async def warm(key: str):
+        nonlocal warmed, skipped
+        marketplace, product_name = sample[key]
+        async with semaphore:
+            if not refresh and await get_cached_questions(marketplace, product_name):
+                skipped += 1
+                return
+            try:
+                await generate_questions(marketplace, product_name, use_cache=False)
+                warmed += 1
+                logger.info(f"{key} ← «{product_name}»")
+            except Exception as e:
+                logger.error(f"Prewarm failed for {key}: {e}")
+
+    await asyncio.gather(*(warm(key) for key, _ in counts.most_common(top)))
+    return warmed, skipped
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Прогрев кэша уточняющих вопросов")
+    parser.add_argument("--top", type=int, default=100, help="сколько популярных категорий прогреть")
+    parser.add_argument("--concurrency", type=int, default=4, help="параллельных запросов к модели")
+    parser.add_argument("--refresh", action="store_true", help="перегенерировать уже закэшированные")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s | %(levelname)-7s | %(name)s | %(message)s",
+        stream=sys.stdout,
+    )
+    await init_db()
+    try:
+        warmed, skipped = await prewarm(args.top, args.concurrency, args.refresh)
+    finally:
+        await close_db()
+    logger.info(f"Prewarm done: {warmed} generated, {skipped} already cached")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,13 +1,21 @@
+import asyncio
 import openai
 import logging
+import time
+from typing import Awaitable, Callable, NamedTuple
 from bot.config import config
+from bot.services.card_format import (
+    CARD_SCHEMA, FIELD_SCHEMAS, FORMAT_CARD, FORMAT_TEXT, TITLE_LIMITS,
+    Card, render_partial, response_format,
+)
+from bot.services.categories import category_key
+from bot.services.llm_client import build_client
+from bot.services.llm_scheduler import QueueCallback, llm_scheduler
+from bot.services.response_cache import make_key, response_cache
 
 logger = logging.getLogger(__name__)
 
-client = openai.AsyncOpenAI(
-    api_key=config.openai_api_key,
-    base_url=config.openai_base_url,
-)
+client = build_client()
 
 # ── Системные промпты ──
 
@@ -51,7 +59,9 @@ GENERATE_PROMPT = """Маркетплейс: {marketplace}
 Товар: {product_name}
 {details_block}
 
-Сгенерируй карточку товара в следующем формате:
+Сгенерируй карточку товара {format_block}"""
+
+TEXT_FORMAT = """в следующем формате:
 
 📌 ЗАГОЛОВОК:
 [заголовок]
@@ -65,6 +75,12 @@ GENERATE_PROMPT = """Маркетплейс: {marketplace}
 📋 РЕКОМЕНДУЕМЫЕ ХАРАКТЕРИСТИКИ:
 [характеристика: значение — по одной на строку]"""
 
+JSON_FORMAT = """в виде JSON:
+title — заголовок,
+description — описание (абзацы через перевод строки),
+keywords — ключевые слова, каждое отдельным элементом,
+attributes — рекомендуемые характеристики: name — название, value — значение."""
+
 COMPETITOR_PROMPT = """Проанализируй карточку товара конкурента на {marketplace} и создай улучшенную версию.
 
 Текст карточки конкурента:
@@ -100,17 +116,219 @@ REWRITE_PROMPT = """Перепиши карточку товара в друго
 Новый стиль: {style}
 Маркетплейс: {marketplace}
 
-Формат: тот же (заголовок, описание, ключевые слова, характеристики)."""
+Верни карточку {format_block}"""
+
+REWRITE_TEXT_FORMAT = "в том же формате (заголовок, описание, ключевые слова, характеристики)."
+
+FIELD_PROMPT = """Маркетплейс: {marketplace}
+
+Карточка товара:
+---
+{card_text}
+---
+
+{instruction}"""
+
+FIELD_INSTRUCTIONS = {
+    "title": (
+        "Придумай другой заголовок для этой карточки: главные ключевые слова первыми, "
+        "не длиннее {limit} символов, без caps lock и эмодзи. Не повторяй текущий."
+    ),
+    "keywords": (
+        "Подбери заново 15-25 ключевых слов для этой карточки: от высокочастотных "
+        "к низкочастотным, с синонимами и разговорными вариантами. "
+        "Не повторяй текущий список дословно."
+    ),
+}
 
 
 # ── API-вызовы ──
 
-async def generate_questions(marketplace: str, product_name: str) -> str:
-    """Генерация уточняющих вопросов по товару."""
+# Получает весь накопленный к этому моменту текст ответа
+ProgressCallback = Callable[[str], Awaitable[None]]
+
+# Вместо имени модели у ответов, отданных из кэша и из запасных вариантов
+CACHE_MODEL = "cache"
+CANDIDATE_MODEL = "candidate"
+
+
+class Completion(NamedTuple):
+    text: str
+    tokens_in: int
+    tokens_out: int
+    model: str
+    latency_ms: int
+    # Запасные варианты при n > 1: (текст, токены_выход)
+    alternatives: tuple[tuple[str, int], ...] = ()
+    # FORMAT_CARD — text и alternatives в виде Card.dump()
+    result_format: int = FORMAT_TEXT
+
+    def usage(self) -> dict:
+        """Поля для log_generation / QuotaReservation.commit()."""
+        return {
+            "result_text": self.text,
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "model": self.model,
+            "latency_ms": self.latency_ms,
+            "candidates": list(self.alternatives),
+            "result_format": self.result_format,
+        }
+
+
+async def _complete(
+    task: str,
+    messages: list[dict],
+    on_progress: ProgressCallback | None = None,
+    plan: str = "free",
+    on_queued: QueueCallback | None = None,
+    schema: tuple[str, dict] | None = None,
+) -> Completion:
+    """
+    Запрос к модели по маршруту задачи (config.route) через общую очередь
+    с приоритетом тарифа plan. С on_progress ответ читается потоком и колбэк
+    вызывается на каждом фрагменте; токены берутся из последнего чанка
+    (stream_options.include_usage). Задержка считается без ожидания в очереди.
+    schema — (имя, JSON-схема) для структурированного ответа.
+    """
+    route = config.route(task, plan)
+    async with llm_scheduler.slot(plan, on_queued):
+        started = time.monotonic()
+        texts, tokens_in, tokens_out, model = await _request(route, messages, on_progress, schema)
+    latency_ms = int((time.monotonic() - started) * 1000)
+
+    # Провайдер отдаёт токены выхода суммой по всем вариантам — делим по длине
+    texts = [t for i, t in enumerate(texts) if t and (i == 0 or t != texts[0])] or [""]
+    total_len = sum(len(t) for t in texts) or 1
+    alternatives = tuple((t, tokens_out * len(t) // total_len) for t in texts[1:])
+    return Completion(texts[0], tokens_in, tokens_out, model, latency_ms, alternatives)
+
+
+async def _request(
+    route: dict,
+    messages: list[dict],
+    on_progress: ProgressCallback | None,
+    schema: tuple[str, dict] | None = None,
+) -> tuple[list[str], int, int, str]:
+    """Тексты всех вариантов (первый — основной), токены и модель, ответившая на запрос."""
+    params = {
+        "model": route["model"],
+        "messages": messages,
+        "temperature": route["temperature"],
+        "max_tokens": route["max_tokens"],
+        "timeout": route["timeout"],
+    }
+    if route.get("n", 1) > 1:
+        params["n"] = route["n"]
+    if schema is not None:
+        params["response_format"] = response_format(*schema)
+
+    if on_progress is None or not config.stream_responses:
+        response = await client.create(**params)
+        choices = sorted(response.choices, key=lambda c: c.index)
+        texts = [c.message.content or "" for c in choices]
+        tokens_in = response.usage.prompt_tokens if response.usage else 0
+        tokens_out = response.usage.completion_tokens if response.usage else 0
+        return texts, tokens_in, tokens_out, response.model or route["model"]
+
+    stream = await client.create(**params, stream=True, stream_options={"include_usage": True})
+    texts: dict[int, str] = {}
+    usage = None
+    model = route["model"]
+    # Таймаут маршрута в client.create ограничивает ожидание заголовков;
+    # на чтение самого потока — тот же общий срок
+    try:
+        async with asyncio.timeout(route["timeout"]):
+            async for chunk in stream:
+                model = chunk.model or model
+                if chunk.usage:
+                    usage = chunk.usage
+                for choice in chunk.choices:
+                    delta = choice.delta.content
+                    if not delta:
+                        continue
+                    texts[choice.index] = texts.get(choice.index, "") + delta
+                    # Пользователь видит, как пишется основной вариант
+                    if choice.index == 0:
+                        await on_progress(texts[0])
+    except TimeoutError as e:
+        raise openai.APITimeoutError(stream.response.request) from e
+    finally:
+        await stream.close()
+
+    tokens_in = usage.prompt_tokens if usage else 0
+    tokens_out = usage.completion_tokens if usage else 0
+    return [texts.get(i, "") for i in range(max(texts, default=0) + 1)], tokens_in, tokens_out, model
+
+
+def _structured(result: Completion, marketplace: str) -> Completion:
+    """
+    Ответ по CARD_SCHEMA → Completion с Card.dump() в text и alternatives.
+    Неразобранные запасные варианты отбрасываются; если не разобрался
+    основной, ответ остаётся свободным текстом.
+    """
+    card = Card.parse(result.text, marketplace)
+    if card is None:
+        logger.warning(f"Card JSON did not parse, keeping raw text ({len(result.text)} chars)")
+        return result
+    alternatives = []
+    for text, tokens_out in result.alternatives:
+        alternative = Card.parse(text, marketplace)
+        if alternative is not None:
+            alternatives.append((alternative.dump(), tokens_out))
+    return result._replace(text=card.dump(), alternatives=tuple(alternatives), result_format=FORMAT_CARD)
+
+
+def _partial_progress(on_progress: ProgressCallback | None) -> ProgressCallback | None:
+    """Показывает недописанный JSON карточки в текстовом виде."""
+    if on_progress is None:
+        return None
+
+    async def progress(raw: str):
+        await on_progress(render_partial(raw))
+    return progress
+
+
+def _questions_cache_key(marketplace: str, product_name: str, plan: str) -> str | None:
+    if not config.response_cache_enabled:
+        return None
+    category = category_key(marketplace, product_name)
+    if category is None:
+        return None
+    return make_key("questions", config.route("questions", plan)["model"], category)
+
+
+async def get_cached_questions(marketplace: str, product_name: str, plan: str = "free") -> str | None:
+    """Вопросы для категории товара, если они уже есть в кэше."""
+    key = _questions_cache_key(marketplace, product_name, plan)
+    if key is None:
+        return None
+    cached = await response_cache.get(key)
+    return cached[0] if cached else None
+
+
+async def generate_questions(
+    marketplace: str,
+    product_name: str,
+    use_cache: bool = True,
+    plan: str = "free",
+    on_queued: QueueCallback | None = None,
+) -> str:
+    """
+    Генерация уточняющих вопросов по товару.
+    Вопросы почти одинаковы для всех товаров одной категории, поэтому
+    кэшируются по категории (главное существительное + маркетплейс).
+    """
+    key = _questions_cache_key(marketplace, product_name, plan)
+    if key and use_cache:
+        cached = await response_cache.get(key)
+        if cached is not None:
+            return cached[0]
+
     try:
-        response = await client.chat.completions.create(
-            model=config.openai_model,
-            messages=[
+        result = await _complete(
+            "questions",
+            [
                 {
                     "role": "user",
                     "content": QUESTIONS_PROMPT.format(
@@ -119,24 +337,46 @@ async def generate_questions(marketplace: str, product_name: str) -> str:
                     ),
                 }
             ],
-            temperature=0.6,
-            max_tokens=500,
+            plan=plan,
+            on_queued=on_queued,
         )
-        return response.choices[0].message.content
     except Exception as e:
         logger.error(f"Error generating questions: {e}")
         raise
+    if key and result.text:
+        await response_cache.put(key, result.text, result.tokens_in, result.tokens_out)
+    return result.text
 
 
 async def generate_card(
     marketplace: str,
     product_name: str,
     details: str = "",
-) -> tuple[str, int, int]:
+    on_progress: ProgressCallback | None = None,
+    use_cache: bool = True,
+    plan: str = "free",
+    on_queued: QueueCallback | None = None,
+    task: str = "card",
+) -> Completion:
     """
     Генерация карточки товара.
-    Возвращает (текст, токены_вход, токены_выход).
+    on_progress получает частичный текст по мере генерации.
+    task — маршрут: "card" или "bulk" (массовая генерация, без запасных вариантов).
+    Одинаковые запросы отдаются из кэша с нулевым расходом токенов;
+    use_cache=False — всегда новый вариант (и он тоже попадает в кэш).
+    При config.structured_cards карточка приходит JSON по CARD_SCHEMA.
     """
+    structured = config.structured_cards
+    fmt = FORMAT_CARD if structured else FORMAT_TEXT
+    cache_key = None
+    if config.response_cache_enabled:
+        model = config.route(task, plan)["model"]
+        cache_key = make_key("card.json" if structured else "card", model, marketplace, product_name, details)
+        if use_cache:
+            cached = await response_cache.get(cache_key)
+            if cached is not None:
+                return Completion(cached[0], 0, 0, CACHE_MODEL, 0, result_format=fmt)
+
     details_block = ""
     if details:
         details_block = f"Детали от продавца:\n{details}"
@@ -145,24 +385,26 @@ async def generate_card(
         marketplace=marketplace,
         product_name=product_name,
         details_block=details_block,
+        format_block=JSON_FORMAT if structured else TEXT_FORMAT,
     )
 
     try:
-        response = await client.chat.completions.create(
-            model=config.openai_model,
-            messages=[
+        result = await _complete(
+            task,
+            [
                 {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user", "content": user_prompt},
             ],
-            temperature=0.7,
-            max_tokens=2000,
+            on_progress=_partial_progress(on_progress) if structured else on_progress,
+            plan=plan,
+            on_queued=on_queued,
+            schema=("card", CARD_SCHEMA) if structured else None,
         )
-
-        text = response.choices[0].message.content
-        tokens_in = response.usage.prompt_tokens if response.usage else 0
-        tokens_out = response.usage.completion_tokens if response.usage else 0
-
-        return text, tokens_in, tokens_out
+        if structured:
+            result = _structured(result, marketplace)
+        if cache_key and result.text and result.result_format == fmt:
+            await response_cache.put(cache_key, result.text, result.tokens_in, result.tokens_out)
+        return result
 
     except openai.APIError as e:
         logger.error(f"OpenAI API error: {e}")
@@ -175,7 +417,10 @@ async def generate_card(
 async def analyze_competitor(
     competitor_text: str,
     marketplace: str,
-) -> tuple[str, int, int]:
+    on_progress: ProgressCallback | None = None,
+    plan: str = "free",
+    on_queued: QueueCallback | None = None,
+) -> Completion:
     """Анализ карточки конкурента."""
     user_prompt = COMPETITOR_PROMPT.format(
         competitor_text=competitor_text,
@@ -183,22 +428,17 @@ async def analyze_competitor(
     )
 
     try:
-        response = await client.chat.completions.create(
-            model=config.openai_model,
-            messages=[
+        return await _complete(
+            "competitor",
+            [
                 {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user", "content": user_prompt},
             ],
-            temperature=0.7,
-            max_tokens=2500,
+            on_progress=on_progress,
+            plan=plan,
+            on_queued=on_queued,
         )
 
-        text = response.choices[0].message.content
-        tokens_in = response.usage.prompt_tokens if response.usage else 0
-        tokens_out = response.usage.completion_tokens if response.usage else 0
-
-        return text, tokens_in, tokens_out
-
     except Exception as e:
         logger.error(f"Error in analyze_competitor: {e}")
         raise
@@ -208,31 +448,71 @@ async def rewrite_card(
     original_text: str,
     style: str,
     marketplace: str,
-) -> tuple[str, int, int]:
-    """Перегенерация карточки в другом стиле."""
+    on_progress: ProgressCallback | None = None,
+    plan: str = "free",
+    on_queued: QueueCallback | None = None,
+) -> Completion:
+    """Перегенерация карточки в другом стиле. original_text — карточка в текстовом виде."""
+    structured = config.structured_cards
     user_prompt = REWRITE_PROMPT.format(
         original_text=original_text,
         style=style,
         marketplace=marketplace,
+        format_block=JSON_FORMAT if structured else REWRITE_TEXT_FORMAT,
     )
 
     try:
-        response = await client.chat.completions.create(
-            model=config.openai_model,
-            messages=[
+        result = await _complete(
+            "rewrite",
+            [
                 {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user", "content": user_prompt},
             ],
-            temperature=0.8,
-            max_tokens=2000,
+            on_progress=_partial_progress(on_progress) if structured else on_progress,
+            plan=plan,
+            on_queued=on_queued,
+            schema=("card", CARD_SCHEMA) if structured else None,
         )
+        return _structured(result, marketplace) if structured else result
 
-        text = response.choices[0].message.content
-        tokens_in = response.usage.prompt_tokens if response.usage else 0
-        tokens_out = response.usage.completion_tokens if response.usage else 0
+    except Exception as e:
+        logger.error(f"Error in rewrite_card: {e}")
+        raise
 
-        return text, tokens_in, tokens_out
+
+async def regenerate_field(
+    card_json: str,
+    field: str,
+    marketplace: str,
+    plan: str = "free",
+    on_queued: QueueCallback | None = None,
+) -> Completion:
+    """
+    Новый заголовок (field="title") или ключевые слова (field="keywords")
+    для структурированной карточки card_json (Card.dump()). Модель пишет
+    только этот раздел, остальное переносится без изменений.
+    """
+    card = Card.load(card_json)
+    user_prompt = FIELD_PROMPT.format(
+        marketplace=marketplace,
+        card_text=card.plain(),
+        instruction=FIELD_INSTRUCTIONS[field].format(limit=TITLE_LIMITS.get(marketplace, 100)),
+    )
+
+    try:
+        result = await _complete(
+            "field",
+            [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt},
+            ],
+            plan=plan,
+            on_queued=on_queued,
+            schema=(field, FIELD_SCHEMAS[field]),
+        )
+        updated = card.with_field(field, result.text, marketplace)
+        return result._replace(text=updated.dump(), result_format=FORMAT_CARD)
 
     except Exception as e:
-        logger.error(f"Error in rewrite_card: {e}")
+        logger.error(f"Error in regenerate_field({field}): {e}")
         raise
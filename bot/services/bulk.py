@@ -0,0 +1,462 @@
+import asyncio
+import csv
+import itertools
+import logging
+import os
+import random
+import time
+from typing import AsyncIterator, Iterator, NamedTuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import FSInputFile
+
+from bot.config import config
+from bot.database.db import (
+    get_active_subscription, get_bulk_job, get_bulk_progress, get_running_bulk_jobs,
+    iter_bulk_results, save_bulk_error, update_bulk_job,
+)
+from bot.database.quota import reserve_quota
+from bot.keyboards.inline import bulk_cancel_kb
+from bot.services.ai_service import generate_card
+from bot.services.card_format import FORMAT_CARD, Card
+from bot.services.llm_client import LLMUnavailable, is_retryable
+from bot.services.llm_scheduler import LLMOverloaded
+
+try:
+    import openpyxl
+    XLSX_AVAILABLE = True
+except ImportError:
+    openpyxl = None
+    XLSX_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Заголовки столбцов (в нижнем регистре), которые понимаем
+COLUMNS = {
+    "marketplace": {"marketplace", "mp", "маркетплейс", "площадка"},
+    "product_name": {"product", "product_name", "name", "товар", "название", "наименование"},
+    "details": {"details", "description", "детали", "описание", "характеристики"},
+}
+MARKETPLACES = {
+    "wb": "Wildberries", "wildberries": "Wildberries", "вб": "Wildberries", "вайлдберриз": "Wildberries",
+    "ozon": "Ozon", "озон": "Ozon",
+}
+RESULT_HEADER = [
+    "Маркетплейс", "Товар", "Детали", "Заголовок", "Описание",
+    "Ключевые слова", "Характеристики", "Ошибка",
+]
+
+
+class BulkFileError(ValueError):
+    """Файл нельзя обработать; текст — для пользователя."""
+
+
+class BulkRow(NamedTuple):
+    row_no: int
+    marketplace: str  # пусто — маркетплейс задания
+    product_name: str
+    details: str
+
+
+# ── Чтение файла ──
+
+def _csv_format(path: str) -> tuple[str, str]:
+    """Кодировка и разделитель: Excel в России сохраняет CSV в cp1251 и через «;»."""
+    with open(path, "rb") as f:
+        head = f.read(64 * 1024)
+    try:
+        head.decode("utf-8")
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError as e:
+        # Ошибка в самом конце — просто обрезанный многобайтный символ
+        encoding = "utf-8-sig" if e.start >= len(head) - 3 else "cp1251"
+    sample = head.decode(encoding, errors="ignore")
+    try:
+        delimiter = csv.Sniffer().sniff(sample, delimiters=",;\t").delimiter
+    except csv.Error:
+        delimiter = ";" if sample.count(";") > sample.count(",") else ","
+    return encoding, delimiter
+
+
+def _cells(path: str) -> Iterator[list[str]]:
+    if path.endswith(".xlsx"):
+        if not XLSX_AVAILABLE:
+            raise BulkFileError("XLSX сейчас не поддерживается — сохраните таблицу как CSV.")
+        book = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            for values in book.active.iter_rows(values_only=True):
+                yield ["" if v is None else str(v) for v in values]
+        finally:
+            book.close()
+        return
+    encoding, delimiter = _csv_format(path)
+    with open(path, encoding=encoding, newline="") as f:
+        yield from csv.reader(f, delimiter=delimiter)
+
+
+def read_rows(path: str) -> Iterator[BulkRow]:
+    """
+    Строки файла по одной. Первая непустая строка — заголовок; пустые строки
+    пропускаются, номера строк (с 0) от запуска к запуску одинаковые.
+    """
+    rows = _cells(path)
+    columns = None
+    for cells in rows:
+        if any(c.strip() for c in cells):
+            columns = _map_columns(cells)
+            break
+    if columns is None:
+        raise BulkFileError("Файл пустой.")
+
+    def cell(cells: list[str], name: str) -> str:
+        index = columns.get(name)
+        return cells[index].strip() if index is not None and index < len(cells) else ""
+
+    row_no = 0
+    for cells in rows:
+        if not any(c.strip() for c in cells):
+            continue
+        yield BulkRow(row_no, cell(cells, "marketplace"), cell(cells, "product_name"), cell(cells, "details"))
+        row_no += 1
+
+
+async def aread_rows(path: str, batch: int = 200) -> AsyncIterator[BulkRow]:
+    """read_rows в отдельном потоке пачками — большой файл не блокирует цикл событий."""
+    rows = read_rows(path)
+    try:
+        while True:
+            chunk = await asyncio.to_thread(list, itertools.islice(rows, batch))
+            if not chunk:
+                return
+            for row in chunk:
+                yield row
+    finally:
+        rows.close()
+
+
+def _map_columns(header: list[str]) -> dict[str, int]:
+    columns = {}
+    for index, title in enumerate(header):
+        title = title.strip().lower()
+        for name, aliases in COLUMNS.items():
+            if title in aliases and name not in columns:
+                columns[name] = index
+    if "product_name" not in columns:
+        raise BulkFileError(
+            "Не нашёл столбец с названием товара. Первая строка файла — заголовки: "
+            "«Маркетплейс», «Товар», «Детали»."
+        )
+    return columns
+
+
+def inspect_file(path: str, max_rows: int) -> int:
+    """Проверяет файл и считает строки (одним проходом, без загрузки в память)."""
+    total = 0
+    for _ in read_rows(path):
+        total += 1
+        if total > max_rows:
+            raise BulkFileError(f"Слишком много строк — максимум {max_rows}. Разбейте файл на части.")
+    if total == 0:
+        raise BulkFileError("В файле нет строк с товарами.")
+    return total
+
+
+# ── Файл результата ──
+
+class _ResultWriter:
+    """Результат в том же формате, что и исходный файл: построчно, без накопления."""
+
+    def __init__(self, path: str):
+        self.path = path
+        if path.endswith(".xlsx"):
+            self._book = openpyxl.Workbook(write_only=True)
+            self._sheet = self._book.create_sheet("Карточки")
+            self._file = None
+        else:
+            self._book = None
+            # utf-8 с BOM и «;» — так Excel откроет файл без мастера импорта
+            self._file = open(path, "w", encoding="utf-8-sig", newline="")
+            self._csv = csv.writer(self._file, delimiter=";")
+
+    def write(self, values: list[str]):
+        if self._book is not None:
+            self._sheet.append(values)
+        else:
+            self._csv.writerow(values)
+
+    def close(self):
+        if self._book is not None:
+            self._book.save(self.path)
+        else:
+            self._file.close()
+
+
+def _result_cells(text: str, fmt: int) -> list[str]:
+    """Заголовок, описание, ключевые слова, характеристики."""
+    if fmt == FORMAT_CARD:
+        card = Card.load(text)
+        attributes = "\n".join(f"{name}: {value}" for name, value in card.attributes)
+        return [card.title, card.description, ", ".join(card.keywords), attributes]
+    return ["", text, "", ""]
+
+
+async def write_result(source: str, path: str, default_marketplace: str, results: AsyncIterator) -> None:
+    """Сливает строки исходного файла с результатами (оба потока идут по возрастанию row_no)."""
+    writer = _ResultWriter(path)
+    try:
+        writer.write(RESULT_HEADER)
+        result = await anext(results, None)
+        async for row in aread_rows(source):
+            while result is not None and result[0] < row.row_no:
+                result = await anext(results, None)
+            cells = ["", "", "", "", "не обработано"]
+            if result is not None and result[0] == row.row_no:
+                _, text, fmt, error = result
+                cells = _result_cells(text, fmt) + [""] if error is None else ["", "", "", "", error]
+            marketplace = MARKETPLACES.get(row.marketplace.lower(), row.marketplace) or default_marketplace
+            writer.write([marketplace, row.product_name, row.details] + cells)
+    finally:
+        # Сохранение XLSX — запись всего файла, не в цикле событий
+        await asyncio.to_thread(writer.close)
+
+
+# ── Выполнение ──
+
+class _Job:
+    """Одно задание: производитель читает строки, concurrency воркеров генерируют."""
+
+    def __init__(self, runner: "BulkRunner", bot: Bot, job: dict):
+        self.runner = runner
+        self.bot = bot
+        self.job = job
+        self.id = job["id"]
+        self.plan = "free"
+        self.done = self.failed = 0
+        # Готовые строки после next_row; next_row двигается по непрерывному префиксу
+        self.next_row = job["next_row"]
+        self.finished: set[int] = set()
+        self.stopped: str | None = None  # "limit" | "cancelled"
+        self._next_report = 0.0
+
+    async def run(self):
+        self.plan = await get_active_subscription(self.job["user_id"])
+        self.done, self.failed, self.finished = await get_bulk_progress(self.id, self.next_row)
+        self._advance()
+
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.runner.concurrency)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.runner.concurrency)]
+        try:
+            async for row in aread_rows(self.job["source"]):
+                if self.stopped:
+                    break
+                if row.row_no < self.next_row or row.row_no in self.finished:
+                    continue
+                await queue.put(row)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            # Прогресс сохраняется и при остановке бота — продолжим с этого места
+            await update_bulk_job(self.id, next_row=self.next_row)
+
+        status = self.stopped or "done"
+        await self._report(final=True)
+        await self._send_result(status)
+        await update_bulk_job(self.id, status=status)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            row = await queue.get()
+            if row is None:
+                return
+            if self.stopped:
+                continue  # строка не обработана — next_row через неё не перейдёт
+            await self._process(row)
+            self.finished.add(row.row_no)
+            self._advance()
+            await self._maybe_report()
+
+    async def _process(self, row: BulkRow):
+        marketplace = MARKETPLACES.get(row.marketplace.lower()) if row.marketplace else self.job["marketplace"]
+        error = None
+        if not row.product_name:
+            error = "нет названия товара"
+        elif len(row.product_name) > 500:
+            error = "название длиннее 500 символов"
+        elif marketplace is None:
+            error = f"неизвестный маркетплейс «{row.marketplace}»"
+        if error:
+            await save_bulk_error(self.id, row.row_no, error)
+            self.failed += 1
+            return
+
+        attempt = 0
+        while not self.stopped:
+            quota = await reserve_quota(self.job["user_id"])
+            if not quota.allowed:
+                self.stopped = "limit"
+                return
+            try:
+                card = await generate_card(
+                    marketplace, row.product_name, row.details[:3000], plan=self.plan, task="bulk",
+                )
+                await quota.commit(
+                    marketplace=marketplace, category="каталог", product_name=row.product_name,
+                    bulk_row=(self.id, row.row_no), **card.usage(),
+                )
+                self.done += 1
+                return
+            except LLMOverloaded:
+                # Очередь к модели переполнена — строка подождёт, лимит не списан
+                await asyncio.sleep(config.llm_aging_seconds)
+            except Exception as e:
+                if isinstance(e, LLMUnavailable) or is_retryable(e):
+                    # Таймаут, 429, недоступный API — не ошибка строки: ждём и повторяем,
+                    # пока задание не остановят
+                    delay = min(60.0, 5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+                    attempt += 1
+                    logger.warning(f"Bulk job {self.id} row {row.row_no} transient error, retry in {delay:.0f}s: {e!r}")
+                    await asyncio.sleep(delay)
+                    continue
+                logger.warning(f"Bulk job {self.id} row {row.row_no} failed: {e!r}")
+                await save_bulk_error(self.id, row.row_no, "ошибка генерации")
+                self.failed += 1
+                return
+            finally:
+                await quota.release()
+
+    def _advance(self):
+        while self.next_row in self.finished:
+            self.finished.remove(self.next_row)
+            self.next_row += 1
+
+    async def _maybe_report(self):
+        now = time.monotonic()
+        if now < self._next_report:
+            return
+        self._next_report = now + self.runner.progress_interval
+        await update_bulk_job(self.id, next_row=self.next_row)
+        await self._report()
+
+    async def _report(self, final: bool = False):
+        if not self.job.get("message_id"):
+            return
+        total = self.job["total"]
+        text = (
+            f"📦 <b>Каталог: {self.job['file_name']}</b>\n\n"
+            f"✅ Готово: {self.done} из {total}\n"
+            f"❌ Ошибок: {self.failed}"
+        )
+        if final:
+            text += "\n\n" + {
+                "limit": "⚠️ Лимит генераций исчерпан — обработана часть строк.",
+                "cancelled": "⏹ Остановлено.",
+            }.get(self.stopped, "🏁 Готово.")
+        else:
+            text += "\n\n<i>Файл с результатом придёт сюда, когда всё будет готово.</i>"
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=self.job["chat_id"], message_id=self.job["message_id"],
+                reply_markup=None if final else bulk_cancel_kb(self.id), parse_mode="HTML",
+            )
+        except TelegramRetryAfter as e:
+            self._next_report = time.monotonic() + e.retry_after
+        except TelegramBadRequest as e:
+            logger.debug(f"Bulk progress edit skipped: {e}")
+        except Exception as e:
+            logger.warning(f"Bulk progress edit failed: {e}")
+
+    async def _send_result(self, status: str):
+        source = self.job["source"]
+        ext = os.path.splitext(source)[1]
+        path = os.path.join(self.runner.directory, f"{self.id}-result{ext}")
+        try:
+            await write_result(source, path, self.job["marketplace"], iter_bulk_results(self.id))
+            stem = os.path.splitext(self.job["file_name"])[0]
+            await self.bot.send_document(
+                self.job["chat_id"],
+                FSInputFile(path, filename=f"{stem}-карточки{ext}"),
+                caption=f"📦 Карточки: {self.done}, ошибок: {self.failed}",
+            )
+        except Exception as e:
+            logger.error(f"Bulk job {self.id} result ({status}) not delivered: {e}")
+        finally:
+            for leftover in (path, source):
+                try:
+                    os.remove(leftover)
+                except OSError:
+                    pass
+
+
+class BulkRunner:
+    """
+    Выполняет задания массовой генерации (таблица bulk_jobs).
+    Строки читаются из файла по одной и через очередь размера concurrency
+    идут в concurrency воркеров — память не зависит от размера файла.
+    Готовая строка записывается в bulk_rows в одной транзакции с генерацией
+    и списанием лимита (log_generation(bulk_row=...)), поэтому после рестарта
+    задание продолжается с next_row, а уже готовые строки не списываются дважды.
+    """
+
+    def __init__(self, directory: str, concurrency: int, progress_interval: float):
+        self.directory = directory
+        self.concurrency = max(1, concurrency)
+        self.progress_interval = progress_interval
+        self._jobs: dict[int, tuple[_Job, asyncio.Task]] = {}
+
+    def start(self, bot: Bot, job: dict):
+        if job["id"] in self._jobs:
+            return
+        runner_job = _Job(self, bot, job)
+        task = asyncio.create_task(runner_job.run(), name=f"bulk-{job['id']}")
+        self._jobs[job["id"]] = (runner_job, task)
+        task.add_done_callback(lambda t: self._finished(job["id"], t))
+
+    def _finished(self, job_id: int, task: asyncio.Task):
+        self._jobs.pop(job_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Bulk job {job_id} crashed: {task.exception()!r}")
+            asyncio.ensure_future(update_bulk_job(job_id, status="failed"))
+
+    async def resume(self, bot: Bot) -> int:
+        """Продолжает задания, прерванные остановкой бота."""
+        jobs = await get_running_bulk_jobs()
+        for job in jobs:
+            self.start(bot, job)
+        return len(jobs)
+
+    async def start_job(self, bot: Bot, job_id: int):
+        job = await get_bulk_job(job_id)
+        if job is not None:
+            self.start(bot, job)
+
+    def cancel(self, job_id: int) -> bool:
+        """Останавливает задание после текущих строк; готовая часть придёт файлом."""
+        entry = self._jobs.get(job_id)
+        if entry is None:
+            return False
+        entry[0].stopped = "cancelled"
+        return True
+
+    async def stop(self):
+        """Прерывает задания при остановке бота; статус остаётся running."""
+        tasks = [task for _, task in self._jobs.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._jobs),
+            "rows_done": sum(job.done for job, _ in self._jobs.values()),
+        }
+
+
+bulk_runner = BulkRunner(
+    directory=config.bulk_dir,
+    concurrency=config.bulk_concurrency,
+    progress_interval=config.bulk_progress_interval,
+)
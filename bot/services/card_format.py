@@ -0,0 +1,220 @@
+import html
+import json
+import re
+from dataclasses import dataclass, field, replace
+
+# generation_bodies.format
+FORMAT_TEXT = 0   # свободный текст модели, выводится как есть
+FORMAT_CARD = 1   # Card.dump()
+
+# Длина заголовка, символов
+TITLE_LIMITS = {"Wildberries": 100, "Ozon": 150}
+
+_STRING = {"type": "string"}
+
+CARD_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": _STRING,
+        "description": _STRING,
+        "keywords": {"type": "array", "items": _STRING},
+        "attributes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"name": _STRING, "value": _STRING},
+                "required": ["name", "value"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["title", "description", "keywords", "attributes"],
+    "additionalProperties": False,
+}
+
+# Схемы для перегенерации одного раздела
+FIELD_SCHEMAS = {
+    "title": {
+        "type": "object",
+        "properties": {"title": _STRING},
+        "required": ["title"],
+        "additionalProperties": False,
+    },
+    "keywords": {
+        "type": "object",
+        "properties": {"keywords": CARD_SCHEMA["properties"]["keywords"]},
+        "required": ["keywords"],
+        "additionalProperties": False,
+    },
+}
+
+
+def response_format(name: str, schema: dict) -> dict:
+    """response_format для chat.completions со строгой JSON-схемой."""
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+# Служебные слова, на которых заголовок не должен обрываться
+_TAIL_WORDS = {"и", "или", "в", "во", "на", "для", "с", "со", "из", "по", "от", "до", "под", "без", "к", "о"}
+
+
+def fit_title(title: str, marketplace: str) -> str:
+    """Обрезает заголовок до лимита маркетплейса по границе слова — без запроса к модели."""
+    limit = TITLE_LIMITS.get(marketplace)
+    if limit is None or len(title) <= limit:
+        return title
+    words = title[:limit + 1].split()
+    if len(title) > limit and title[limit] not in " ,":
+        words = words[:-1]  # последнее слово разрезано лимитом
+    while words and (words[-1].lower() in _TAIL_WORDS or not words[-1].strip(",;:-–—")):
+        words.pop()
+    return " ".join(words).rstrip(",;:-–— ") or title[:limit]
+
+
+@dataclass
+class Card:
+    title: str
+    description: str
+    keywords: list[str] = field(default_factory=list)
+    attributes: list[tuple[str, str]] = field(default_factory=list)
+
+    @classmethod
+    def parse(cls, raw: str, marketplace: str = "") -> "Card | None":
+        """Ответ модели по CARD_SCHEMA; None, если это не карточка. Заголовок подгоняется под лимит."""
+        try:
+            data = json.loads(raw)
+            card = cls(
+                title=fit_title(" ".join(data["title"].split()), marketplace),
+                description=data["description"].strip(),
+                keywords=_clean_keywords(data.get("keywords") or []),
+                attributes=[
+                    (a["name"].strip(), a["value"].strip())
+                    for a in data.get("attributes") or []
+                    if a.get("name", "").strip() and a.get("value", "").strip()
+                ],
+            )
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return None
+        return card if card.title and card.description else None
+
+    def with_field(self, name: str, raw: str, marketplace: str = "") -> "Card":
+        """Копия с разделом name из ответа модели по FIELD_SCHEMAS; ValueError, если ответ пустой."""
+        try:
+            value = json.loads(raw)[name]
+            if name == "title":
+                value = fit_title(" ".join(value.split()), marketplace)
+            else:
+                value = _clean_keywords(value)
+        except (TypeError, KeyError, AttributeError) as e:
+            raise ValueError(f"Bad {name} answer: {raw[:100]!r}") from e
+        if not value:
+            raise ValueError(f"Empty {name} answer")
+        return replace(self, **{name: value})
+
+    def dump(self) -> str:
+        """
+        Для хранения: короткие ключи, без пробелов. Каждый элемент на своей
+        строке — словарь сжатия тел учится на повторяющихся строках, а
+        ключевые слова и характеристики между карточками повторяются часто.
+        """
+        return json.dumps(
+            {"t": self.title, "d": self.description, "k": self.keywords, "a": self.attributes},
+            ensure_ascii=False, indent=0, separators=(",", ":"),
+        )
+
+    @classmethod
+    def load(cls, text: str) -> "Card":
+        data = json.loads(text)
+        return cls(data["t"], data["d"], data["k"], [tuple(a) for a in data["a"]])
+
+    def plain(self) -> str:
+        """Прежний текстовый вид карточки — для копирования и как вход для переписывания."""
+        parts = [
+            f"📌 ЗАГОЛОВОК:\n{self.title}",
+            f"📝 ОПИСАНИЕ:\n{self.description}",
+            f"🔑 КЛЮЧЕВЫЕ СЛОВА:\n{', '.join(self.keywords)}",
+        ]
+        if self.attributes:
+            attributes = "\n".join(f"{name}: {value}" for name, value in self.attributes)
+            parts.append(f"📋 РЕКОМЕНДУЕМЫЕ ХАРАКТЕРИСТИКИ:\n{attributes}")
+        return "\n\n".join(parts)
+
+    def render(self, marketplace: str | None = None) -> str:
+        """HTML для сообщения; у заголовка — длина относительно лимита маркетплейса."""
+        e = html.escape
+        title_head = "📌 <b>ЗАГОЛОВОК:</b>"
+        limit = TITLE_LIMITS.get(marketplace or "")
+        if limit:
+            mark = "" if len(self.title) <= limit else " ⚠️"
+            title_head += f" <i>{len(self.title)}/{limit}{mark}</i>"
+        parts = [
+            f"{title_head}\n{e(self.title)}",
+            f"📝 <b>ОПИСАНИЕ:</b>\n{e(self.description)}",
+            f"🔑 <b>КЛЮЧЕВЫЕ СЛОВА:</b>\n{e(', '.join(self.keywords))}",
+        ]
+        if self.attributes:
+            attributes = "\n".join(f"{e(name)}: {e(value)}" for name, value in self.attributes)
+            parts.append(f"📋 <b>РЕКОМЕНДУЕМЫЕ ХАРАКТЕРИСТИКИ:</b>\n{attributes}")
+        return "\n\n".join(parts)
+
+
+def _clean_keywords(items: list) -> list[str]:
+    """Без пустых и повторов, порядок модели (от частотных к редким) сохраняется."""
+    seen, result = set(), []
+    for item in items:
+        keyword = " ".join(str(item).split()).strip(" ,.")
+        if keyword and keyword.lower() not in seen:
+            seen.add(keyword.lower())
+            result.append(keyword)
+    return result
+
+
+def render_text(text: str, fmt: int, marketplace: str | None = None) -> str:
+    """Тело генерации → HTML сообщения."""
+    if fmt == FORMAT_CARD:
+        return Card.load(text).render(marketplace)
+    return text
+
+
+def plain_text(text: str, fmt: int) -> str:
+    if fmt == FORMAT_CARD:
+        return Card.load(text).plain()
+    return text
+
+
+# ── Частичный ответ при потоковой выдаче ──
+
+_STRING_TAIL = re.compile(r'(?:[^"\\]|\\.)*')
+
+
+def _partial_string(raw: str, key: str) -> str | None:
+    """Значение строкового поля, даже если кавычка ещё не закрыта."""
+    match = re.search(rf'"{key}"\s*:\s*"', raw)
+    if not match:
+        return None
+    body = _STRING_TAIL.match(raw, match.end()).group()
+    if body.endswith("\\") and not body.endswith("\\\\"):
+        body = body[:-1]  # escape-последовательность пришла наполовину
+    try:
+        return json.loads(f'"{body}"')
+    except ValueError:
+        return body
+
+
+def render_partial(raw: str) -> str:
+    """
+    Текстовый вид недописанного JSON для сообщения ожидания: заголовок
+    и описание по мере поступления, ключевые слова — уже законченные.
+    """
+    parts = []
+    title = _partial_string(raw, "title")
+    if title is not None:
+        parts.append(f"📌 ЗАГОЛОВОК:\n{title}")
+    description = _partial_string(raw, "description")
+    if description is not None:
+        parts.append(f"📝 ОПИСАНИЕ:\n{description}")
+    match = re.search(r'"keywords"\s*:\s*\[([^\]]*)', raw)
+    if match:
+        keywords = [json.loads(f'"{k}"') for k in re.findall(r'"((?:[^"\\]|\\.)*)"', match.group(1))]
+        parts.append(f"🔑 КЛЮЧЕВЫЕ СЛОВА:\n{', '.join(keywords)}")
+    return "\n\n".join(parts)
@@ -0,0 +1,66 @@
+import re
+
+try:
+    import pymorphy3
+except ImportError:  # морфология необязательна — без неё работает отсечение окончаний
+    pymorphy3 = None
+
+_WORD = re.compile(r"[а-яё]+")
+
+# Слова-обёртки: «набор кастрюль» — это про кастрюли
+_WRAPPERS = {"набор", "комплект", "пара", "упаковка", "коробка", "сет", "лот"}
+_STOPWORDS = {"для", "без", "под", "над", "при", "про", "или", "шт", "штук"}
+
+_ADJ_ENDINGS = (
+    "ый", "ий", "ой", "ая", "яя", "ое", "ее", "ые", "ие",
+    "ого", "его", "ому", "ему", "ую", "юю", "ых", "их", "ым", "им",
+)
+_NOUN_ENDINGS = sorted(
+    ("ами", "ями", "ов", "ев", "ей", "ам", "ям", "ах", "ях", "ом", "ем",
+     "а", "я", "ы", "и", "е", "о", "у", "ю", "ь", "й"),
+    key=len, reverse=True,
+)
+
+_morph = pymorphy3.MorphAnalyzer() if pymorphy3 else None
+
+
+def _stem(word: str) -> str:
+    for ending in _NOUN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[: -len(ending)]
+    return word
+
+
+def _is_noun(word: str) -> bool:
+    if _morph is not None:
+        return "NOUN" in _morph.parse(word)[0].tag
+    return not word.endswith(_ADJ_ENDINGS)
+
+
+def _lemma(word: str) -> str:
+    if _morph is not None:
+        return _morph.parse(word)[0].normal_form
+    return _stem(word)
+
+
+def head_noun(product_name: str) -> str | None:
+    """Главное существительное названия в начальной форме (или его основа без словаря)."""
+    words = [
+        w for w in _WORD.findall(product_name.lower().replace("ё", "е"))
+        if len(w) >= 3 and w not in _STOPWORDS
+    ]
+    nouns = [w for w in words if _is_noun(w)]
+    if not nouns:
+        return None
+    head = _lemma(nouns[0])
+    if head in _WRAPPERS and len(nouns) > 1:
+        head = _lemma(nouns[1])
+    return head
+
+
+def category_key(marketplace: str, product_name: str) -> str | None:
+    """Ключ категории для кэша вопросов: «wildberries:чайник». None — категорию не определить."""
+    head = head_noun(product_name)
+    if head is None:
+        return None
+    return f"{marketplace.lower()}:{head}"
@@ -0,0 +1,291 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from aiogram import Bot
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+from bot.config import config
+from bot.database.db import (
+    claim_job, count_ready_jobs, create_job, extend_job, finish_job,
+    get_job_counts, has_ready_job, recover_jobs, retry_job, set_job_message,
+)
+from bot.services.llm_scheduler import PRIORITY, LLMOverloaded
+from bot.services.progress import ProgressEditor
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Job:
+    """Взятое воркером задание и всё, что нужно, чтобы ответить в чат."""
+    id: int
+    kind: str
+    user_id: int
+    chat_id: int
+    payload: dict
+    attempts: int
+    bot: Bot
+    state: FSMContext
+    message_id: int | None = None
+    # Генерация уже записана прошлой попыткой — модель вызывать не нужно
+    generation_id: int | None = None
+    _progress: ProgressEditor | None = field(default=None, repr=False)
+
+    async def answer(self, text: str, **kwargs):
+        return await self.bot.send_message(self.chat_id, text, **kwargs)
+
+    async def progress(self, text: str) -> ProgressEditor:
+        """
+        Сообщение ожидания с потоковым текстом. Создаётся при первом вызове;
+        после сбоя повторная попытка правит то же сообщение.
+        """
+        if self._progress is not None:
+            return self._progress
+        if self.message_id is None:
+            message = await self.answer(text, parse_mode="HTML")
+            self.message_id = message.message_id
+            await set_job_message(self.id, self.message_id)
+        else:
+            try:
+                await self.bot.edit_message_text(
+                    text, chat_id=self.chat_id, message_id=self.message_id, parse_mode="HTML",
+                )
+            except Exception as e:
+                logger.debug(f"Wait message of job {self.id} not reset: {e}")
+        self._progress = ProgressEditor(self.bot, self.chat_id, self.message_id)
+        return self._progress
+
+    async def finish_progress(self):
+        if self._progress is not None:
+            await self._progress.finish()
+
+    async def delete_wait(self):
+        """Убирает сообщение ожидания перед ответом."""
+        await self.finish_progress()
+        if self.message_id is None:
+            return
+        try:
+            await self.bot.delete_message(self.chat_id, self.message_id)
+        except Exception as e:
+            logger.debug(f"Wait message of job {self.id} not deleted: {e}")
+        self.message_id = None
+
+
+JobRunner = Callable[[Job], Awaitable[None]]
+FailureHandler = Callable[[Job, Exception], Awaitable[None]]
+
+
+class JobQueue:
+    """
+    Очередь заданий генерации в SQLite (таблица jobs) и пул воркеров.
+
+    Хэндлер ставит задание и сразу отвечает; воркер вызывает модель
+    и доставляет результат в чат. Доставка «хотя бы один раз»: взятое
+    задание скрыто на visibility_timeout и продлевается, пока идёт работа;
+    если процесс упал, после рестарта задание выполняется снова.
+    Повтор не списывает лимит дважды: генерация записывается с job_id
+    (log_generation), и следующая попытка только доставляет готовый текст.
+    Ошибка выполнения — повтор с задержкой, после max_attempts — on_failure.
+
+    Порядок выдачи — как в llm_scheduler: время постановки + ступень тарифа
+    * aging, так что pro не ждёт за пачкой бесплатных, а старые бесплатные
+    не голодают. Бесплатные задания не принимаются (LLMOverloaded), если
+    ждущих уже shed_depth. Задания берёт один диспетчер — когда есть
+    свободный воркер; пустую очередь он проверяет чтением, без записи.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        visibility_timeout: int,
+        max_attempts: int,
+        poll_interval: float,
+        aging: float,
+        shed_depth: int,
+    ):
+        self.workers = max(1, workers)
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.poll_interval = poll_interval
+        self.aging = aging
+        self.shed_depth = shed_depth
+        self._kinds: dict[str, tuple[JobRunner, FailureHandler | None]] = {}
+        self._dispatcher: asyncio.Task | None = None
+        self._running: set[asyncio.Task] = set()
+        self._slots = asyncio.Semaphore(self.workers)
+        self._wake = asyncio.Event()
+        self._bot: Bot | None = None
+        self._storage: BaseStorage | None = None
+        self.retried = 0
+        self.coalesced = 0
+        self.shed = 0
+
+    def register(self, kind: str, run: JobRunner, on_failure: FailureHandler | None = None):
+        self._kinds[kind] = (run, on_failure)
+
+    async def enqueue(
+        self,
+        kind: str,
+        user_id: int,
+        chat_id: int,
+        payload: dict,
+        plan: str = "free",
+        exclusive: bool = False,
+    ) -> int | None:
+        """
+        exclusive — одно задание вида kind на пользователя: пока прежнее ждёт
+        или выполняется, новое не ставится (None), его результат придёт в тот же чат.
+        LLMOverloaded — очередь переполнена, бесплатное задание не принято.
+        """
+        if kind not in self._kinds:
+            raise ValueError(f"Unknown job kind: {kind}")
+        plan = plan if plan in PRIORITY else "free"
+        if plan == "free" and await count_ready_jobs() >= self.shed_depth:
+            self.shed += 1
+            logger.warning(f"Job queue is {self.shed_depth}+ deep, shedding free {kind} job")
+            raise LLMOverloaded()
+        job_id = await create_job(
+            kind, user_id, chat_id, json.dumps(payload, ensure_ascii=False),
+            score=time.time() + PRIORITY[plan] * self.aging, exclusive=exclusive,
+        )
+        if job_id is None:
+            self.coalesced += 1
+            return None
+        self._wake.set()
+        return job_id
+
+    async def start(self, bot: Bot, storage: BaseStorage) -> int:
+        """Запускает воркеров; возвращает число заданий, прерванных прошлой остановкой."""
+        self._bot = bot
+        self._storage = storage
+        recovered = await recover_jobs()
+        self._dispatcher = asyncio.create_task(self._dispatch(), name="job-dispatcher")
+        return recovered
+
+    async def stop(self):
+        """Прерывает воркеров; взятые задания остаются running и выполнятся после рестарта."""
+        tasks = [*self._running, *([self._dispatcher] if self._dispatcher else [])]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dispatcher = None
+        self._running.clear()
+
+    async def _dispatch(self):
+        while True:
+            await self._slots.acquire()
+            try:
+                row = await self._next()
+            except BaseException:
+                self._slots.release()
+                raise
+            task = asyncio.create_task(self._work(row), name=f"job-{row['id']}")
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _next(self) -> dict:
+        """Ждёт и забирает следующее задание."""
+        while True:
+            # Сброс до проверки: задание, поставленное во время проверки, разбудит снова
+            self._wake.clear()
+            try:
+                if await has_ready_job():
+                    row = await claim_job(self.visibility_timeout)
+                    if row is not None:
+                        return row
+            except Exception as e:
+                logger.error(f"Job claim failed: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _work(self, row: dict):
+        try:
+            await self._execute(row)
+        except Exception as e:
+            # Задание останется running и вернётся в очередь по таймауту видимости
+            logger.error(f"Job {row['id']} bookkeeping failed: {e}")
+        finally:
+            self._slots.release()
+
+    async def _execute(self, row: dict):
+        run, on_failure = self._kinds.get(row["kind"], (None, None))
+        if run is None:
+            logger.error(f"Job {row['id']} has unknown kind {row['kind']!r}")
+            await finish_job(row["id"], "failed", error="unknown kind")
+            return
+
+        job = Job(
+            id=row["id"],
+            kind=row["kind"],
+            user_id=row["user_id"],
+            chat_id=row["chat_id"],
+            payload=json.loads(row["payload"]),
+            attempts=row["attempts"],
+            bot=self._bot,
+            state=FSMContext(
+                storage=self._storage,
+                key=StorageKey(bot_id=self._bot.id, chat_id=row["chat_id"], user_id=row["user_id"]),
+            ),
+            message_id=row["message_id"],
+            generation_id=row["generation_id"],
+        )
+        heartbeat = asyncio.create_task(self._heartbeat(job.id))
+        try:
+            await run(job)
+        except Exception as e:
+            await job.finish_progress()
+            error = f"{e!r}"[:500]
+            if job.attempts < self.max_attempts:
+                self.retried += 1
+                delay = int(2 ** job.attempts * random.uniform(1, 2))
+                logger.warning(f"Job {job.id} ({job.kind}) attempt {job.attempts} failed, retry in {delay}s: {error}")
+                await retry_job(job.id, delay, error)
+                return
+            logger.error(f"Job {job.id} ({job.kind}) failed after {job.attempts} attempts: {error}")
+            await finish_job(job.id, "failed", error)
+            if on_failure is not None:
+                try:
+                    await job.delete_wait()
+                    await on_failure(job, e)
+                except Exception as notify_error:
+                    logger.error(f"Job {job.id} failure notice not sent: {notify_error}")
+            return
+        finally:
+            heartbeat.cancel()
+        await finish_job(job.id, "done")
+
+    async def _heartbeat(self, job_id: int):
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            try:
+                await extend_job(job_id, self.visibility_timeout)
+            except Exception as e:
+                logger.warning(f"Job {job_id} visibility not extended: {e}")
+
+    async def stats(self) -> dict:
+        return {
+            **await get_job_counts(),
+            "workers": self.workers if self._dispatcher else 0,
+            "busy": len(self._running),
+            "retried": self.retried,
+            "coalesced": self.coalesced,
+            "shed": self.shed,
+        }
+
+
+job_queue = JobQueue(
+    workers=config.job_workers,
+    visibility_timeout=config.job_visibility_timeout,
+    max_attempts=config.job_max_attempts,
+    poll_interval=config.job_poll_interval,
+    aging=config.llm_aging_seconds,
+    shed_depth=config.llm_shed_queue_depth,
+)
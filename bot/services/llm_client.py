@@ -0,0 +1,355 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+import httpx
+import openai
+
+from bot.config import config
+
+try:
+    import h2  # noqa: F401 — нужен httpx для HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Коды, после которых имеет смысл повторить запрос
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMUnavailable(Exception):
+    """Все попытки и все эндпоинты исчерпаны."""
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, openai.APIConnectionError):  # включая APITimeoutError
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """
+    После threshold ошибок подряд эндпоинт выключается на cooldown секунд,
+    затем пропускает один пробный запрос: успех закрывает цепь, ошибка
+    снова открывает. Ответ API с ошибкой запроса (400 и т. п.) — тоже
+    признак живого эндпоинта. Пробный запрос, отменённый или упавший
+    без ответа API, только освобождает место пробы (release()).
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probe = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probe:
+            self._probe = True
+            return True
+        return False
+
+    def release(self):
+        """Проба завершилась без вывода о состоянии эндпоинта."""
+        self._probe = False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe = False
+
+    def failure(self):
+        self.failures += 1
+        self._probe = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+@dataclass
+class Endpoint:
+    name: str
+    client: openai.AsyncOpenAI
+    model: str | None = None
+    breaker: CircuitBreaker = field(default_factory=CircuitBreaker)
+    # Задержки успешных запросов по виду запроса — для порога хеджирования
+    latencies: dict[tuple, deque] = field(default_factory=dict)
+
+    def record(self, kind: tuple, seconds: float):
+        self.latencies.setdefault(kind, deque(maxlen=200)).append(seconds)
+
+    def percentile(self, kind: tuple, q: float, min_samples: int) -> float | None:
+        samples = self.latencies.get(kind)
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class LLMClient:
+    """
+    Обёртка над несколькими OpenAI-совместимыми эндпоинтами
+    с тем же вызовом, что и client.chat.completions.create(...).
+
+    - Повтор при сетевых ошибках, 429 и 5xx с экспоненциальной задержкой
+      и случайным разбросом; каждая следующая попытка идёт на следующий
+      доступный эндпоинт.
+    - У каждого эндпоинта свой CircuitBreaker. Если эндпоинт один, запрос
+      идёт на него и при открытой цепи (больше некуда) — цепь тогда
+      видна только в статистике.
+    - Хеджирование: если ответ (для stream — заголовки) не пришёл за p95
+      обычной задержки, параллельно отправляется второй запрос; берётся
+      тот, что ответит первым, второй отменяется.
+    """
+
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        http: httpx.AsyncClient | None = None,
+        connect_timeout: float = 5.0,
+        max_attempts: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        hedge: bool = True,
+        hedge_quantile: float = 0.95,
+        hedge_min_samples: int = 20,
+    ):
+        if not endpoints:
+            raise ValueError("LLMClient needs at least one endpoint")
+        self.endpoints = endpoints
+        self.http = http
+        self.connect_timeout = connect_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self._next = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _pick(self, exclude: Endpoint | None = None) -> tuple[Endpoint, bool]:
+        """
+        Следующий эндпоинт по кругу с закрытой цепью; если таких нет — просто
+        следующий. Второе значение — запрос будет пробным для полуоткрытой цепи.
+        """
+        n = len(self.endpoints)
+        for i in range(n):
+            endpoint = self.endpoints[(self._next + i) % n]
+            if endpoint is exclude and n > 1:
+                continue
+            half_open = endpoint.breaker.state == "half-open"
+            if endpoint.breaker.allow():
+                self._next = (self._next + i + 1) % n
+                return endpoint, half_open
+        endpoint = self.endpoints[self._next % n]
+        self._next = (self._next + 1) % n
+        return endpoint, False
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    async def create(self, **kwargs):
+        last_error: Exception | None = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                self.retries += 1
+                await asyncio.sleep(self._backoff(attempt - 1))
+            try:
+                return await self._hedged(kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                last_error = e
+                logger.warning(f"LLM attempt {attempt + 1}/{self.max_attempts} failed: {e!r}")
+        raise LLMUnavailable(f"All {self.max_attempts} attempts failed") from last_error
+
+    async def _call(self, endpoint: Endpoint, probe: bool, kind: tuple, kwargs: dict):
+        params = dict(kwargs)
+        if endpoint.model:
+            params["model"] = endpoint.model
+        deadline = None
+        if isinstance(params.get("timeout"), (int, float)):
+            # httpx ограничивает каждое чтение и соединение по отдельности;
+            # таймаут маршрута — общий срок ответа (для stream — заголовков)
+            deadline = params["timeout"]
+            params["timeout"] = httpx.Timeout(deadline, connect=self.connect_timeout)
+        started = time.monotonic()
+        try:
+            try:
+                async with asyncio.timeout(deadline):
+                    result = await endpoint.client.chat.completions.create(**params)
+            except TimeoutError as e:
+                request = httpx.Request("POST", endpoint.client.base_url.join("chat/completions"))
+                raise openai.APITimeoutError(request) from e
+        except Exception as e:
+            if is_retryable(e):
+                endpoint.breaker.failure()
+            elif isinstance(e, openai.APIStatusError):
+                # Эндпоинт ответил — ошибка в самом запросе
+                endpoint.breaker.success()
+            raise
+        finally:
+            # Отмена (проигравший хедж, остановка) или ошибка не от API не должны
+            # оставить цепь в пробе навсегда
+            if probe:
+                endpoint.breaker.release()
+        endpoint.breaker.success()
+        endpoint.record(kind, time.monotonic() - started)
+        return result
+
+    def _spawn(self, endpoint: Endpoint, probe: bool, kind: tuple, kwargs: dict) -> asyncio.Task:
+        task = asyncio.create_task(self._call(endpoint, probe, kind, kwargs))
+        if probe:
+            # Задача, отменённая до старта, не дойдёт до finally в _call
+            def release(t: asyncio.Task):
+                if t.cancelled():
+                    endpoint.breaker.release()
+            task.add_done_callback(release)
+        return task
+
+    async def _hedged(self, kwargs: dict):
+        kind = (kwargs.get("model"), kwargs.get("max_tokens"), bool(kwargs.get("stream")))
+        primary, probe = self._pick()
+        threshold = None
+        if self.hedge:
+            threshold = primary.percentile(kind, self.hedge_quantile, self.hedge_min_samples)
+        if threshold is None:
+            return await self._call(primary, probe, kind, kwargs)
+
+        first = self._spawn(primary, probe, kind, kwargs)
+        tasks = [first]
+        winner: asyncio.Task | None = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=threshold)
+            if not done:
+                self.hedges += 1
+                second, second_probe = self._pick(exclude=primary)
+                tasks.append(self._spawn(second, second_probe, kind, kwargs))
+
+            pending = set(tasks)
+            error: BaseException | None = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if task is not first:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if task is not winner:
+                    task.cancel()
+                    task.add_done_callback(_close_orphan)
+
+    async def warm_up(self):
+        """
+        Открывает (или поддерживает) соединение с каждым эндпоинтом лёгким
+        запросом списка моделей, чтобы TLS-рукопожатие не доставалось
+        первому пользователю. Ошибки не важны — важно соединение, поэтому
+        на ответ отводится только таймаут соединения.
+        """
+        async def ping(endpoint: Endpoint):
+            started = time.monotonic()
+            try:
+                async with asyncio.timeout(self.connect_timeout):
+                    await endpoint.client.models.list(timeout=self.connect_timeout)
+            except Exception as e:
+                logger.debug(f"Warm-up of {endpoint.name}: {e!r}")
+            return time.monotonic() - started
+
+        timings = await asyncio.gather(*(ping(e) for e in self.endpoints))
+        return {e.name: round(t * 1000) for e, t in zip(self.endpoints, timings)}
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "endpoints": {
+                e.name: {"state": e.breaker.state, "failures": e.breaker.failures}
+                for e in self.endpoints
+            },
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+def _close_orphan(task: asyncio.Task):
+    """Проигравший stream-запрос мог успеть открыть соединение — закрываем."""
+    if task.cancelled() or task.exception() is not None:
+        return
+    result = task.result()
+    if isinstance(result, openai.AsyncStream):
+        asyncio.ensure_future(result.close())
+
+
+def build_http_client() -> httpx.AsyncClient:
+    """Общий пул соединений для всех эндпоинтов."""
+    http2 = config.llm_http2 and HTTP2_AVAILABLE
+    if config.llm_http2 and not HTTP2_AVAILABLE:
+        logger.warning("LLM_HTTP2 is on but the h2 package is not installed, using HTTP/1.1")
+    return openai.DefaultAsyncHttpxClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=config.llm_pool_size,
+            max_keepalive_connections=config.llm_keepalive_connections,
+            keepalive_expiry=config.llm_keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(
+            config.llm_read_timeout,
+            connect=config.llm_connect_timeout,
+            pool=config.llm_connect_timeout,
+        ),
+    )
+
+
+def build_client() -> LLMClient:
+    http = build_http_client()
+    endpoints = [
+        Endpoint(
+            name=e.get("name") or e["base_url"],
+            client=openai.AsyncOpenAI(
+                api_key=e.get("api_key") or config.openai_api_key,
+                base_url=e["base_url"],
+                max_retries=0,  # повторы — на нашей стороне, с учётом всех эндпоинтов
+                http_client=http,
+            ),
+            model=e.get("model"),
+            breaker=CircuitBreaker(config.llm_breaker_threshold, config.llm_breaker_cooldown),
+        )
+        for e in config.openai_endpoints
+    ]
+    return LLMClient(
+        endpoints,
+        http=http,
+        connect_timeout=config.llm_connect_timeout,
+        max_attempts=config.llm_max_attempts,
+        backoff_base=config.llm_backoff_base,
+        hedge=config.llm_hedge,
+    )
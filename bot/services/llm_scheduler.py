@@ -0,0 +1,138 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
+
+from bot.config import config
+
+logger = logging.getLogger(__name__)
+
+# Чем меньше, тем раньше
+PRIORITY = {"pro": 0, "standard": 1, "free": 2}
+
+# Получает место в очереди (1 — следующий)
+QueueCallback = Callable[[int], Awaitable[None]]
+
+
+class LLMOverloaded(Exception):
+    """Очередь слишком длинная — бесплатный запрос не принят."""
+
+
+class LLMScheduler:
+    """
+    Ограничивает число одновременных запросов к модели и раздаёт
+    освободившиеся слоты по приоритету тарифа: pro > standard > free.
+
+    Старение: запрос ждёт в очереди с ключом enqueued_at + priority * aging,
+    то есть каждые aging секунд ожидания равны одной ступени тарифа —
+    бесплатный запрос, прождавший 2 * aging, пройдёт раньше только что
+    пришедшего pro. Бесплатные запросы отклоняются, если в очереди уже
+    shed_depth ожидающих.
+    """
+
+    def __init__(self, concurrency: int, aging: float, shed_depth: int):
+        self.concurrency = max(1, concurrency)
+        self.aging = aging
+        self.shed_depth = shed_depth
+        self._active = 0
+        self._heap: list[tuple[float, int, str, asyncio.Future]] = []
+        self._waiting = 0
+        self._seq = itertools.count()
+        # Последние времена ожидания по тарифам, секунд
+        self._waits: dict[str, deque[float]] = {plan: deque(maxlen=500) for plan in PRIORITY}
+        self.shed = 0
+        self.total = 0
+
+    @asynccontextmanager
+    async def slot(self, plan: str, on_queued: QueueCallback | None = None):
+        await self._acquire(plan, on_queued)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, plan: str, on_queued: QueueCallback | None):
+        plan = plan if plan in PRIORITY else "free"
+        started = time.monotonic()
+        if self._active < self.concurrency and not self._waiting:
+            self._active += 1
+            self._record(plan, 0.0)
+            return
+
+        if plan == "free" and self._waiting >= self.shed_depth:
+            self.shed += 1
+            logger.warning(f"LLM queue is {self._waiting} deep, shedding free request")
+            raise LLMOverloaded()
+
+        future = asyncio.get_running_loop().create_future()
+        score = started + PRIORITY[plan] * self.aging
+        heapq.heappush(self._heap, (score, next(self._seq), plan, future))
+        self._waiting += 1
+
+        try:
+            if on_queued is not None:
+                try:
+                    await on_queued(self._position(score))
+                except Exception as e:
+                    logger.debug(f"Queue notification failed: {e}")
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но забрать его некому
+                self._release()
+            else:
+                future.cancel()
+                self._waiting -= 1
+            raise
+        self._record(plan, time.monotonic() - started)
+
+    def _release(self):
+        self._active -= 1
+        while self._heap:
+            _, _, _, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            self._waiting -= 1
+            self._active += 1
+            future.set_result(None)
+            break
+
+    def _position(self, score: float) -> int:
+        return 1 + sum(1 for s, _, _, f in self._heap if s < score and not f.done())
+
+    def _record(self, plan: str, waited: float):
+        self.total += 1
+        self._waits[plan].append(waited)
+
+    def stats(self) -> dict:
+        waiting = {plan: 0 for plan in PRIORITY}
+        for _, _, plan, future in self._heap:
+            if not future.done():
+                waiting[plan] += 1
+        waits = {}
+        for plan, samples in self._waits.items():
+            ordered = sorted(samples)
+            waits[plan] = {
+                "p50": ordered[len(ordered) // 2] if ordered else 0.0,
+                "p95": ordered[int(len(ordered) * 0.95)] if ordered else 0.0,
+            }
+        return {
+            "active": self._active,
+            "concurrency": self.concurrency,
+            "waiting": self._waiting,
+            "waiting_by_plan": waiting,
+            "wait": waits,
+            "shed": self.shed,
+            "total": self.total,
+        }
+
+
+llm_scheduler = LLMScheduler(
+    concurrency=config.llm_concurrency,
+    aging=config.llm_aging_seconds,
+    shed_depth=config.llm_shed_queue_depth,
+)
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import time
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from bot.config import config
+
+logger = logging.getLogger(__name__)
+
+# Лимит длины сообщения Telegram с запасом под курсор
+PREVIEW_LIMIT = 4000
+CURSOR = " ▌"
+
+
+class ProgressEditor:
+    """
+    Показывает частично сгенерированный текст в сообщении ожидания.
+    Передаётся в ai_service как on_progress. Правки идут не чаще раза
+    в interval секунд и в фоне, чтобы не тормозить чтение потока;
+    промежуточные версии, пришедшие во время правки, пропускаются.
+    Текст модели выводится без разметки: незакрытый тег в середине
+    ответа сломал бы HTML-парсинг. Сообщение задаётся идентификаторами —
+    правит его и воркер очереди заданий, у которого нет объекта Message.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: int, interval: float | None = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval = config.stream_edit_interval if interval is None else interval
+        self._next_edit = 0.0
+        self._task: asyncio.Task | None = None
+        self._shown = ""
+        self.edits = 0
+
+    async def __call__(self, text: str):
+        now = time.monotonic()
+        if now < self._next_edit or (self._task and not self._task.done()):
+            return
+        preview = text[:PREVIEW_LIMIT].strip()
+        if not preview or preview == self._shown:
+            return
+        self._next_edit = now + self.interval
+        self._shown = preview
+        self._task = asyncio.create_task(self._edit(preview + CURSOR))
+
+    async def queued(self, position: int):
+        """Сообщение о месте в очереди к модели (передаётся как on_queued)."""
+        try:
+            await self.bot.edit_message_text(
+                f"⏳ <b>Высокая нагрузка</b> — вы {position}-й в очереди.\n"
+                f"<i>Генерация начнётся автоматически.</i>",
+                chat_id=self.chat_id, message_id=self.message_id, parse_mode="HTML",
+            )
+        except Exception as e:
+            logger.debug(f"Queue position edit skipped: {e}")
+
+    async def _edit(self, text: str):
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=self.chat_id, message_id=self.message_id, parse_mode=None,
+            )
+            self.edits += 1
+        except TelegramRetryAfter as e:
+            self._next_edit = time.monotonic() + e.retry_after
+        except TelegramBadRequest as e:
+            # "message is not modified" и удалённое сообщение — не повод прерывать генерацию
+            logger.debug(f"Progress edit skipped: {e}")
+        except Exception as e:
+            logger.warning(f"Progress edit failed: {e}")
+
+    async def finish(self):
+        """Дожидается последней правки, чтобы она не легла поверх итогового сообщения."""
+        self._next_edit = float("inf")
+        if self._task is not None:
+            await self._task
+            self._task = None
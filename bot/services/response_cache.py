@@ -0,0 +1,90 @@
+import hashlib
+import logging
+import re
+
+from bot.config import config
+from bot.database.cache import MISSING, TTLCache
+from bot.database.db import evict_response_cache, get_cached_response, put_cached_response
+
+logger = logging.getLogger(__name__)
+
+_SPACES = re.compile(r"\s+")
+_EDGE_PUNCT = " .,;:!?-—«»\"'()"
+
+
+def normalize(text: str) -> str:
+    """Регистр, ё, лишние пробелы и пунктуация по краям не влияют на ключ."""
+    text = text.lower().replace("ё", "е")
+    return _SPACES.sub(" ", text).strip(_EDGE_PUNCT)
+
+
+def make_key(kind: str, model: str, *parts: str) -> str:
+    raw = "\x1f".join([kind, model, *(normalize(p) for p in parts)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Двухуровневый кэш ответов модели: LRU в памяти поверх таблицы
+    response_cache. Хранит (текст, токены_вход, токены_выход) исходного
+    запроса — по ним считается, сколько токенов сэкономлено.
+    """
+
+    def __init__(self, memory_size: int, ttl: int, max_rows: int):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self._memory = TTLCache(maxsize=memory_size, ttl=ttl)
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+
+    async def get(self, key: str) -> tuple[str, int, int] | None:
+        entry = self._memory.get(key)
+        if entry is MISSING:
+            try:
+                entry = await get_cached_response(key, self.ttl)
+            except Exception as e:
+                logger.warning(f"Response cache read failed: {e}")
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._memory.set(key, entry)
+            self.db_hits += 1
+        else:
+            self.memory_hits += 1
+        self.tokens_saved += entry[1] + entry[2]
+        return entry
+
+    async def put(self, key: str, text: str, tokens_in: int, tokens_out: int):
+        self._memory.set(key, (text, tokens_in, tokens_out))
+        try:
+            await put_cached_response(key, text, tokens_in, tokens_out)
+        except Exception as e:
+            logger.warning(f"Response cache write failed: {e}")
+
+    async def evict(self) -> int:
+        removed = await evict_response_cache(self.ttl, self.max_rows)
+        if removed:
+            logger.info(f"Response cache: evicted {removed} entries")
+        return removed
+
+    def stats(self) -> dict:
+        hits = self.memory_hits + self.db_hits
+        total = hits + self.misses
+        return {
+            "memory_size": self._memory.stats()["size"],
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_ratio": hits / total if total else 0.0,
+            "tokens_saved": self.tokens_saved,
+        }
+
+
+response_cache = ResponseCache(
+    memory_size=config.response_cache_memory_size,
+    ttl=config.response_cache_ttl,
+    max_rows=config.response_cache_max_rows,
+)
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+from bot.config import config
+from bot.database.cache import MISSING, TTLCache
+from bot.services.ai_service import Completion, rewrite_card
+
+logger = logging.getLogger(__name__)
+
+
+class RestylePrefetcher:
+    """
+    Заранее переписывает карточку во всех стилях, пока пользователь
+    выбирает стиль. Варианты хранятся по (user_id, gen_id): style_key → Task.
+    Одновременно для одного пользователя идёт не больше per_user запросов.
+    Лимит здесь не списывается — только когда вариант показан (take()).
+    """
+
+    def __init__(self, per_user: int, maxsize: int, ttl: float):
+        self.per_user = max(1, per_user)
+        self._variants = TTLCache(maxsize=maxsize, ttl=ttl)
+        # user_id → [семафор, число задач]; запись удаляется вместе с последней задачей
+        self._slots: dict[int, list] = {}
+        self.started = 0
+        self.served = 0
+
+    def prefetch(
+        self,
+        user_id: int,
+        gen_id: int,
+        text: str,
+        marketplace: str,
+        plan: str,
+        styles: dict[str, str],
+    ):
+        key = (user_id, gen_id)
+        variants = self._variants.get(key)
+        if variants is MISSING:
+            variants = {}
+            self._variants.set(key, variants)
+        for style_key, style in styles.items():
+            if style_key in variants:
+                continue
+            task = asyncio.create_task(
+                self._rewrite(user_id, text, style, marketplace, plan),
+                name=f"restyle-{user_id}-{style_key}",
+            )
+            task.add_done_callback(_log_failure)
+            variants[style_key] = task
+            self.started += 1
+
+    def take(self, user_id: int, gen_id: int | None, style_key: str) -> asyncio.Task | None:
+        """Готовый или ещё считающийся вариант; забирается из кэша — повторный выбор стиля даёт новый."""
+        if gen_id is None:
+            return None
+        variants = self._variants.get((user_id, gen_id))
+        if variants is MISSING:
+            return None
+        task = variants.pop(style_key, None)
+        if task is not None:
+            self.served += 1
+        return task
+
+    async def _rewrite(self, user_id: int, text: str, style: str, marketplace: str, plan: str) -> Completion:
+        entry = self._slots.get(user_id)
+        if entry is None:
+            entry = self._slots[user_id] = [asyncio.Semaphore(self.per_user), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await rewrite_card(text, style, marketplace, plan=plan)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._slots[user_id]
+
+    def stats(self) -> dict:
+        return {"started": self.started, "served": self.served}
+
+
+def _log_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Style prefetch {task.get_name()} failed: {task.exception()!r}")
+
+
+restyle_prefetcher = RestylePrefetcher(
+    per_user=config.restyle_user_concurrency,
+    maxsize=config.restyle_cache_size,
+    ttl=config.restyle_cache_ttl,
+)
@@ -0,0 +1,82 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from bot.database import db
+from bot.database.compression import compress
+
+USER = 5
+TEXT = "ЗАГОЛОВОК: Кроссовки беговые\nОПИСАНИЕ: Лёгкие кроссовки для бега\n"
+ZDICT = b"\xd0\x97\xd0\x90\xd0\x93\xd0\x9e\xd0\x9b\xd0\x9e\xd0\x92\xd0\x9e\xd0\x9a: \n"
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    path = str(tmp_path / "bot.db")
+    monkeypatch.setattr(db, "DB_PATH", path)
+    monkeypatch.setattr(db, "_dicts", {})
+    monkeypatch.setattr(db, "_current_dict_id", 0)
+    return path
+
+
+def _store_from_other_process(path: str) -> int:
+    """Другой процесс обучил словарь и записал им карточку."""
+    conn = sqlite3.connect(path)
+    try:
+        dict_id = conn.execute("INSERT INTO compression_dicts (data) VALUES (?)", (ZDICT,)).lastrowid
+        gen_id = conn.execute(
+            "INSERT INTO generations (user_id, marketplace, category, product_name, has_result, created_at)"
+            " VALUES (?, 'Ozon', '', 'кроссовки', 1, 0)",
+            (USER,),
+        ).lastrowid
+        conn.execute(
+            "INSERT INTO generation_bodies (generation_id, dict_id, body) VALUES (?, ?, ?)",
+            (gen_id, dict_id, compress(TEXT, ZDICT)),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return gen_id
+
+
+def test_unknown_dictionary_is_reloaded(database):
+    async def run():
+        await db.init_db()
+        try:
+            await db.get_or_create_user(USER, "user", "User")
+            gen_id = _store_from_other_process(database)
+            card = await db.get_generation_by_id(gen_id, USER)
+            assert card["result_text"] == TEXT
+        finally:
+            await db.close_db()
+
+    asyncio.run(run())
+
+
+def test_missing_dictionary_raises(database):
+    async def run():
+        await db.init_db()
+        try:
+            with pytest.raises(LookupError):
+                await db._unpack_body(99, compress(TEXT, ZDICT))
+        finally:
+            await db.close_db()
+
+    asyncio.run(run())
+
+
+def test_body_migration_only_on_request(database):
+    async def run():
+        await db.init_db()
+        try:
+            assert db._body_migration is None
+        finally:
+            await db.close_db()
+        await db.init_db(migrate_bodies=True)
+        try:
+            assert db._body_migration is not None
+        finally:
+            await db.close_db()
+
+    asyncio.run(run())
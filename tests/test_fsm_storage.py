@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+from bot.database import db
+from bot.database.fsm_storage import RedisSessionStorage, SQLiteStorage
+
+KEY = StorageKey(bot_id=1, chat_id=5, user_id=5)
+
+
+class Clock:
+    """Подменяет db._now: даты строк задаются тестом."""
+
+    def __init__(self, now: int = 1_000_000):
+        self.now = now
+
+    def __call__(self) -> int:
+        return self.now
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "bot.db"))
+    clock = Clock()
+    monkeypatch.setattr(db, "_now", clock)
+    return clock
+
+
+def storage(ttl: float = 100) -> SQLiteStorage:
+    return SQLiteStorage(ttl=ttl, maxsize=10, flush_interval=60)
+
+
+def test_sqlite_survives_restart(database):
+    async def run():
+        await db.init_db()
+        try:
+            first = storage()
+            await first.set_state(KEY, "GenStates:result")
+            await first.set_data(KEY, {"gen_id": 3, "marketplace": "Ozon"})
+            await first.close()
+
+            second = storage()
+            assert await second.get_state(KEY) == "GenStates:result"
+            assert await second.get_data(KEY) == {"gen_id": 3, "marketplace": "Ozon"}
+            await second.set_state(KEY, None)
+            await second.set_data(KEY, {})
+            await second.close()
+            assert await db.count_fsm_sessions() == 0
+
+            third = storage()
+            assert await third.get_state(KEY) is None
+            assert await third.get_data(KEY) == {}
+            await third.close()
+        finally:
+            await db.close_db()
+
+    asyncio.run(run())
+
+
+def test_sqlite_read_extends_ttl(database):
+    async def run():
+        await db.init_db()
+        try:
+            st = storage(ttl=100)
+            await st.set_data(KEY, {"gen_id": 3})
+            await st.flush()
+
+            database.now += 80
+            assert await st.get_data(KEY) == {"gen_id": 3}
+            database.now += 70  # от записи прошло 150 с, от чтения — 70
+            await st.evict()
+            assert await db.count_fsm_sessions() == 1
+
+            database.now += 101  # без обращений сессия истекает
+            await st.evict()
+            assert await db.count_fsm_sessions() == 0
+            await st.close()
+        finally:
+            await db.close_db()
+
+    asyncio.run(run())
+
+
+def test_redis_round_trip():
+    fakeredis = pytest.importorskip("fakeredis")
+
+    async def run():
+        st = RedisSessionStorage(fakeredis.aioredis.FakeRedis(), ttl=60)
+        assert await st.get_state(KEY) is None
+        assert await st.get_data(KEY) == {}
+
+        await st.set_state(KEY, "GenStates:result")
+        await st.set_data(KEY, {"gen_id": 3})
+        assert await st.get_state(KEY) == "GenStates:result"
+        assert await st.get_data(KEY) == {"gen_id": 3}
+        assert 0 < await st.redis.ttl("fsm:1:5:5") <= 60
+        assert (await st.stats())["stored"] == 1
+
+        await st.set_state(KEY, None)
+        await st.set_data(KEY, {})
+        assert not await st.redis.exists("fsm:1:5:5")
+        await st.close()
+
+    asyncio.run(run())
@@ -0,0 +1,231 @@
+import asyncio
+import json
+
+import httpx
+import openai
+
+from bot.services.llm_client import CircuitBreaker, Endpoint, LLMClient
+
+COMPLETION = {
+    "id": "test",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "test",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+}
+
+
+class FakeTransport:
+    """Ответы эндпоинта по очереди: код статуса или "hang" — ждать до отмены."""
+
+    def __init__(self):
+        self.script: list = []
+        self.calls = 0
+        self.cancelled = 0
+        self.started = asyncio.Event()
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        self.started.set()
+        action = self.script.pop(0) if self.script else 200
+        if action == "hang":
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+        body = COMPLETION if action == 200 else {"error": {"message": "fail"}}
+        return httpx.Response(action, content=json.dumps(body), headers={"content-type": "application/json"})
+
+
+def make_endpoint(name: str) -> tuple[Endpoint, FakeTransport]:
+    transport = FakeTransport()
+    client = openai.AsyncOpenAI(
+        api_key="test",
+        base_url=f"http://{name}/v1",
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(transport)),
+    )
+    return Endpoint(name, client, breaker=CircuitBreaker(threshold=2, cooldown=0.05)), transport
+
+
+def make_client(**options):
+    a, fa = make_endpoint("a")
+    b, fb = make_endpoint("b")
+    options = {"max_attempts": 1, "hedge": False, **options}
+    return LLMClient([a, b], **options), a, fa, fb
+
+
+async def request(client: LLMClient):
+    return await client.create(model="test", messages=[{"role": "user", "content": "hi"}])
+
+
+async def open_breaker(client: LLMClient, endpoint: Endpoint, transport: FakeTransport):
+    """Две ошибки 500 на эндпоинте a открывают цепь."""
+    transport.script = [500, 500]
+    for _ in range(4):  # запросы чередуются между a и b
+        try:
+            await request(client)
+        except Exception:
+            pass
+    assert endpoint.breaker.state == "open"
+    await asyncio.sleep(0.06)
+    assert endpoint.breaker.state == "half-open"
+
+
+def test_open_half_open_closed():
+    async def run():
+        client, a, fa, fb = make_client()
+        await open_breaker(client, a, fa)
+        calls = fa.calls
+        for _ in range(2):
+            await request(client)
+        assert fa.calls == calls + 1  # пробный запрос прошёл
+        assert a.breaker.state == "closed"
+
+    asyncio.run(run())
+
+
+def test_probe_failure_reopens():
+    async def run():
+        client, a, fa, fb = make_client()
+        await open_breaker(client, a, fa)
+        fa.script = [503]
+        for _ in range(2):
+            try:
+                await request(client)
+            except Exception:
+                pass
+        assert a.breaker.state == "open"
+
+    asyncio.run(run())
+
+
+def test_probe_non_retryable_error_closes():
+    async def run():
+        client, a, fa, fb = make_client()
+        await open_breaker(client, a, fa)
+        fa.script = [400]
+        for _ in range(2):
+            try:
+                await request(client)
+            except openai.BadRequestError:
+                pass
+        assert a.breaker.state == "closed"
+        calls = fa.calls
+        for _ in range(2):
+            await request(client)
+        assert fa.calls == calls + 1
+
+    asyncio.run(run())
+
+
+def test_probe_cancelled_releases():
+    async def run():
+        client, a, fa, fb = make_client()
+        await open_breaker(client, a, fa)
+        fa.script = ["hang"]
+        fa.started.clear()
+        client._next = 0  # следующий запрос — на a
+        task = asyncio.create_task(request(client))
+        await fa.started.wait()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert a.breaker.state == "half-open"
+        client._next = 0
+        calls = fa.calls
+        await request(client)
+        assert fa.calls == calls + 1  # новая проба допущена
+        assert a.breaker.state == "closed"
+
+    asyncio.run(run())
+
+
+def test_route_timeout_is_total_deadline():
+    async def run():
+        client, a, fa, fb = make_client()
+        fa.script = ["hang"]
+        client._next = 0
+        try:
+            await client.create(model="test", messages=[], timeout=0.05)
+        except Exception as e:
+            assert isinstance(e.__cause__, openai.APITimeoutError)
+        else:
+            raise AssertionError("deadline was not enforced")
+        assert a.breaker.failures == 1
+
+    asyncio.run(run())
+
+
+def test_warm_up_does_not_hang():
+    async def run():
+        client, a, fa, fb = make_client()
+        client.connect_timeout = 0.05
+        fa.script = ["hang"]
+        timings = await asyncio.wait_for(client.warm_up(), 1)
+        assert set(timings) == {"a", "b"}
+
+    asyncio.run(run())
+
+
+def test_hedge_after_p95():
+    async def run():
+        client, a, fa, fb = make_client(hedge=True, hedge_min_samples=5)
+        kind = ("test", None, False)
+        for _ in range(5):
+            a.record(kind, 0.05)
+        fa.script = ["hang"]
+        client._next = 0
+        result = await asyncio.wait_for(request(client), 2)
+        assert result.choices[0].message.content == "ok"
+        assert (fa.calls, fb.calls) == (1, 1)
+        assert client.hedges == 1 and client.hedge_wins == 1
+        await asyncio.sleep(0)  # отмена проигравшего доходит до транспорта
+        assert fa.cancelled == 1
+
+    asyncio.run(run())
+
+
+def test_no_hedge_below_min_samples():
+    async def run():
+        client, a, fa, fb = make_client(hedge=True, hedge_min_samples=5)
+        a.record(("test", None, False), 0.05)
+        client._next = 0
+        await request(client)
+        assert (fa.calls, fb.calls) == (1, 0)
+        assert client.hedges == 0
+
+    asyncio.run(run())
+
+
+def test_retry_after_server_error():
+    async def run():
+        client, a, fa, fb = make_client(max_attempts=3, backoff_base=0.01)
+        fa.script = [500]
+        client._next = 0
+        result = await request(client)
+        assert result.choices[0].message.content == "ok"
+        assert client.retries == 1
+        assert (fa.calls, fb.calls) == (1, 1)  # повтор — на следующий эндпоинт
+
+    asyncio.run(run())
+
+
+def test_client_error_not_retried():
+    async def run():
+        client, a, fa, fb = make_client(max_attempts=3, backoff_base=0.01)
+        fa.script = [400]
+        client._next = 0
+        try:
+            await request(client)
+        except openai.BadRequestError:
+            pass
+        else:
+            raise AssertionError("400 must be raised")
+        assert client.retries == 0
+        assert (fa.calls, fb.calls) == (1, 0)
+
+    asyncio.run(run())
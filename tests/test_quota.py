@@ -0,0 +1,115 @@
+import asyncio
+import multiprocessing
+
+import pytest
+
+from bot.config import config
+from bot.database import db
+from bot.database.quota import reserve_quota
+
+USER = 5
+LIMIT = 3
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    path = str(tmp_path / "bot.db")
+    monkeypatch.setattr(db, "DB_PATH", path)
+    monkeypatch.setattr(config, "free_daily_limit", LIMIT)
+    return path
+
+
+async def _open(path: str):
+    db.DB_PATH = path
+    await db.init_db()
+    await db.get_or_create_user(USER, "user", "User")
+
+
+async def _usage() -> tuple[int, int]:
+    async with db._db() as conn:
+        cursor = await conn.execute(
+            "SELECT count, reserved FROM usage_counters WHERE user_id = ? AND period = ?",
+            (USER, db._day_period()),
+        )
+        row = await cursor.fetchone()
+    return (row[0], row[1]) if row else (0, 0)
+
+
+def test_commit_and_release(database):
+    async def run():
+        await _open(database)
+        try:
+            first = await reserve_quota(USER)
+            second = await reserve_quota(USER)
+            assert first.allowed and second.allowed
+            assert await _usage() == (0, 2)
+
+            await first.commit(marketplace="Ozon", category="", product_name="товар")
+            await first.release()  # после commit ничего не делает
+            assert await _usage() == (1, 1)
+
+            await second.release()
+            assert await _usage() == (1, 0)
+        finally:
+            await db.close_db()
+
+    asyncio.run(run())
+
+
+def test_concurrent_reservations_stop_at_limit(database):
+    async def run():
+        await _open(database)
+        try:
+            reservations = await asyncio.gather(*(reserve_quota(USER) for _ in range(10)))
+            assert sum(r.allowed for r in reservations) == LIMIT
+            assert await _usage() == (0, LIMIT)
+        finally:
+            await db.close_db()
+
+    asyncio.run(run())
+
+
+def test_stale_reservations_purged(database, monkeypatch):
+    async def run():
+        await _open(database)
+        try:
+            await reserve_quota(USER)
+            assert await db.purge_quota_reservations(3600) == 0
+            monkeypatch.setattr(db, "_now", lambda: int(__import__("time").time()) + 3601)
+            assert await db.purge_quota_reservations(3600) == 1
+            assert await _usage() == (0, 0)
+        finally:
+            await db.close_db()
+
+    asyncio.run(run())
+
+
+def _reserve_in_process(path: str, n: int, results):
+    """Отдельный процесс бота на той же базе: n параллельных резервов."""
+    async def run():
+        await _open(path)
+        try:
+            reservations = await asyncio.gather(*(reserve_quota(USER) for _ in range(n)))
+            results.put(sum(r.allowed for r in reservations))
+        finally:
+            await db.close_db()
+
+    config.free_daily_limit = LIMIT
+    asyncio.run(run())
+
+
+def test_reservations_shared_between_processes(database):
+    async def setup():
+        await _open(database)
+        await db.close_db()
+
+    asyncio.run(setup())
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    processes = [ctx.Process(target=_reserve_in_process, args=(database, 5, results)) for _ in range(2)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(30)
+        assert process.exitcode == 0
+    assert results.get(timeout=1) + results.get(timeout=1) == LIMIT